@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Latency and throughput of the storages against a local mongod.
+
+Every scenario runs on emptied collections, prefilled with the
+requested number of documents, and measures each operation over distinct
+keys with the given number of concurrent callers::
+
+    python benchmarks/storage_benchmark.py --output current.json
+    python benchmarks/storage_benchmark.py --baseline previous.json
+
+Results are written as JSON. With ``--baseline``, scenarios whose p90
+latency grew by more than ``--threshold`` are reported and the script
+exits with status 1.
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+from importlib import import_module
+from timeit import default_timer
+
+import pymongo
+from bson.binary import Binary
+from tornado import gen
+from tornado.ioloop import IOLoop
+from thumbor.config import Config
+from thumbor.context import Context, RequestParameters, ServerParameters
+from tc_mongodb.mongodb import keys
+
+STORAGES = {
+    'mongo_storage': 'tc_mongodb.storages.mongo_storage',
+    'motor_storage': 'tc_mongodb.storages.motor_storage',
+    'mongo_result_storage':
+        'tc_mongodb.result_storages.mongo_result_storage',
+    'motor_result_storage':
+        'tc_mongodb.result_storages.motor_result_storage',
+}
+
+STORAGE_OPERATIONS = ('put', 'get', 'exists')
+RESULT_STORAGE_OPERATIONS = ('put', 'get', 'last_updated')
+
+PREFILL_BATCH_SIZE = 1000
+PREFILL_PAYLOAD = b'\0' * 1024
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+def percentile(latencies, fraction):
+    '''Return the nearest-rank percentile of sorted latencies.'''
+
+    if not latencies:
+        return None
+    rank = max(int(round(fraction * len(latencies))) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    to_ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'count': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'mean_ms': to_ms(sum(latencies) / len(latencies)),
+        'p50_ms': to_ms(percentile(latencies, 0.5)),
+        'p90_ms': to_ms(percentile(latencies, 0.9)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'max_ms': to_ms(latencies[-1]),
+    }
+
+
+def build_config(options):
+    settings = {
+        'STORAGE_EXPIRATION_SECONDS': 3600,
+        'RESULT_STORAGE_EXPIRATION_SECONDS': 3600,
+        'MONGODB_STORAGE_IGNORE_ERRORS': False,
+    }
+    for prefix, collection in (('MONGO_STORAGE', 'images'),
+                               ('MONGO_RESULT_STORAGE', 'results')):
+        settings.update({
+            prefix + '_URI': options.uri,
+            prefix + '_SERVER_HOST': None,
+            prefix + '_SERVER_PORT': None,
+            prefix + '_SERVER_DB': options.database,
+            prefix + '_SERVER_COLLECTION': collection,
+            # The sweep would compete with the measured operations
+            prefix + '_ORPHAN_SWEEP_INTERVAL': 0,
+        })
+    for setting in options.setting:
+        name, value = setting.split('=', 1)
+        settings[name] = json.loads(value)
+    return Config(**settings)
+
+
+def build_context(config, url=None):
+    server = ServerParameters(
+        8888, 'localhost', 'thumbor.conf', None, 'info', None
+    )
+    server.security_key = 'BENCHMARK'
+    context = Context(server=server, config=config)
+    if url is not None:
+        context.request = RequestParameters(url=url)
+    return context
+
+
+def empty(database):
+    '''Remove every document but keep the indexes, which the storages only
+    create once per process.
+    '''
+
+    for name in ('images', 'results', 'fs.files', 'fs.chunks'):
+        database[name].delete_many({})
+
+
+def prefill(database, config, name, count):
+    '''Insert count small documents directly, as the storage would.'''
+
+    is_result = 'result' in name
+    collection = database['results' if is_result else 'images']
+    prefix = 'MONGO_RESULT_STORAGE' if is_result else 'MONGO_STORAGE'
+    hashed = config.get(prefix + '_HASHED_KEYS', False) or \
+        config.get(prefix + '_SHARDED', False)
+    created_at = datetime.utcnow()
+    expires_at = created_at + timedelta(hours=1)
+
+    def documents():
+        for index in range(count):
+            key = 'prefill/%d.png' % index
+            if is_result:
+                doc = keys.lookup('key', 'result:' + key, hashed)
+                doc.update(metadata={}, content_type='image/png',
+                           content_length=len(PREFILL_PAYLOAD),
+                           etag='"prefill"')
+            else:
+                doc = keys.lookup('path', key, hashed)
+            doc.update(created_at=created_at, expires_at=expires_at,
+                       data=Binary(PREFILL_PAYLOAD))
+            yield doc
+
+    batch = []
+    for doc in documents():
+        batch.append(doc)
+        if len(batch) >= PREFILL_BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+@gen.coroutine
+def measure(call, arguments, concurrency):
+    '''Run call over arguments with concurrency callers in flight.'''
+
+    pending = list(reversed(arguments))
+    latencies = []
+
+    @gen.coroutine
+    def caller():
+        while pending:
+            argument = pending.pop()
+            started = default_timer()
+            yield gen.maybe_future(call(argument))
+            latencies.append(default_timer() - started)
+
+    started = default_timer()
+    yield [caller() for _ in range(concurrency)]
+    raise gen.Return(summarize(latencies, default_timer() - started))
+
+
+def storage_calls(module, config, payload):
+    def put(path):
+        return module.Storage(build_context(config)).put(path, payload)
+
+    def get(path):
+        return module.Storage(build_context(config)).get(path)
+
+    def exists(path):
+        return module.Storage(build_context(config)).exists(path)
+
+    return {'put': put, 'get': get, 'exists': exists}
+
+
+def result_storage_calls(module, config, payload):
+    def storage(url):
+        return module.Storage(build_context(config, url))
+
+    def put(url):
+        return storage(url).put(payload)
+
+    def get(url):
+        return storage(url).get()
+
+    def last_updated(url):
+        return storage(url).last_updated()
+
+    return {'put': put, 'get': get, 'last_updated': last_updated}
+
+
+@gen.coroutine
+def run_scenario(name, options, config, size, concurrency, collection_size):
+    module = import_module(STORAGES[name])
+    payload = b'\xff' * size
+    paths = ['bench/%d/%d/%d.png' % (size, concurrency, index)
+             for index in range(options.operations)]
+
+    if 'result' in name:
+        calls = result_storage_calls(module, config, payload)
+        operations = RESULT_STORAGE_OPERATIONS
+    else:
+        calls = storage_calls(module, config, payload)
+        operations = STORAGE_OPERATIONS
+
+    results = []
+    for operation in operations:
+        summary = yield measure(calls[operation], paths, concurrency)
+        summary.update({
+            'storage': name,
+            'operation': operation,
+            'payload_size': size,
+            'concurrency': concurrency,
+            'collection_size': collection_size,
+        })
+        results.append(summary)
+        print(
+            '%(storage)s %(operation)s size=%(payload_size)d '
+            'concurrency=%(concurrency)d documents=%(collection_size)d: '
+            'p50=%(p50_ms)sms p90=%(p90_ms)sms p99=%(p99_ms)sms '
+            '%(throughput)s ops/s' % summary,
+            file=sys.stderr
+        )
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def run(options):
+    config = build_config(options)
+    client = pymongo.MongoClient(options.uri)
+    database = client[options.database]
+    client.drop_database(options.database)
+    results = []
+
+    for name in options.storages:
+        for collection_size in options.collection_sizes:
+            empty(database)
+            prefill(database, config, name, collection_size)
+            for size in options.sizes:
+                for concurrency in options.concurrency:
+                    scenario = yield run_scenario(
+                        name, options, config, size, concurrency,
+                        collection_size
+                    )
+                    results.extend(scenario)
+
+    client.drop_database(options.database)
+    raise gen.Return({
+        'environment': environment(client),
+        'results': results,
+    })
+
+
+def environment(client):
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('tc_mongodb').version
+    except Exception:
+        version = None
+
+    return {
+        'tc_mongodb': version,
+        'pymongo': pymongo.version,
+        'mongodb': client.server_info().get('version'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def scenario_key(result):
+    return (result['storage'], result['operation'], result['payload_size'],
+            result['concurrency'], result['collection_size'])
+
+
+def compare(report, baseline, threshold):
+    '''Return the scenarios whose p90 latency grew by more than threshold
+    relative to the baseline.
+    :rtype: list
+    '''
+
+    previous = dict(
+        (scenario_key(result), result) for result in baseline['results']
+    )
+    regressions = []
+    for result in report['results']:
+        before = previous.get(scenario_key(result))
+        if not before or not before['p90_ms']:
+            continue
+        change = (result['p90_ms'] - before['p90_ms']) / before['p90_ms']
+        if change > threshold:
+            regressions.append((scenario_key(result), before['p90_ms'],
+                                result['p90_ms'], change))
+    return regressions
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='tc_mongodb_benchmark',
+                        help='dropped before and after the run')
+    parser.add_argument('--storages', default='mongo_storage,'
+                        'mongo_result_storage',
+                        type=lambda value: value.split(','),
+                        help='comma separated, among %s' %
+                        ', '.join(sorted(STORAGES)))
+    parser.add_argument('--sizes', default='1024,65536,1048576',
+                        type=parse_sizes, help='payload sizes in bytes')
+    parser.add_argument('--concurrency', default='1,8,32', type=parse_sizes,
+                        help='concurrent callers')
+    parser.add_argument('--collection-sizes', default='0,10000',
+                        type=parse_sizes, help='documents prefilled')
+    parser.add_argument('--operations', default=200, type=int,
+                        help='calls per operation and scenario')
+    parser.add_argument('--setting', action='append', default=[],
+                        metavar='NAME=JSON',
+                        help='extra thumbor setting, e.g. '
+                        'MONGO_STORAGE_INLINE_MAX_SIZE=0')
+    parser.add_argument('--output', help='write the JSON report there')
+    parser.add_argument('--baseline', help='JSON report to compare with')
+    parser.add_argument('--threshold', default=0.2, type=float,
+                        help='tolerated p90 growth, 0.2 is 20%%')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    for name in options.storages:
+        if name not in STORAGES:
+            raise SystemExit('Unknown storage %r' % name)
+
+    report = IOLoop.current().run_sync(lambda: run(options))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as destination:
+            destination.write(output)
+    else:
+        print(output)
+
+    if options.baseline:
+        with open(options.baseline) as source:
+            baseline = json.load(source)
+        regressions = compare(report, baseline, options.threshold)
+        for key, before, after, change in regressions:
+            print('REGRESSION %s: p90 %.3fms -> %.3fms (+%d%%)' % (
+                '/'.join(str(part) for part in key), before, after,
+                change * 100
+            ), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
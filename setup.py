@@ -26,6 +26,12 @@ setup(
         'tc_mongodb.storages',
         'tc_mongodb.result_storages'
     ]),
+    entry_points={
+        'console_scripts': ['tc-mongodb = tc_mongodb.cli:main']
+    },
+    extras_require={
+        'motor': ['motor>=2.1.0,<2.2.0']
+    },
     long_description=long_description,
     classifiers=[
         'Development Status :: 5 - Production/Stable',
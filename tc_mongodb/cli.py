@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Maintenance of the MongoDB storages, outside of thumbor::
+
+    tc-mongodb -c thumbor.conf indexes --check
+    tc-mongodb -c thumbor.conf purge --expired --orphans --rate 500
+    tc-mongodb -c thumbor.conf stats
+
+Every command reads the storage settings from the thumbor configuration and
+applies to the image storage, the result storage or both.
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+from pymongo.errors import OperationFailure, PyMongoError
+from thumbor.config import Config
+from tc_mongodb.mongodb import maintenance, periods
+from tc_mongodb.mongodb.registry import client_options
+from tc_mongodb.mongodb.connector_storage import \
+    MongoConnector as StorageConnector
+from tc_mongodb.mongodb.connector_result_storage import \
+    MongoConnector as ResultStorageConnector
+
+# name -> (setting prefix, connector class, key field, expiration setting)
+TARGETS = {
+    'storage': ('MONGO_STORAGE', StorageConnector, 'path',
+                'STORAGE_EXPIRATION_SECONDS'),
+    'result-storage': ('MONGO_RESULT_STORAGE', ResultStorageConnector, 'key',
+                       'RESULT_STORAGE_EXPIRATION_SECONDS'),
+}
+
+CONFIG_LOOKUP_PATHS = [os.curdir, os.path.expanduser('~'), '/etc/']
+
+
+def load_config(path):
+    return Config.load(
+        path, conf_name='thumbor.conf', lookup_paths=CONFIG_LOOKUP_PATHS
+    )
+
+
+def connect(config, name):
+    '''Return the connector of a storage, without index bootstrap.
+    :param string name: Key of TARGETS
+    '''
+
+    prefix, connector_class, _, _ = TARGETS[name]
+    options = client_options(config, prefix)
+    if connector_class is ResultStorageConnector:
+        options['tracks_access'] = \
+            config.get(prefix + '_MAX_SIZE', 0) > 0 and \
+            partitioning(config, name) is None
+    return connector_class(
+        uri=config.get(prefix + '_URI', None),
+        host=config.get(prefix + '_SERVER_HOST', None),
+        port=config.get(prefix + '_SERVER_PORT', None),
+        db_name=config.get(prefix + '_SERVER_DB', None),
+        coll_name=config.get(prefix + '_SERVER_COLLECTION', None),
+        hashed_keys=config.get(prefix + '_HASHED_KEYS', False),
+        sharded=config.get(prefix + '_SHARDED', False),
+        ensure_indexes=False,
+        **options
+    )
+
+
+def partitioning(config, name):
+    '''Return the period length and expiration of a partitioned storage,
+    None when it is not partitioned.
+    :rtype: tuple
+    '''
+
+    prefix, _, _, expiration = TARGETS[name]
+    max_age = config.get(expiration, None)
+    if not config.get(prefix + '_PARTITIONED', False) or \
+            not max_age or max_age <= 0:
+        return None
+    return periods.check_partitioning(
+        prefix,
+        config.get(prefix + '_PARTITION_SECONDS', None) or max_age,
+        max_age
+    )
+
+
+def report(name, message, *args):
+    print('%s: %s' % (name, message % args))
+
+
+def indexes(config, name, options):
+    '''Create the missing indexes, or only report them with --check.
+    :returns: Whether every index is in place
+    :rtype: bool
+    '''
+
+    connector = connect(config, name)
+    collection = connector.coll_conn
+    problems = maintenance.index_problems(
+        collection, connector.index_specs()
+    )
+
+    if not options.check and any(p == 'missing' for _, p in problems):
+        connector.ensure_index()
+        problems = maintenance.index_problems(
+            collection, connector.index_specs()
+        )
+
+    for index_name, problem in problems:
+        report(name, 'index %s is %s on %s', index_name, problem,
+               collection.full_name)
+    if not problems:
+        report(name, 'indexes of %s are in place', collection.full_name)
+    return not problems
+
+
+def purge(config, name, options):
+    '''Delete expired documents and orphaned GridFS data, at most
+    options.rate documents or files per second.
+    '''
+
+    _, _, field, expiration = TARGETS[name]
+    connector = connect(config, name)
+    database, collection = connector.db_conn, connector.coll_conn
+    pause = float(options.batch_size) / options.rate if options.rate else 0
+    verb = 'would remove' if options.dry_run else 'removed'
+
+    if options.expired:
+        removed = maintenance.purge_expired(
+            database, collection,
+            max_age=config.get(expiration, None),
+            batch_size=options.batch_size,
+            pause=pause,
+            dry_run=options.dry_run
+        )
+        report(name, '%s %d expired documents from %s', verb, removed,
+               collection.full_name)
+
+        length_and_age = partitioning(config, name)
+        if length_and_age is not None:
+            drop = periods.expired_partitions if options.dry_run \
+                else periods.drop_expired
+            dropped = drop(database, collection.name, *length_and_age)
+            report(name, '%s %d expired partitions of %s', verb,
+                   len(dropped), collection.full_name)
+
+    if options.orphans:
+        files, _ = maintenance.sweep_orphaned_files(
+            database, collection,
+            maintenance.owned_files([field], collection),
+            batch_size=options.batch_size,
+            grace=options.grace,
+            pause=pause,
+            dry_run=options.dry_run
+        )
+        chunks = maintenance.sweep_orphaned_chunks(
+            database,
+            batch_size=options.batch_size,
+            grace=options.grace,
+            pause=pause,
+            dry_run=options.dry_run
+        )
+        report(name, '%s %d orphaned files and %d chunk sets from %s',
+               verb, files, chunks, database.name)
+    return True
+
+
+def collection_stats(database, collection_name):
+    try:
+        stats = database.command('collStats', collection_name)
+    except OperationFailure:
+        # Not created yet
+        return None
+    return dict((key, stats.get(key)) for key in (
+        'count', 'size', 'storageSize', 'totalIndexSize', 'indexSizes'
+    ))
+
+
+def stats(config, name, options):
+    '''Print the sizes of the collection, its GridFS bucket and indexes.'''
+
+    _, _, _, expiration = TARGETS[name]
+    connector = connect(config, name)
+    database, collection = connector.db_conn, connector.coll_conn
+
+    result = {'storage': name}
+    for collection_name in (collection.name, 'fs.files', 'fs.chunks'):
+        result[collection_name] = collection_stats(database, collection_name)
+    result['expired'] = collection.count_documents(
+        maintenance.expired_documents(config.get(expiration, None))
+    )
+    print(json.dumps(result, indent=2, sort_keys=True, default=str))
+    return True
+
+
+def compact(config, name, options):
+    '''Release the space left by deleted documents. MongoDB before 4.4
+    blocks the database while compacting.
+    '''
+
+    connector = connect(config, name)
+    database = connector.db_conn
+    for collection_name in (connector.coll_conn.name, 'fs.files',
+                            'fs.chunks'):
+        database.command('compact', collection_name)
+        report(name, 'compacted %s.%s', database.name, collection_name)
+    return True
+
+
+COMMANDS = {
+    'indexes': indexes,
+    'purge': purge,
+    'stats': stats,
+    'compact': compact,
+}
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='tc-mongodb', description=__doc__.split('\n')[0]
+    )
+    parser.add_argument('-c', '--conf', help='thumbor configuration file')
+    parser.add_argument('-s', '--storage', default='all',
+                        choices=sorted(TARGETS) + ['all'])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    indexes_parser = commands.add_parser(
+        'indexes', help='create the missing indexes'
+    )
+    indexes_parser.add_argument('--check', action='store_true',
+                                help='only report missing or differing '
+                                'indexes, exit with status 1 if any')
+
+    purge_parser = commands.add_parser(
+        'purge', help='delete expired documents and orphaned GridFS files'
+    )
+    purge_parser.add_argument('--expired', action='store_true')
+    purge_parser.add_argument('--orphans', action='store_true')
+    purge_parser.add_argument('--batch-size', default=500, type=int)
+    purge_parser.add_argument('--rate', default=0, type=int,
+                              help='documents or files per second, 0 does '
+                              'not limit')
+    purge_parser.add_argument('--grace', type=int,
+                              default=maintenance.ORPHAN_GRACE_SECONDS,
+                              help='keep GridFS files younger than this, in '
+                              'seconds')
+    purge_parser.add_argument('--dry-run', action='store_true')
+
+    commands.add_parser('stats', help='print collection and index sizes')
+    commands.add_parser('compact', help='compact the collections')
+
+    options = parser.parse_args(argv)
+    if options.command == 'purge' and not (options.expired or
+                                           options.orphans):
+        parser.error('purge needs --expired, --orphans or both')
+    return options
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    config = load_config(options.conf)
+    names = sorted(TARGETS) if options.storage == 'all' \
+        else [options.storage]
+
+    succeeded = True
+    for name in names:
+        try:
+            succeeded = COMMANDS[options.command](config, name, options) \
+                and succeeded
+        except PyMongoError as exc_value:
+            report(name, '%s failed: %s', options.command, exc_value)
+            succeeded = False
+    return 0 if succeeded else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
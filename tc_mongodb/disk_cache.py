@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from thumbor.utils import logger
+
+TEMPORARY_SUFFIX = '.tmp'
+
+
+class DiskCache(object):
+    '''Least recently used cache of immutable payloads in local files,
+    bounded by their total size.
+
+    Files left by earlier processes are picked up at start-up, oldest
+    first. Processes sharing a directory each enforce the budget over the
+    files they know about.
+
+    :param string directory: Where the files live, created when missing
+    :param int max_size: Budget for the sum of the file sizes
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path_for(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def load(self):
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if name.endswith(TEMPORARY_SUFFIX):
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+
+        found.sort()
+        with self.lock:
+            for _, path, size in found:
+                self.entries[path] = size
+                self.size += size
+            self.evict()
+
+    def get(self, key):
+        '''Return the payload cached for key and mark it as recently used.
+        :rtype: bytes
+        '''
+
+        path = self.path_for(key)
+        try:
+            with open(path, 'rb') as cached:
+                contents = cached.read()
+        except (IOError, OSError):
+            contents = None
+        if not contents:
+            # Missing, or evicted by another process
+            with self.lock:
+                self.misses += 1
+                self.size -= self.entries.pop(path, 0)
+            return None
+
+        with self.lock:
+            self.hits += 1
+            self.size -= self.entries.pop(path, 0)
+            self.entries[path] = len(contents)
+            self.size += len(contents)
+            self.evict()
+        return contents
+
+    def set(self, key, contents):
+        '''Write the payload of key, evicting the least recently used files
+        until it fits. Empty payloads and payloads bigger than the whole
+        budget are not cached.
+        '''
+
+        size = len(contents)
+        if not size or size > self.max_size:
+            return
+
+        path = self.path_for(key)
+        temporary = '%s.%d.%d%s' % (
+            path, os.getpid(), threading.current_thread().ident,
+            TEMPORARY_SUFFIX
+        )
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Created concurrently
+                    pass
+            with open(temporary, 'wb') as cached:
+                cached.write(contents)
+            os.rename(temporary, path)
+        except (IOError, OSError) as exc_value:
+            logger.warning(
+                "[MONGODB] can't write %s to the disk cache: %s",
+                path, exc_value
+            )
+            self.remove(temporary)
+            return
+
+        with self.lock:
+            self.size -= self.entries.pop(path, 0)
+            self.entries[path] = size
+            self.size += size
+            self.evict()
+
+    def delete(self, key):
+        path = self.path_for(key)
+        with self.lock:
+            self.size -= self.entries.pop(path, 0)
+        self.remove(path)
+
+    def evict(self):
+        # Called with the lock held
+        while self.entries and self.size > self.max_size:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        '''Return the cache counters.
+        :rtype: dict
+        '''
+
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Thread-safe least recently used cache bounded by the total size of
+    its values, with an optional lifetime per entry.
+
+    :param int max_size: Budget for the sum of the entry sizes
+    :param callable sizeof: Return the size of a value, ``len`` by default
+    '''
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        '''Return the value cached for key and mark it as recently used.'''
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, size, expires = entry
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                self.misses += 1
+                return default
+
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''Cache value for key, evicting the least recently used entries
+        until it fits. Values bigger than the whole budget are not cached.
+        :param int ttl: Seconds the entry stays valid, None for no limit
+        '''
+
+        size = self.sizeof(value)
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+
+            if size > self.max_size:
+                return
+
+            while self.entries and self.size + size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+                self.evictions += 1
+
+            self.entries[key] = (value, size, expires)
+            self.size += size
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        '''Return the cache counters.
+        :rtype: dict
+        '''
+
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Content-addressed GridFS files shared by every document with the same
+payload.
+
+A shared file is identified by the digest of its contents, counts the
+documents referencing it in its ``refs`` field and lists the collections
+holding them in ``collections``. The orphan sweep remains the backstop for
+references dropped without a release, e.g. by the TTL index. Each reuse
+sets ``last_referenced``, the sweep leaves blobs referenced recently alone.
+
+A blob is deleted in three steps: its files document is marked
+``deleting``, then its chunks are deleted, then the document. A marked blob
+can't be referenced, and its id is not uploaded again until the document
+is gone, so a new upload never shares chunks with a blob being deleted.
+Puts that can't share a blob store the payload as a file of its own.
+'''
+
+import hashlib
+from datetime import datetime
+
+import gridfs
+from gridfs.errors import FileExists
+from pymongo import ReturnDocument
+
+SHARED_PREFIX = 'sha256:'
+
+
+def blob_id(contents):
+    return SHARED_PREFIX + hashlib.sha256(contents).hexdigest()
+
+
+def is_shared(file_id):
+    return str(file_id).startswith(SHARED_PREFIX)
+
+
+def put_shared(database, collection_name, contents):
+    '''Store contents once per database and take a reference on it for a
+    document of collection_name.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param string collection_name: Collection of the referencing document
+    :param bytes contents: Payload
+    :returns: The file id, None when the blob is being deleted or uploaded
+        by another put, the caller then stores a file of its own
+    :rtype: string
+    '''
+
+    file_id = blob_id(contents)
+    files = database.fs.files
+
+    def take_reference():
+        # last_referenced keeps the orphan sweep off a reused blob until
+        # the document referencing it is written
+        return files.update_one({
+            '_id': file_id, 'deleting': {'$exists': False}
+        }, {
+            '$inc': {'refs': 1},
+            '$addToSet': {'collections': collection_name},
+            '$set': {'last_referenced': datetime.utcnow()},
+        }).matched_count
+
+    if take_reference():
+        return file_id
+    if files.find_one({'_id': file_id}, {'_id': True}) is not None:
+        # Being deleted
+        return None
+
+    try:
+        gridfs.GridFS(database).put(
+            contents, _id=file_id, refs=1, collections=[collection_name]
+        )
+        return file_id
+    except FileExists:
+        # Uploaded concurrently by another put, which writes the files
+        # document after the chunks
+        if take_reference():
+            return file_id
+        return None
+
+
+def delete_marked(database, file_ids):
+    '''Delete the files of file_ids marked ``deleting``, chunks first.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param list file_ids: Ids of marked files
+    '''
+
+    database.fs.chunks.delete_many({'files_id': {'$in': file_ids}})
+    database.fs.files.delete_many({
+        '_id': {'$in': file_ids}, 'deleting': {'$exists': True}
+    })
+
+
+def release(database, file_id, bucket_name='fs'):
+    '''Drop a reference on a GridFS file, deleting it along with its last
+    reference. Files that are not shared are deleted right away.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param file_id: The file id
+    :param string bucket_name: Bucket of files that are not shared, shared
+        ones always live in ``fs``
+    :returns: Whether the file was deleted
+    :rtype: bool
+    '''
+
+    if not is_shared(file_id):
+        gridfs.GridFS(database, bucket_name).delete(file_id)
+        return True
+
+    files = database.fs.files
+    blob = files.find_one_and_update(
+        {'_id': file_id},
+        {'$inc': {'refs': -1}},
+        projection={'refs': True},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None or blob.get('refs', 0) > 0:
+        return False
+
+    marked = files.update_one({
+        '_id': file_id,
+        'refs': {'$lte': 0},
+        'deleting': {'$exists': False},
+    }, {'$set': {'deleting': datetime.utcnow()}})
+    if not marked.modified_count:
+        # Referenced again, or deleted by another release
+        return False
+    delete_marked(database, [file_id])
+    return True
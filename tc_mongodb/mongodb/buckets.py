@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Process-wide GridFS buckets and chunk-wise reads of their files.
+
+``GridOut.read`` appends every chunk to a growing in-memory stream before
+copying it out. The readers here keep the chunks as they arrive and join
+them once, into a buffer allocated at the final size. :func:`read_files`
+reads many files in two queries.
+'''
+
+import threading
+
+from pymongo import ASCENDING
+from tornado import gen
+from tc_mongodb.mongodb import registry
+
+_lock = threading.Lock()
+_buckets = {}
+
+
+def forget_buckets():
+    global _lock
+
+    _lock = threading.Lock()
+    _buckets.clear()
+
+
+# Buckets wrap the clients the registry drops in forked children
+registry.on_fork(forget_buckets)
+
+
+def get_bucket(bucket_class, database, chunk_size=None, bucket_name='fs'):
+    '''Return the bucket of database shared by the process.
+    :param type bucket_class: ``gridfs.GridFSBucket`` or
+        ``motor.motor_tornado.MotorGridFSBucket``
+    :param database: Database holding GridFS, with its read preference
+    :param int chunk_size: Chunk size of new files, None for the default
+    :param string bucket_name: Prefix of the files and chunks collections
+    '''
+
+    registry.check_fork()
+    delegate = getattr(database, 'delegate', database)
+    key = (bucket_class, id(delegate.client), delegate.name,
+           repr(delegate.read_preference), chunk_size, bucket_name)
+
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            options = {}
+            if bucket_name != 'fs':
+                options['bucket_name'] = bucket_name
+            if chunk_size:
+                options['chunk_size_bytes'] = chunk_size
+            bucket = _buckets[key] = bucket_class(database, **options)
+        return bucket
+
+
+def read_stream(grid_out):
+    '''Read a whole pymongo GridOut chunk by chunk.
+    :rtype: bytes
+    '''
+
+    chunks = []
+    received = 0
+    while received < grid_out.length:
+        chunk = grid_out.readchunk()
+        if not chunk:
+            break
+        chunks.append(chunk)
+        received += len(chunk)
+    return b''.join(chunks)
+
+
+def read_files(database, file_ids, bucket_name='fs'):
+    '''Read whole GridFS files with one query on their lengths and one on
+    their chunks, instead of a download stream per file.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param list file_ids: Files to read
+    :param string bucket_name: Prefix of the files and chunks collections
+    :returns: Payloads by file id, without the files gone or incomplete
+    :rtype: dict
+    '''
+
+    lengths = dict(
+        (f['_id'], f['length']) for f in database[bucket_name + '.files'].find(
+            {'_id': {'$in': file_ids}}, {'length': True}
+        )
+    )
+    if not lengths:
+        return {}
+
+    chunks = {}
+    # Sorted on the unique files_id_1_n_1 index GridFS creates
+    cursor = database[bucket_name + '.chunks'].find(
+        {'files_id': {'$in': list(lengths)}},
+        {'files_id': True, 'data': True}
+    ).sort([('files_id', ASCENDING), ('n', ASCENDING)])
+    for chunk in cursor:
+        chunks.setdefault(chunk['files_id'], []).append(chunk['data'])
+
+    contents = {}
+    for file_id, length in lengths.items():
+        data = b''.join(chunks.get(file_id, ()))
+        if len(data) == length:
+            contents[file_id] = data
+    return contents
+
+
+@gen.coroutine
+def read_motor_stream(grid_out):
+    '''Read a whole MotorGridOut chunk by chunk.
+    :rtype: bytes
+    '''
+
+    chunks = []
+    received = 0
+    while received < grid_out.length:
+        chunk = yield grid_out.readchunk()
+        if not chunk:
+            break
+        chunks.append(chunk)
+        received += len(chunk)
+    raise gen.Return(b''.join(chunks))
@@ -0,0 +1,81 @@
+from motor.motor_tornado import MotorClient
+from pymongo.errors import OperationFailure, PyMongoError
+from tornado import gen
+from tornado.ioloop import IOLoop
+from thumbor.utils import logger
+from tc_mongodb.mongodb import connector_storage, registry
+
+
+class MongoConnector(connector_storage.MongoConnector):
+    '''Motor counterpart of
+    :class:`tc_mongodb.mongodb.connector_storage.MongoConnector`.
+
+    The index bootstrap is scheduled on the IOLoop instead of blocking the
+    constructor, and claimed again by the next connector when it fails.
+    '''
+    client_class = MotorClient
+
+    def bootstrap(self):
+        # Scheduled, the constructor never waits for MongoDB
+        self.ensure_index()
+
+    def ensure_index(self):
+        IOLoop.current().spawn_callback(self._ensure_index)
+
+    @gen.coroutine
+    def _ensure_index(self):
+        try:
+            indexes = yield self.coll_conn.index_information()
+        except PyMongoError as exc_value:
+            logger.error("[MONGODB_STORAGE] ensure_index: %s", exc_value)
+            # The next connector retries
+            registry.forget_bootstrap(self.bootstrap_key)
+            return
+
+        failed = False
+        for index_name, keys, options in self.index_specs():
+            if index_name in indexes:
+                continue
+            try:
+                yield self.coll_conn.create_index(
+                    keys, name=index_name, **options
+                )
+            except PyMongoError as exc_value:
+                # Like the blocking connector, only retry when MongoDB
+                # could not be reached, not when it refused the index
+                failed = failed or \
+                    not isinstance(exc_value, OperationFailure)
+                logger.error(
+                    "[MONGODB_STORAGE] can't create index %s: %s",
+                    index_name, exc_value
+                )
+
+        if failed:
+            registry.forget_bootstrap(self.bootstrap_key)
+
+        if self.sharded:
+            yield self._ensure_sharding()
+
+    @gen.coroutine
+    def _ensure_sharding(self):
+        client = self.db_conn.client
+        full_name = self.coll_conn.full_name
+        try:
+            sharded = yield client.config.collections.find_one(
+                {'_id': full_name, 'dropped': {'$ne': True}}
+            )
+            if sharded:
+                return
+            yield client.admin.command('enableSharding', self.db_name)
+        except OperationFailure:
+            # Already enabled
+            pass
+
+        try:
+            yield client.admin.command(
+                'shardCollection', full_name, key=self.shard_key()
+            )
+        except PyMongoError as exc_value:
+            logger.error(
+                "[MONGODB_STORAGE] can't shard %s: %s", full_name, exc_value
+            )
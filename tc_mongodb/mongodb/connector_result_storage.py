@@ -1,54 +1,150 @@
-from pymongo import ASCENDING, DESCENDING, MongoClient
-
-
-class Singleton(type):
-    """
-    Define an Instance operation that lets clients access its unique
-    instance.
-    """
-
-    def __init__(cls, name, bases, attrs, **kwargs):
-        super(Singleton, cls).__init__(name, bases, attrs)
-        cls._instance = None
-
-    def __call__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super(Singleton, cls).__call__(*args, **kwargs)
-        return cls._instance
+from pymongo import ASCENDING, HASHED, MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+from thumbor.utils import logger
+from tc_mongodb.mongodb import registry
+from tc_mongodb.mongodb.eviction import LAST_ACCESS_INDEX
 
 
 class MongoConnector(object):
-    __metaclass__ = Singleton
+    client_class = MongoClient
 
     def __init__(self,
                  uri=None,
                  host=None,
                  port=None,
                  db_name=None,
-                 coll_name=None):
+                 coll_name=None,
+                 hashed_keys=False,
+                 sharded=False,
+                 ensure_indexes=True,
+                 tracks_access=False,
+                 breaker=None,
+                 **client_options):
         self.uri = uri
         self.host = host
         self.port = port
         self.db_name = db_name
         self.coll_name = coll_name
+        self.hashed_keys = hashed_keys or sharded
+        self.sharded = sharded
+        self.tracks_access = tracks_access
+        self.client_options = client_options
+        self.breaker = breaker
         self.db_conn, self.coll_conn = self.create_connection()
-        self.ensure_index()
+
+        self.bootstrap_key = (type(self), self.uri, self.host, self.port,
+                              self.db_name, self.coll_name)
+        if ensure_indexes and registry.claim_bootstrap(self.bootstrap_key):
+            self.bootstrap()
+
+    def bootstrap(self):
+        '''Create the indexes through the circuit breaker of the storage.
+        Failures are logged and the next connector retries, so storages
+        built while MongoDB is down answer with misses instead of failing.
+        '''
+
+        if self.breaker is not None and not self.breaker.allow():
+            registry.forget_bootstrap(self.bootstrap_key)
+            return
+
+        try:
+            self.ensure_index()
+        except PyMongoError as exc_value:
+            registry.forget_bootstrap(self.bootstrap_key)
+            if self.breaker is not None:
+                self.breaker.failed(exc_value)
+            logger.error(
+                "[MONGODB_RESULT_STORAGE] can't ensure the indexes of %s: %s",
+                self.coll_conn.full_name, exc_value
+            )
+            return
+
+        if self.breaker is not None:
+            self.breaker.succeeded()
 
     def create_connection(self):
-        if self.uri:
-            connection = MongoClient(self.uri)
-        else:
-            connection = MongoClient(self.host, self.port)
+        connection = registry.get_client(
+            self.client_class,
+            uri=self.uri,
+            host=self.host,
+            port=self.port,
+            **self.client_options
+        )
 
         db_conn = connection[self.db_name]
         coll_conn = db_conn[self.coll_name]
 
         return db_conn, coll_conn
 
+    def index_specs(self):
+        '''Return the indexes the storage relies on.
+        :returns: (name, keys, options) tuples
+        :rtype: list
+        '''
+
+        if self.sharded:
+            # Hashed shard keys can't be unique
+            key_index = ('key_hash_hashed', [('key_hash', HASHED)], {})
+        elif self.hashed_keys:
+            key_index = ('key_hash_1', [('key_hash', ASCENDING)],
+                         {'unique': True})
+        else:
+            key_index = ('key_1', [('key', ASCENDING)], {'unique': True})
+
+        specs = [
+            key_index,
+            ('expires_at_1', [('expires_at', ASCENDING)],
+             {'expireAfterSeconds': 0}),
+            ('file_id_1', [('file_id', ASCENDING)], {'sparse': True}),
+        ]
+        if self.tracks_access:
+            # Not sparse, eviction walks every result in access order
+            specs.append(('last_access_1', LAST_ACCESS_INDEX, {}))
+        return specs
+
     def ensure_index(self):
-        index_name = 'key_1_created_at_-1'
-        if index_name not in self.coll_conn.index_information():
-            self.coll_conn.create_index(
-                [('key', ASCENDING), ('created_at', DESCENDING)],
-                name=index_name
+        indexes = self.coll_conn.index_information()
+        for index_name, keys, options in self.index_specs():
+            if index_name in indexes:
+                continue
+            try:
+                self.coll_conn.create_index(keys, name=index_name, **options)
+            except OperationFailure as exc_value:
+                # Collections written by older versions hold duplicated
+                # keys and can't get the unique index until cleaned up.
+                logger.error(
+                    "[MONGODB_RESULT_STORAGE] can't create index %s: %s",
+                    index_name, exc_value
+                )
+
+        if self.sharded:
+            self.ensure_sharding()
+
+    def shard_key(self):
+        return {'key_hash': 'hashed'}
+
+    def ensure_sharding(self):
+        '''Shard the collection on the hashed key digest, unless it
+        already is. Needs the enableSharding and shardCollection privileges.
+        '''
+
+        client = self.db_conn.client
+        full_name = self.coll_conn.full_name
+        try:
+            if client.config.collections.find_one(
+                    {'_id': full_name, 'dropped': {'$ne': True}}):
+                return
+            client.admin.command('enableSharding', self.db_name)
+        except OperationFailure:
+            # Already enabled
+            pass
+
+        try:
+            client.admin.command(
+                'shardCollection', full_name, key=self.shard_key()
+            )
+        except OperationFailure as exc_value:
+            logger.error(
+                "[MONGODB_RESULT_STORAGE] can't shard %s: %s",
+                full_name, exc_value
             )
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Least-recently-used eviction of results over a byte budget.
+
+Result documents carry a ``last_access`` date, set when they are stored and
+moved forward by reads. Reads only record an access when the stored one is
+older than a resolution, and the updates are applied in batches by a
+write-behind queue, so hot results cost one write per resolution instead of
+one per read.
+
+The total size of a collection is kept in :data:`SIZES_COLLECTION`. Puts
+count the bytes they add in memory, and each process adds its count there
+on every eviction run. The TTL index deletes results without counting them,
+so the total is summed again from the documents every recount interval,
+counting the ``content_length`` of distinct payloads, so a blob shared by
+several results (see :mod:`tc_mongodb.mongodb.blobs`) counts once.
+
+Once over the budget, the eviction job deletes the least recently used
+documents, walking the ``last_access`` index, and releases their GridFS
+files until the bytes actually freed bring the total back under
+:data:`LOW_WATER` of the budget. Deleting a result whose shared blob is
+still referenced frees nothing. A lease keeps concurrent processes from
+evicting the same collection.
+'''
+
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from thumbor.utils import logger
+from tc_mongodb.mongodb import blobs, registry
+from tc_mongodb.mongodb.maintenance import \
+    SWEEP_BATCH_SIZE, acquire_lease, batches
+
+# Evicting down to a fraction of the budget leaves room for new results
+# until the next run.
+LOW_WATER = 0.9
+LAST_ACCESS_INDEX = [('last_access', ASCENDING)]
+SIZES_COLLECTION = 'tc_mongodb_sizes'
+
+_lock = threading.Lock()
+_stored = {}
+
+
+def forget_stored():
+    global _lock
+
+    _lock = threading.Lock()
+    _stored.clear()
+
+
+# Counts of the parent are added by the parent
+registry.on_fork(forget_stored)
+
+
+def is_access_due(last_access, resolution, now=None):
+    '''Tell whether a read should record its access.
+    :param datetime.datetime last_access: Access stored in the document
+    :param int resolution: Seconds between recorded accesses
+    :rtype: bool
+    '''
+
+    if last_access is None:
+        return True
+    if now is None:
+        now = datetime.utcnow()
+    return last_access <= now - timedelta(seconds=resolution)
+
+
+def record_accesses(collection, accesses):
+    '''Move last_access forward, never backward, in one round-trip.
+    :param accesses: (query, date) tuples
+    '''
+
+    collection.bulk_write([
+        UpdateOne(query, {'$max': {'last_access': accessed_at}})
+        for query, accessed_at in accesses
+    ], ordered=False)
+
+
+def record_stored(collection, size):
+    '''Count size bytes written to collection, negative when removed. The
+    count is added to the total by the next eviction run of the process.
+    '''
+
+    collection = getattr(collection, 'delegate', collection)
+    with _lock:
+        _stored[collection.full_name] = \
+            _stored.get(collection.full_name, 0) + size
+
+
+def add_stored(database, collection, size=None):
+    '''Add size bytes, by default the ones counted by :func:`record_stored`,
+    to the total of collection.
+    '''
+
+    if size is None:
+        with _lock:
+            size = _stored.pop(collection.full_name, 0)
+    if not size:
+        return
+    try:
+        database[SIZES_COLLECTION].update_one(
+            {'_id': collection.full_name}, {'$inc': {'size': size}}
+        )
+    except PyMongoError:
+        # Keep the count for the next run
+        record_stored(collection, size)
+        raise
+
+
+def stored_bytes(collection):
+    '''Return the size of the payloads of collection, counting shared
+    GridFS files once. Every document is read, see :func:`tracked_bytes`.
+    :rtype: int
+    '''
+
+    totals = list(collection.aggregate([
+        # Inline payloads are grouped by their own document
+        {'$group': {
+            '_id': {'$ifNull': ['$file_id', '$_id']},
+            'size': {'$first': '$content_length'},
+        }},
+        {'$group': {'_id': None, 'size': {'$sum': '$size'}}},
+    ], allowDiskUse=True))
+    return totals[0]['size'] if totals else 0
+
+
+def tracked_bytes(database, collection, recount_interval):
+    '''Return the total size of the payloads of collection, summing it
+    again with :func:`stored_bytes` when it was summed more than
+    recount_interval seconds ago.
+    :param int recount_interval: Seconds between sums of the documents
+    :rtype: int
+    '''
+
+    sizes = database[SIZES_COLLECTION]
+    now = datetime.utcnow()
+    tracked = sizes.find_one({'_id': collection.full_name})
+    if tracked is not None and \
+            tracked['counted_at'] > now - timedelta(seconds=recount_interval):
+        return tracked['size']
+
+    size = stored_bytes(collection)
+    sizes.replace_one(
+        {'_id': collection.full_name},
+        {'size': size, 'counted_at': now},
+        upsert=True
+    )
+    return size
+
+
+def evict(database,
+          collection,
+          max_size,
+          batch_size=SWEEP_BATCH_SIZE,
+          total=None):
+    '''Delete the least recently used results of collection until they fit
+    in max_size bytes. Documents are deleted one at a time, so one read or
+    stored again meanwhile is kept along with its file.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param pymongo.collection.Collection collection: Result collection
+    :param int max_size: Budget in bytes
+    :param int batch_size: Documents fetched per round-trip
+    :param int total: Size of the payloads, summed from the documents when
+        None
+    :returns: Number of documents removed and payload bytes freed
+    :rtype: tuple
+    '''
+
+    if total is None:
+        total = stored_bytes(collection)
+    if total <= max_size:
+        return 0, 0
+
+    excess = total - int(max_size * LOW_WATER)
+    removed = freed = 0
+    # Documents stored without last_access sort first. The hint fails
+    # rather than sort the whole collection in memory without the index.
+    cursor = collection.find(
+        {}, {'last_access': True}, batch_size=batch_size
+    ).sort('last_access', ASCENDING).hint(LAST_ACCESS_INDEX)
+    for batch in batches(cursor, batch_size):
+        for doc in batch:
+            if freed >= excess:
+                return removed, freed
+            stored = collection.find_one_and_delete(
+                {'_id': doc['_id'], 'last_access': doc.get('last_access')},
+                projection={
+                    'file_id': True, 'bucket': True, 'content_length': True
+                }
+            )
+            if stored is None:
+                continue
+            removed += 1
+            if stored.get('file_id') is None or blobs.release(
+                    database, stored['file_id'], stored.get('bucket', 'fs')):
+                freed += stored.get('content_length') or 0
+    return removed, freed
+
+
+def evict_safely(database, collection, max_size, interval, recount_interval):
+    try:
+        add_stored(database, collection)
+        if not acquire_lease(
+                database, 'evict:' + collection.full_name, interval):
+            return
+        removed, freed = evict(
+            database, collection, max_size,
+            total=tracked_bytes(database, collection, recount_interval)
+        )
+        add_stored(database, collection, -freed)
+        logger.debug(
+            "[MONGODB] evicted %d results, %d bytes, from %s",
+            removed, freed, collection.full_name
+        )
+    except PyMongoError as exc_value:
+        logger.error("[MONGODB] eviction failed: %s", exc_value)
+
+
+def schedule_eviction(database,
+                      collection,
+                      max_size,
+                      interval,
+                      recount_interval):
+    '''Run :func:`evict` every interval seconds on a worker thread, once
+    per process for a collection. Motor objects are unwrapped to their
+    pymongo delegate.
+    :param int max_size: Budget in bytes
+    :param int interval: Seconds between runs
+    :param int recount_interval: Seconds between sums of the documents
+    '''
+
+    database = getattr(database, 'delegate', database)
+    collection = getattr(collection, 'delegate', collection)
+
+    key = ('eviction', id(database.client), collection.full_name)
+    if not registry.claim_bootstrap(key):
+        return
+
+    def run():
+        IOLoop.current().run_in_executor(
+            None, evict_safely, database, collection, max_size, interval,
+            recount_interval
+        )
+
+    PeriodicCallback(run, interval * 1000).start()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Fixed-size digests standing in for image paths and result keys in the
+indexes, and as hashed shard key.'''
+
+import hashlib
+
+from bson.binary import Binary
+
+
+def digest(value):
+    '''Return the indexed digest of a path or key.
+    :param string value: Image path or result key
+    :rtype: bson.binary.Binary
+    '''
+
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return Binary(hashlib.sha1(value).digest())
+
+
+def lookup(field, value, hashed):
+    '''Return the query of the document stored for value. The original
+    string is kept in the query so a digest collision reads as a miss.
+    :param string field: ``path`` or ``key``
+    :param bool hashed: Whether documents are indexed by digest
+    :rtype: dict
+    '''
+
+    if not hashed:
+        return {field: value}
+    return {field + '_hash': digest(value), field: value}
+
+
+def lookup_many(field, values, hashed):
+    '''Return the query of the documents stored for values, on the indexed
+    field. Digest collisions match documents of other values, callers pick
+    documents by their original string.
+    :param string field: ``path`` or ``key``
+    :param list values: Image paths or result keys
+    :param bool hashed: Whether documents are indexed by digest
+    :rtype: dict
+    '''
+
+    if not hashed:
+        return {field: {'$in': values}}
+    return {field + '_hash': {'$in': [digest(value) for value in values]}}
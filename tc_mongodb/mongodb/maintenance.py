@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Reclamation of GridFS data left behind by expired documents.
+
+The TTL index removes expired image and result documents, but not the
+GridFS files they point at. The sweep deletes files no document references
+anymore. Shared files are checked against every collection listed in their
+``collections`` field, and skipped while they were referenced again less
+than the grace period ago.
+
+The periodic sweep is opt-in. Each run walks the next files by upload date,
+resuming where the previous run stopped, and a lease keeps the processes of
+a deployment from sweeping the same collection at once.
+
+The ``tc-mongodb`` command runs the same jobs offline, see
+:mod:`tc_mongodb.cli`. It also deletes chunks whose file is gone.
+'''
+
+import time
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from thumbor.utils import logger
+from tc_mongodb.mongodb import blobs, registry
+
+# put writes the GridFS file before the document referencing it, younger
+# files may still be waiting for their document.
+ORPHAN_GRACE_SECONDS = 600
+SWEEP_BATCH_SIZE = 500
+# Files checked by each run of the periodic sweep
+SWEEP_MAX_FILES = 10 * SWEEP_BATCH_SIZE
+LEASES_COLLECTION = 'tc_mongodb_leases'
+UPLOAD_DATE_INDEX = [('uploadDate', ASCENDING)]
+# Created by GridFS buckets
+CHUNKS_INDEX = [('files_id', ASCENDING), ('n', ASCENDING)]
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def acquire_lease(database, name, seconds):
+    '''Take the lease name for seconds, unless another process holds it.
+    :returns: The lease document, None if held
+    :rtype: dict
+    '''
+
+    now = datetime.utcnow()
+    try:
+        return database[LEASES_COLLECTION].find_one_and_update(
+            {'_id': name, 'until': {'$lte': now}},
+            {'$set': {'until': now + timedelta(seconds=seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Held, the upsert collided with the existing lease
+        return None
+
+
+def owned_files(fields, collection):
+    '''Return the filter matching the GridFS files written for documents
+    holding one of fields, or shared through collection. Storages sharing a
+    database also share its GridFS bucket.
+    :param fields: Document fields copied onto the files, e.g. ``path``
+    :param pymongo.collection.Collection collection: Metadata collection
+    :rtype: dict
+    '''
+
+    clauses = [{'collections': collection.name}]
+    for field in fields:
+        clauses.append({field: {'$exists': True}})
+        clauses.append({'metadata.' + field: {'$exists': True}})
+    return {'$or': clauses}
+
+
+def sweep_orphaned_files(database,
+                         collection,
+                         file_filter,
+                         batch_size=SWEEP_BATCH_SIZE,
+                         grace=ORPHAN_GRACE_SECONDS,
+                         pause=0,
+                         dry_run=False,
+                         since=None,
+                         max_files=None):
+    '''Delete the GridFS files of collection no document references
+    anymore, walking them by upload date. Storages sharing a database share
+    its bucket, so the files are restricted to the ones the storage owns,
+    see :func:`owned_files`. References are looked up on the file_id index
+    of the documents.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param pymongo.collection.Collection collection: Metadata collection
+    :param dict file_filter: Files owned by the storage of collection
+    :param int batch_size: Files checked per round-trip
+    :param int grace: Skip files uploaded less than grace seconds ago
+    :param float pause: Seconds slept after each batch
+    :param bool dry_run: Only count what would be removed
+    :param datetime.datetime since: Only check files uploaded after it
+    :param int max_files: Files checked before stopping, None checks all
+    :returns: Number of files removed, and the upload date to resume from,
+        None once every file was checked
+    :rtype: tuple
+    '''
+
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    files = database.fs.files
+    chunks = database.fs.chunks
+    if not dry_run:
+        files.create_index(UPLOAD_DATE_INDEX)
+
+    uploaded = {'$lt': cutoff}
+    if since is not None:
+        uploaded['$gt'] = since
+    # Shared blobs reused recently may not have their new document yet
+    query = dict(
+        file_filter,
+        uploadDate=uploaded,
+        last_referenced={'$not': {'$gte': cutoff}}
+    )
+
+    removed_files = checked = 0
+    last_upload = None
+    cursor = files.find(
+        query,
+        {'_id': True, 'collections': True, 'uploadDate': True},
+        batch_size=batch_size
+    ).sort('uploadDate', ASCENDING)
+    if max_files:
+        cursor = cursor.limit(max_files)
+    for batch in batches(cursor, batch_size):
+        checked += len(batch)
+        last_upload = batch[-1]['uploadDate']
+        file_ids = [f['_id'] for f in batch]
+        holders = set([collection.name])
+        for f in batch:
+            holders.update(f.get('collections', ()))
+
+        referenced = set()
+        for name in holders:
+            holder = collection if name == collection.name else database[name]
+            referenced.update(doc['file_id'] for doc in holder.find(
+                {'file_id': {'$in': file_ids}}, {'file_id': True}
+            ))
+        orphans = [f for f in file_ids if f not in referenced]
+        if orphans and not dry_run:
+            # Only delete the files that were not reused meanwhile. Marked
+            # files can't be reused anymore, see tc_mongodb.mongodb.blobs.
+            files.update_many({
+                '_id': {'$in': orphans},
+                'last_referenced': query['last_referenced'],
+            }, {'$set': {'deleting': datetime.utcnow()}})
+            orphans = [f['_id'] for f in files.find({
+                '_id': {'$in': orphans}, 'deleting': {'$exists': True}
+            }, {'_id': True})]
+            blobs.delete_marked(database, orphans)
+        removed_files += len(orphans)
+        if pause:
+            time.sleep(pause)
+
+    if not max_files or checked < max_files:
+        # Every file up to the cutoff was checked, start over next time
+        last_upload = None
+    return removed_files, last_upload
+
+
+def sweep_orphaned_chunks(database,
+                          batch_size=SWEEP_BATCH_SIZE,
+                          grace=ORPHAN_GRACE_SECONDS,
+                          pause=0,
+                          dry_run=False):
+    '''Delete the chunks whose GridFS file does not exist, left by uploads
+    interrupted before writing their file. The files are listed from the
+    chunks index without reading the payloads, but the whole index is
+    walked, so only the ``tc-mongodb`` command runs it.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param int batch_size: Files checked per round-trip
+    :param int grace: Skip chunks written less than grace seconds ago
+    :param float pause: Seconds slept after each batch
+    :param bool dry_run: Only count what would be removed
+    :returns: Number of chunk sets removed
+    :rtype: int
+    '''
+
+    cutoff = ObjectId.from_datetime(
+        datetime.utcnow() - timedelta(seconds=grace)
+    )
+    files = database.fs.files
+    chunks = database.fs.chunks
+
+    removed = 0
+    cursor = chunks.find(
+        {'n': 0}, {'files_id': True, '_id': False}, batch_size=batch_size
+    ).hint(CHUNKS_INDEX)
+    for batch in batches((c['files_id'] for c in cursor), batch_size):
+        existing = set(f['_id'] for f in files.find(
+            {'_id': {'$in': batch}}, {'_id': True}
+        ))
+        missing = [file_id for file_id in batch if file_id not in existing]
+        if missing and not dry_run:
+            # Uploads in progress write their file after the chunks
+            chunks.delete_many({
+                'files_id': {'$in': missing}, '_id': {'$lt': cutoff}
+            })
+        removed += len(missing)
+        if pause:
+            time.sleep(pause)
+    return removed
+
+
+def expired_documents(max_age=None):
+    '''Return the filter matching expired documents. Documents written
+    before expires_at was stored expire max_age seconds after created_at.
+    :param int max_age: Expiration of the storage, None or 0 if documents
+        without expires_at never expire
+    :rtype: dict
+    '''
+
+    now = datetime.utcnow()
+    clauses = [{'expires_at': {'$lte': now}}]
+    if max_age and max_age > 0:
+        clauses.append({
+            'expires_at': {'$exists': False},
+            'created_at': {'$lte': now - timedelta(seconds=max_age)},
+        })
+    return {'$or': clauses}
+
+
+def purge_expired(database,
+                  collection,
+                  max_age=None,
+                  batch_size=SWEEP_BATCH_SIZE,
+                  pause=0,
+                  dry_run=False):
+    '''Delete the expired documents of collection and release their GridFS
+    files, ahead of the TTL monitor. Documents are deleted one at a time,
+    so one stored again meanwhile is kept along with its file.
+    :param pymongo.database.Database database: Database holding GridFS
+    :param pymongo.collection.Collection collection: Metadata collection
+    :param int max_age: Expiration of documents without expires_at
+    :param int batch_size: Documents deleted between pauses
+    :param float pause: Seconds slept after each batch
+    :param bool dry_run: Only count what would be removed
+    :returns: Number of documents removed
+    :rtype: int
+    '''
+
+    query = expired_documents(max_age)
+    if dry_run:
+        return collection.count_documents(query)
+
+    removed = 0
+    while True:
+        batch = list(collection.find(query, {'_id': True}).limit(batch_size))
+        for doc in batch:
+            query['_id'] = doc['_id']
+            stored = collection.find_one_and_delete(
+                query, projection={'file_id': True}
+            )
+            del query['_id']
+            if stored is None:
+                continue
+            removed += 1
+            if stored.get('file_id') is not None:
+                blobs.release(database, stored['file_id'])
+        if len(batch) < batch_size:
+            return removed
+        if pause:
+            time.sleep(pause)
+
+
+def index_problems(collection, specs):
+    '''Compare the indexes of collection with the ones a storage expects.
+    :param specs: (name, keys, options) tuples, see
+        ``MongoConnector.index_specs``
+    :returns: (name, problem) tuples, problem is ``missing`` or
+        ``mismatch``
+    :rtype: list
+    '''
+
+    existing = collection.index_information()
+    problems = []
+    for name, keys, options in specs:
+        index = existing.get(name)
+        if index is None:
+            problems.append((name, 'missing'))
+            continue
+        same_keys = [tuple(key) for key in index['key']] == \
+            [tuple(key) for key in keys]
+        same_options = all(
+            index.get(option) == value for option, value in options.items()
+        )
+        if not same_keys or not same_options:
+            problems.append((name, 'mismatch'))
+    return problems
+
+
+def sweep_safely(database, collection, file_filter, interval):
+    '''Check the next SWEEP_MAX_FILES files of collection, unless another
+    process holds the sweep lease. The lease keeps where the run stopped.
+    '''
+
+    name = 'sweep:' + collection.full_name
+    try:
+        lease = acquire_lease(database, name, interval)
+        if lease is None:
+            return
+        removed, position = sweep_orphaned_files(
+            database, collection, file_filter,
+            since=lease.get('position'),
+            max_files=SWEEP_MAX_FILES
+        )
+        database[LEASES_COLLECTION].update_one(
+            {'_id': name}, {'$set': {'position': position}}
+        )
+        logger.debug(
+            "[MONGODB] swept %d orphaned files from %s",
+            removed, collection.full_name
+        )
+    except PyMongoError as exc_value:
+        logger.error("[MONGODB] orphan sweep failed: %s", exc_value)
+
+
+def schedule_sweep(database, collection, interval, file_filter):
+    '''Run :func:`sweep_safely` every interval seconds on a worker thread,
+    once per process for a collection. Motor objects are unwrapped to their
+    pymongo delegate.
+    :param int interval: Seconds between sweeps, 0 disables the sweep
+    :param dict file_filter: Files owned by the storage of collection
+    '''
+
+    if not interval:
+        return
+
+    database = getattr(database, 'delegate', database)
+    collection = getattr(collection, 'delegate', collection)
+
+    key = ('sweep', id(database.client), collection.full_name)
+    if not registry.claim_bootstrap(key):
+        return
+
+    def run():
+        IOLoop.current().run_in_executor(
+            None, sweep_safely, database, collection, file_filter, interval
+        )
+
+    PeriodicCallback(run, interval * 1000).start()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''pymongo event listeners reporting round-trips and connection pool waits
+through thumbor's metrics client.
+
+Listeners are registered globally and only apply to the clients created
+afterwards, so :func:`install` runs before the storages open their client.
+'''
+
+import threading
+from timeit import default_timer
+
+from pymongo import monitoring
+
+_lock = threading.Lock()
+_installed = False
+
+
+class CommandMetrics(monitoring.CommandListener):
+    '''Time every command sent to MongoDB, ``mongodb.command.<name>``.'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.timing(
+            'mongodb.command.%s' % event.command_name,
+            event.duration_micros / 1000.0
+        )
+
+    def failed(self, event):
+        self.metrics.incr('mongodb.command.%s.failed' % event.command_name)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    '''Time how long operations wait for a pooled connection,
+    ``mongodb.pool.wait``, and count connections opened and closed.
+
+    A thread checks out one connection at a time, so the wait is measured
+    per thread.
+    '''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.checkouts = threading.local()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.metrics.incr('mongodb.pool.cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.metrics.incr('mongodb.pool.created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.metrics.incr('mongodb.pool.closed')
+
+    def connection_check_out_started(self, event):
+        self.checkouts.started = default_timer()
+
+    def connection_check_out_failed(self, event):
+        self.checkouts.started = None
+        self.metrics.incr('mongodb.pool.check_out_failed.%s' % event.reason)
+
+    def connection_checked_out(self, event):
+        started = getattr(self.checkouts, 'started', None)
+        if started is not None:
+            self.checkouts.started = None
+            self.metrics.timing(
+                'mongodb.pool.wait', (default_timer() - started) * 1000
+            )
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def install(metrics):
+    '''Register the listeners once per process.
+    :param metrics: thumbor metrics client, ``context.metrics``
+    '''
+
+    global _installed
+
+    with _lock:
+        if _installed:
+            return
+        monitoring.register(CommandMetrics(metrics))
+        monitoring.register(PoolMetrics(metrics))
+        _installed = True
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Time-partitioned collections, expired by dropping whole periods.
+
+Each period of ``length`` seconds gets its own collection, named after the
+storage collection and the UTC start of the period, e.g.
+``images_20261017000000``, and a GridFS bucket of the same name. Documents
+are written to the current period and read from the periods that may still
+hold live documents, newest first. A period is dropped once its newest
+document has expired, which costs a few ``drop`` commands instead of
+deleting every document, file and chunk.
+
+A miss looks the key up in every live period, so periods may not be shorter
+than the expiration allows for :data:`MAX_PARTITIONS` of them.
+'''
+
+import calendar
+import math
+import re
+import time
+from datetime import datetime
+
+from pymongo.errors import OperationFailure, PyMongoError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from thumbor.utils import logger
+from tc_mongodb.mongodb import registry
+
+NAME_FORMAT = '%Y%m%d%H%M%S'
+MAX_DROP_INTERVAL = 3600
+# Live periods, each one is a round-trip for misses
+MAX_PARTITIONS = 8
+
+
+def partition_count(length, max_age):
+    '''Return the number of periods that may hold live documents.
+    :rtype: int
+    '''
+
+    return int(math.ceil(float(max_age) / length)) + 1
+
+
+def check_partitioning(prefix, length, max_age):
+    '''Validate the period length of a storage.
+    :param string prefix: Setting prefix, e.g. ``MONGO_STORAGE``
+    :returns: (length, max_age) in seconds
+    :rtype: tuple
+    :raises ValueError: When the expiration spans more than MAX_PARTITIONS
+        periods
+    '''
+
+    if length <= 0 or partition_count(length, max_age) > MAX_PARTITIONS:
+        raise ValueError(
+            "%s_PARTITION_SECONDS %r is too short, periods of at least %d "
+            "seconds keep %d live partitions at most" % (
+                prefix, length,
+                int(math.ceil(float(max_age) / (MAX_PARTITIONS - 1))),
+                MAX_PARTITIONS
+            )
+        )
+    return length, max_age
+
+
+def period_start(length, timestamp=None):
+    '''Return the start of the period holding timestamp, now by default.
+    :rtype: int
+    '''
+
+    if timestamp is None:
+        timestamp = time.time()
+    return int(timestamp // length * length)
+
+
+def partition_name(collection_name, start):
+    return '%s_%s' % (
+        collection_name,
+        datetime.utcfromtimestamp(start).strftime(NAME_FORMAT)
+    )
+
+
+def partition_start(collection_name, name):
+    '''Return the start of the period of a partition, None if name is not
+    a partition of collection_name.
+    :rtype: int
+    '''
+
+    match = re.match(r'^%s_(\d{14})$' % re.escape(collection_name), name)
+    if match is None:
+        return None
+    started = datetime.strptime(match.group(1), NAME_FORMAT)
+    return calendar.timegm(started.utctimetuple())
+
+
+def live_partitions(collection_name, length, max_age, timestamp=None):
+    '''Return the partitions that may hold documents stored less than
+    max_age seconds ago, newest first.
+    :rtype: list
+    '''
+
+    if timestamp is None:
+        timestamp = time.time()
+
+    names = []
+    start = period_start(length, timestamp)
+    while start + length > timestamp - max_age:
+        names.append(partition_name(collection_name, start))
+        start -= length
+    return names
+
+
+def is_expired(start, length, max_age, timestamp=None):
+    '''Tell whether every document of the period starting at start has
+    expired.
+    '''
+
+    if timestamp is None:
+        timestamp = time.time()
+    return start + length + max_age <= timestamp
+
+
+def indexes_key(collection):
+    return ('partition', id(collection.database.client), collection.full_name)
+
+
+def claim_indexes(collection):
+    '''Tell whether the caller creates the indexes of a partition, see
+    :func:`create_indexes`. Only the first caller of the process does.
+    :rtype: bool
+    '''
+
+    return registry.claim_bootstrap(indexes_key(collection))
+
+
+def create_indexes(collection, specs):
+    '''Create the indexes of a partition claimed with
+    :func:`claim_indexes`, letting the next caller retry on failure.
+    Partitions expire by being dropped, so the TTL index is left out.
+    :param pymongo.collection.Collection collection: The partition
+    :param specs: (name, keys, options) tuples, see
+        ``MongoConnector.index_specs``
+    '''
+
+    for index_name, keys, options in specs:
+        if 'expireAfterSeconds' in options:
+            continue
+        try:
+            collection.create_index(keys, name=index_name, **options)
+        except OperationFailure as exc_value:
+            logger.error(
+                "[MONGODB] can't create index %s on %s: %s",
+                index_name, collection.full_name, exc_value
+            )
+            registry.forget_bootstrap(indexes_key(collection))
+            return
+
+
+def ensure_indexes(collection, specs):
+    '''Create the indexes of a partition, once per process.
+    :param pymongo.collection.Collection collection: The partition
+    :param specs: (name, keys, options) tuples, see
+        ``MongoConnector.index_specs``
+    '''
+
+    if claim_indexes(collection):
+        create_indexes(collection, specs)
+
+
+def expired_partitions(database, collection_name, length, max_age):
+    '''Return the partitions of collection_name whose documents have all
+    expired.
+    :rtype: list
+    '''
+
+    expired = []
+    for name in database.list_collection_names():
+        start = partition_start(collection_name, name)
+        if start is not None and is_expired(start, length, max_age):
+            expired.append(name)
+    return expired
+
+
+def drop_expired(database, collection_name, length, max_age):
+    '''Drop the expired partitions of collection_name and their GridFS
+    buckets.
+    :returns: Names of the dropped partitions
+    :rtype: list
+    '''
+
+    dropped = expired_partitions(database, collection_name, length, max_age)
+    for name in dropped:
+        database.drop_collection(name + '.files')
+        database.drop_collection(name + '.chunks')
+        database.drop_collection(name)
+    return dropped
+
+
+def drop_safely(database, collection_name, length, max_age):
+    try:
+        dropped = drop_expired(database, collection_name, length, max_age)
+        logger.debug(
+            "[MONGODB] dropped %d expired partitions of %s",
+            len(dropped), collection_name
+        )
+    except PyMongoError as exc_value:
+        logger.error("[MONGODB] partition drop failed: %s", exc_value)
+
+
+def schedule_drops(database, collection_name, length, max_age):
+    '''Run :func:`drop_expired` on a worker thread, once per process for a
+    collection, as often as periods end but at least hourly. Motor objects
+    are unwrapped to their pymongo delegate.
+    '''
+
+    database = getattr(database, 'delegate', database)
+
+    key = ('partition-drops', id(database.client), database.name,
+           collection_name)
+    if not registry.claim_bootstrap(key):
+        return
+
+    def run():
+        IOLoop.current().run_in_executor(
+            None, drop_safely, database, collection_name, length, max_age
+        )
+
+    interval = min(length, MAX_DROP_INTERVAL)
+    PeriodicCallback(run, interval * 1000).start()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+'''Process-wide registry of MongoDB clients.
+
+Clients own a connection pool and are safe to share, so every connector
+pointing at the same server with the same options reuses one client
+instead of opening a new pool per request.
+
+Clients are not fork-safe: their sockets and monitor threads belong to the
+process that created them. The registry notices when it runs in a forked
+child and starts over with new clients, see :func:`check_fork`.
+'''
+
+import multiprocessing
+import os
+import threading
+
+from pymongo.read_preferences import (
+    Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+)
+from thumbor.utils import logger
+
+# thumbor setting suffix -> MongoClient keyword argument
+CLIENT_OPTIONS = (
+    ('MAX_POOL_SIZE', 'maxPoolSize'),
+    ('MIN_POOL_SIZE', 'minPoolSize'),
+    ('WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+    ('MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+    ('CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+    ('SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+)
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+_lock = threading.Lock()
+_clients = {}
+_bootstrapped = set()
+_pid = os.getpid()
+_fork_callbacks = []
+
+
+def worker_processes(context):
+    '''Return the number of thumbor processes sharing the MongoDB
+    servers on this host, from ``--processes``.
+    :param thumbor.context.Context context: Current context
+    :rtype: int
+    '''
+
+    processes = getattr(context.server, 'processes', 1)
+    if processes is None or processes < 0:
+        return 1
+    if processes == 0:
+        # tornado forks one process per core
+        return multiprocessing.cpu_count()
+    return processes
+
+
+def client_options(config, prefix, processes=1):
+    '''Read the client pool settings for a storage from thumbor config.
+
+    ``<prefix>_MAX_CONNECTIONS`` is a budget for all the processes of the
+    host: each process gets an equal share as its pool size, unless
+    ``<prefix>_MAX_POOL_SIZE`` is smaller.
+
+    :param thumbor.config.Config config: Current thumbor config
+    :param string prefix: Setting prefix, e.g. ``MONGO_STORAGE``
+    :param int processes: Processes sharing the connection budget
+    :returns: Keyword arguments for the client, unset options are omitted
+    :rtype: dict
+    '''
+
+    options = {}
+    for suffix, option in CLIENT_OPTIONS:
+        value = config.get('%s_%s' % (prefix, suffix), None)
+        if value is not None:
+            options[option] = value
+
+    budget = config.get('%s_MAX_CONNECTIONS' % prefix, None)
+    if budget:
+        share = max(1, budget // max(1, processes))
+        options['maxPoolSize'] = min(
+            share, options.get('maxPoolSize') or share
+        )
+        if options.get('minPoolSize', 0) > options['maxPoolSize']:
+            options['minPoolSize'] = options['maxPoolSize']
+    return options
+
+
+def read_preference(config, prefix):
+    '''Read the read preference of a storage from thumbor config.
+    :param thumbor.config.Config config: Current thumbor config
+    :param string prefix: Setting prefix, e.g. ``MONGO_STORAGE``
+    :returns: The read preference, None to read from the primary
+    :rtype: pymongo.read_preferences.ServerMode
+    '''
+
+    mode = config.get('%s_READ_PREFERENCE' % prefix, None)
+    if not mode or mode == 'primary':
+        return None
+
+    if mode not in READ_PREFERENCES:
+        raise ValueError("Unknown %s_READ_PREFERENCE %r" % (prefix, mode))
+
+    options = {
+        'tag_sets': config.get('%s_READ_PREFERENCE_TAGS' % prefix, None),
+        'max_staleness':
+            config.get('%s_MAX_STALENESS_SECONDS' % prefix, -1),
+    }
+    if config.get('%s_HEDGED_READS' % prefix, False):
+        options['hedge'] = {'enabled': True}
+
+    try:
+        return READ_PREFERENCES[mode](**options)
+    except TypeError:
+        if 'hedge' not in options:
+            # Invalid tag sets or staleness
+            raise
+        # Hedged reads need pymongo 3.11 and MongoDB 4.4
+        logger.warning(
+            "[MONGODB] %s_HEDGED_READS is not supported by this pymongo",
+            prefix
+        )
+        options.pop('hedge')
+        return READ_PREFERENCES[mode](**options)
+
+
+def on_fork(callback):
+    '''Call callback in forked children, before they create their first
+    client. Other process-wide state built on clients resets itself there.
+    '''
+
+    _fork_callbacks.append(callback)
+
+
+def check_fork():
+    '''Forget the clients and one-off setups inherited from the parent
+    process when running in a forked child. The inherited clients are
+    dropped rather than closed, closing them would end the sessions of the
+    parent.
+    '''
+
+    global _lock, _pid
+
+    pid = os.getpid()
+    if pid == _pid:
+        return
+
+    # The parent may have forked while another thread held the lock
+    _lock = threading.Lock()
+    _pid = pid
+    _clients.clear()
+    _bootstrapped.clear()
+    logger.debug("[MONGODB] forked as %d, dropping inherited clients", pid)
+    for callback in _fork_callbacks:
+        callback()
+
+
+def get_client(client_class, uri=None, host=None, port=None, **options):
+    '''Return the shared client for the given server and options,
+    creating it on first use.
+    :param type client_class: ``MongoClient`` or ``MotorClient``
+    :returns: The process-wide client
+    '''
+
+    check_fork()
+    key = (
+        client_class, uri or None, host, port,
+        tuple(sorted(options.items()))
+    )
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if uri:
+                client = client_class(uri, **options)
+            else:
+                client = client_class(host, port, **options)
+            _clients[key] = client
+
+    return client
+
+
+def claim_bootstrap(key):
+    '''Tell whether the caller runs the one-off setup identified by key.
+    The check and the claim are atomic, so concurrent callers of the process
+    don't both run it.
+    :rtype: bool
+    '''
+
+    check_fork()
+    with _lock:
+        if key in _bootstrapped:
+            return False
+        _bootstrapped.add(key)
+        return True
+
+
+def forget_bootstrap(key):
+    '''Let the one-off setup identified by key run again, after it
+    failed.
+    '''
+
+    with _lock:
+        _bootstrapped.discard(key)
@@ -3,30 +3,127 @@
 # http://www.opensource.org/licenses/mit-license
 # Copyright (c) 2015 Thumbor-Community
 
+import functools
+import hashlib
 import time
 from datetime import datetime, timedelta
 import pytz
 
 import gridfs
-from pymongo.errors import PyMongoError
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from tornado.concurrent import return_future
 from thumbor.engines import BaseEngine
 from thumbor.result_storages import BaseStorage, ResultStorageResult
 from thumbor.utils import logger
-from tc_mongodb.utils import OnException
+from tc_mongodb.disk_cache import DiskCache
+from tc_mongodb.lru_cache import LRUCache
+from tc_mongodb.write_behind import DROP, WriteBehindQueue
+from tc_mongodb.utils import (
+    CircuitBreaker, CircuitOpenError, OnException, guarded, timed
+)
+from tc_mongodb.mongodb.registry import (
+    client_options, on_fork, read_preference, worker_processes
+)
 from tc_mongodb.mongodb.connector_result_storage import MongoConnector
+from tc_mongodb.mongodb import blobs, eviction, keys, periods
+from tc_mongodb.mongodb.buckets import get_bucket, read_stream
+from tc_mongodb.mongodb.maintenance import owned_files, schedule_sweep
+from tc_mongodb.mongodb.monitoring import install as install_monitoring
+
+# Results that fit in a single GridFS chunk are kept in the result document
+DEFAULT_INLINE_MAX_SIZE = 255 * 1024
+DEFAULT_ORPHAN_SWEEP_INTERVAL = 0
+DEFAULT_MISS_CACHE_TTL = 5
+DEFAULT_DISK_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 10
+DEFAULT_ACCESS_RESOLUTION = 600
+DEFAULT_EVICTION_INTERVAL = 60
+DEFAULT_EVICTION_RECOUNT_INTERVAL = 3600
+DEFAULT_REFRESH_TIMEOUT = 30
+
+
+def compute_etag(contents):
+    '''Return the ETag tornado sends for a response made of contents.'''
+
+    return '"%s"' % hashlib.sha1(contents).hexdigest()
 
 
 class Storage(BaseStorage):
 
+    '''breaker stops calling MongoDB while it fails, see get_breaker.
+    '''
+    breaker = None
+
+    '''metrics_prefix names the metrics sent to context.metrics.
+    '''
+    metrics_prefix = 'mongodb_result_storage'
+
     '''start_time is used to calculate the last modified value when an item
     has no expiration date.
     '''
     start_time = None
 
+    '''memory_cache holds the hottest results of the process, see
+    get_memory_cache.
+    '''
+    memory_cache = None
+
+    '''bucket_class reads and writes GridFS files, see get_bucket.
+    '''
+    bucket_class = gridfs.GridFSBucket
+
+    '''miss_cache remembers the keys recently found missing in the
+    process, see get_miss_cache.
+    '''
+    miss_cache = None
+
+    '''disk_cache keeps GridFS results on the local disk, see
+    get_disk_cache.
+    '''
+    disk_cache = None
+
+    '''access_queue applies the accesses recorded by reads in batches, see
+    get_access_queue.
+    '''
+    access_queue = None
+
     def __init__(self, context):
         BaseStorage.__init__(self, context)
+        if self.context.config.get('MONGO_COMMAND_MONITORING', False):
+            install_monitoring(self.context.metrics)
         self.database, self.storage = self.__conn__()
+        self.read_database, self.reader = self.read_connection()
+        self.request_key = None
+        self.documents = {}
+        schedule_sweep(
+            self.database,
+            self.storage,
+            self.context.config.get(
+                'MONGO_RESULT_STORAGE_ORPHAN_SWEEP_INTERVAL',
+                DEFAULT_ORPHAN_SWEEP_INTERVAL
+            ),
+            owned_files(['key'], self.storage)
+        )
+        partitioning = self.get_partitioning()
+        if partitioning is not None:
+            periods.schedule_drops(
+                self.database, self.storage.name, *partitioning
+            )
+        if self.get_max_size():
+            eviction.schedule_eviction(
+                self.database,
+                self.storage,
+                self.get_max_size(),
+                self.context.config.get(
+                    'MONGO_RESULT_STORAGE_EVICTION_INTERVAL',
+                    DEFAULT_EVICTION_INTERVAL
+                ),
+                self.context.config.get(
+                    'MONGO_RESULT_STORAGE_EVICTION_RECOUNT_INTERVAL',
+                    DEFAULT_EVICTION_RECOUNT_INTERVAL
+                )
+            )
 
         if not Storage.start_time:
             Storage.start_time = time.time()
@@ -44,14 +141,131 @@ class Storage(BaseStorage):
             port=self.context.config.MONGO_RESULT_STORAGE_SERVER_PORT,
             db_name=self.context.config.MONGO_RESULT_STORAGE_SERVER_DB,
             coll_name=
-            self.context.config.MONGO_RESULT_STORAGE_SERVER_COLLECTION
+            self.context.config.MONGO_RESULT_STORAGE_SERVER_COLLECTION,
+            hashed_keys=self.uses_hashed_keys(),
+            sharded=self.is_sharded(),
+            ensure_indexes=self.context.config.get(
+                'MONGO_RESULT_STORAGE_ENSURE_INDEXES', True
+            ),
+            tracks_access=self.get_max_size() > 0,
+            breaker=self.get_breaker(),
+            **client_options(
+                self.context.config, 'MONGO_RESULT_STORAGE',
+                worker_processes(self.context)
+            )
         )
 
         database = mongo_conn.db_conn
         storage = mongo_conn.coll_conn
+        self.index_specs = mongo_conn.index_specs()
 
         return database, storage
 
+    def read_connection(self):
+        '''Return the database and collection reads go to, routed by
+        MONGO_RESULT_STORAGE_READ_PREFERENCE. Writes always go to the primary.
+        :returns: MongoDB DB and Collection
+        :rtype: pymongo.database.Database, pymongo.database.Collection
+        '''
+
+        preference = read_preference(self.context.config, 'MONGO_RESULT_STORAGE')
+        if preference is None:
+            return self.database, self.storage
+
+        database = self.database.client.get_database(
+            self.database.name, read_preference=preference
+        )
+        return database, database[self.storage.name]
+
+    def is_sharded(self):
+        '''Tell whether the collection is sharded on the hashed key, see
+        MONGO_RESULT_STORAGE_SHARDED.
+        :rtype: bool
+        '''
+
+        return self.context.config.get('MONGO_RESULT_STORAGE_SHARDED', False)
+
+    def uses_hashed_keys(self):
+        '''Tell whether results are indexed by the digest of their key
+        rather than the key itself. Sharded collections always are.
+        :rtype: bool
+        '''
+
+        return self.is_sharded() or self.context.config.get(
+            'MONGO_RESULT_STORAGE_HASHED_KEYS', False
+        )
+
+    def get_partitioning(self):
+        '''Return the period length and expiration of time-partitioned
+        collections, see MONGO_RESULT_STORAGE_PARTITIONED and
+        tc_mongodb.mongodb.periods. Periods last
+        MONGO_RESULT_STORAGE_PARTITION_SECONDS, the expiration by default.
+        :returns: (length, max_age) in seconds, None when disabled
+        :rtype: tuple
+        '''
+
+        config = self.context.config
+        max_age = self.get_max_age()
+        if not config.get('MONGO_RESULT_STORAGE_PARTITIONED', False) or \
+                not max_age or max_age <= 0:
+            # Results that never expire can't be dropped with their period
+            return None
+
+        length = config.get('MONGO_RESULT_STORAGE_PARTITION_SECONDS', None)
+        return periods.check_partitioning(
+            'MONGO_RESULT_STORAGE', length or max_age, max_age
+        )
+
+    def read_collections(self):
+        '''Return the collections reads look a result up in, newest
+        period first when partitioned.
+        :rtype: list
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            return [self.reader]
+        return [
+            self.read_database[name] for name in
+            periods.live_partitions(self.storage.name, *partitioning)
+        ]
+
+    def current_collection(self):
+        '''Return the collection new results are written to, the one of
+        the current period when partitioned.
+        :rtype: pymongo.collection.Collection
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            return self.storage
+
+        collection = self.database[periods.partition_name(
+            self.storage.name, periods.period_start(partitioning[0])
+        )]
+        periods.ensure_indexes(collection, self.index_specs)
+        return collection
+
+    def bucket_name(self, collection):
+        '''Return the GridFS bucket of the results of collection.'''
+
+        return 'fs' if self.get_partitioning() is None else collection.name
+
+    def lookup(self, key):
+        '''Return the query of the result document of key.
+        :rtype: dict
+        '''
+
+        return keys.lookup('key', key, self.uses_hashed_keys())
+
+    def incr(self, name, value=1):
+        self.context.metrics.incr('%s.%s' % (self.metrics_prefix, name), value)
+
+    def timing(self, name, value):
+        self.context.metrics.timing(
+            '%s.%s' % (self.metrics_prefix, name), value
+        )
+
     def on_mongodb_error(self, fname, exc_type, exc_value):
         '''Callback executed when there is a redis error.
         :param string fname: Function name that was being called.
@@ -60,7 +274,14 @@ class Storage(BaseStorage):
         :returns: Default value or raise the current exception
         '''
 
-        logger.error("[MONGODB_RESULT_STORAGE] %s,%s" % exc_type, exc_value)
+        if isinstance(exc_value, CircuitOpenError):
+            # The breaker logged why it opened
+            self.incr('circuit_open.%s' % fname.lstrip('_'))
+        else:
+            self.incr('errors.%s' % fname.lstrip('_'))
+            logger.error(
+                "[MONGODB_RESULT_STORAGE] %s,%s", exc_type, exc_value
+            )
         if fname == '_exists':
             return False
         return None
@@ -82,11 +303,15 @@ class Storage(BaseStorage):
         :rettype: string
         '''
 
+        if self.request_key is not None:
+            return self.request_key
+
         path = "result:%s" % self.context.request.url
 
         if self.is_auto_webp():
             path += '/webp'
 
+        self.request_key = path
         return path
 
     def get_max_age(self):
@@ -99,6 +324,383 @@ class Storage(BaseStorage):
 
         return default_ttl
 
+    def get_expiration(self, created_at):
+        '''Return when a result stored at created_at expires.
+        :param datetime.datetime created_at: Storage date
+        :returns: Expiration date, None if results never expire
+        :rtype: datetime.datetime
+        '''
+
+        max_age = self.get_max_age()
+        if not max_age or max_age <= 0:
+            return None
+        return created_at + timedelta(seconds=max_age)
+
+    def get_stale_seconds(self):
+        '''Return how long expired results are still served while a single
+        request refreshes them, see MONGO_RESULT_STORAGE_STALE_SECONDS.
+        :returns: Grace window in seconds, 0 when disabled
+        :rtype: int
+        '''
+
+        if self.get_partitioning() is not None:
+            # Periods are dropped once their results expire
+            return 0
+        return self.context.config.get('MONGO_RESULT_STORAGE_STALE_SECONDS', 0)
+
+    def set_expiration(self, doc, expires_at):
+        '''Set the expiration of a new result document. With a grace
+        window, expires_at is when the TTL index removes it and refresh_at
+        when it expires.
+        '''
+
+        doc['expires_at'] = expires_at
+        stale_seconds = self.get_stale_seconds()
+        if stale_seconds:
+            doc['refresh_at'] = expires_at
+            doc['expires_at'] = expires_at + timedelta(seconds=stale_seconds)
+
+    def get_refresh_time(self, doc):
+        '''Return when a stored document expires.
+        :returns: None if it never expires
+        :rtype: datetime.datetime
+        '''
+
+        return doc.get('refresh_at') or doc.get('expires_at') or \
+            self.get_expiration(doc['created_at'])
+
+    def is_document_expired(self, doc):
+        '''Tell whether a stored document has expired. The TTL monitor
+        only runs once a minute, so expired documents can still be read.
+        :param dict doc: Document with its created_at and expires_at
+        :rtype: bool
+        '''
+
+        refresh_at = self.get_refresh_time(doc)
+        return refresh_at is not None and refresh_at <= datetime.utcnow()
+
+    def is_document_stale(self, doc):
+        '''Tell whether an expired document is still in its grace window.
+        :rtype: bool
+        '''
+
+        return bool(self.get_stale_seconds()) and \
+            doc.get('refresh_at') is not None and \
+            doc['expires_at'] > datetime.utcnow()
+
+    def is_document_servable(self, doc):
+        return not self.is_document_expired(doc) or \
+            self.is_document_stale(doc)
+
+    def refresh_claim(self, stored):
+        '''Return the update claiming the refresh of a stale document for
+        MONGO_RESULT_STORAGE_REFRESH_TIMEOUT seconds, None when a request
+        holds the claim. The claim is also marked on stored, so requests
+        sharing the document don't try again.
+        :returns: Query and update
+        :rtype: tuple
+        '''
+
+        now = datetime.utcnow()
+        if stored.get('refreshing_until') is not None and \
+                stored['refreshing_until'] > now:
+            return None
+
+        timeout = self.context.config.get(
+            'MONGO_RESULT_STORAGE_REFRESH_TIMEOUT', DEFAULT_REFRESH_TIMEOUT
+        )
+        stored['refreshing_until'] = now + timedelta(seconds=timeout)
+        return (
+            {'_id': stored['_id'], 'refreshing_until': {'$not': {'$gt': now}}},
+            {'$set': {'refreshing_until': stored['refreshing_until']}}
+        )
+
+    @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    def claim_refresh(self, stored):
+        '''Tell whether this request refreshes a stale result. A single
+        request gets the claim, the put replacing the document releases it,
+        and it lapses if the new result is not stored in time.
+        :rtype: bool
+        '''
+
+        claim = self.refresh_claim(stored)
+        if claim is None:
+            return False
+        return self.storage.update_one(*claim).modified_count == 1
+
+    def serve(self, found, refreshes):
+        '''Return the result of a lookup to this request, None when the
+        request refreshes a stale one.
+        :param tuple found: Result and stale document, see _get
+        :param bool refreshes: Whether this request got the refresh claim
+        :rtype: thumbor.result_storages.ResultStorageResult
+        '''
+
+        result, stale = found or (None, None)
+        if stale is None:
+            return result
+        if refreshes:
+            # thumbor renders the result again and stores it
+            self.incr('get.refresh')
+            return None
+        self.incr('get.stale')
+        return result
+
+    def get_inline_max_size(self):
+        '''Return the largest result stored inline in the result document.
+        Bigger results go to GridFS.
+        :returns: Size in bytes, 0 stores everything in GridFS
+        :rtype: int
+        '''
+
+        return self.context.config.get(
+            'MONGO_RESULT_STORAGE_INLINE_MAX_SIZE', DEFAULT_INLINE_MAX_SIZE
+        )
+
+    def deduplicates(self):
+        '''Tell whether GridFS results are shared by content, see
+        tc_mongodb.mongodb.blobs.
+        :rtype: bool
+        '''
+
+        # Shared files outlive the partitions referencing them
+        return self.get_partitioning() is None and self.context.config.get(
+            'MONGO_RESULT_STORAGE_DEDUPLICATE', False
+        )
+
+    def get_max_size(self):
+        '''Return the byte budget of the stored results, see
+        MONGO_RESULT_STORAGE_MAX_SIZE and tc_mongodb.mongodb.eviction.
+        :returns: Size in bytes, 0 when results are not evicted
+        :rtype: int
+        '''
+
+        if self.get_partitioning() is not None:
+            # Periods are dropped whole, not evicted result by result
+            return 0
+        return self.context.config.get('MONGO_RESULT_STORAGE_MAX_SIZE', 0)
+
+    def record_stored(self, previous, size):
+        '''Count a put in the size tracked for eviction. Shared blobs count
+        once per put until the next recount.
+        :param dict previous: Replaced document
+        :param int size: Bytes written
+        '''
+
+        if not self.get_max_size():
+            return
+        if previous:
+            size -= previous.get('content_length') or 0
+        eviction.record_stored(self.storage, size)
+
+    def get_access_queue(self):
+        '''Return the process-wide queue of accesses to record.
+        :returns: The queue, None when results are not evicted
+        :rtype: tc_mongodb.write_behind.WriteBehindQueue
+        '''
+
+        if not self.get_max_size():
+            return None
+
+        if Storage.access_queue is None:
+            # The worker thread uses pymongo even behind Motor
+            collection = getattr(self.storage, 'delegate', self.storage)
+            Storage.access_queue = WriteBehindQueue(
+                functools.partial(eviction.record_accesses, collection),
+                batch_size=500,
+                policy=DROP
+            )
+        return Storage.access_queue
+
+    def record_access(self, stored, query=None):
+        '''Record a read of a result document, unless an access was recorded
+        less than MONGO_RESULT_STORAGE_ACCESS_RESOLUTION seconds ago.
+        Accesses are dropped rather than delay reads when the queue is full.
+        The recorded access is set on stored.
+        :param dict stored: Result document with its _id and last_access
+        :param dict query: Lookup of the document, by _id by default
+        '''
+
+        queue = self.get_access_queue()
+        if queue is None:
+            return
+
+        now = datetime.utcnow()
+        resolution = self.context.config.get(
+            'MONGO_RESULT_STORAGE_ACCESS_RESOLUTION', DEFAULT_ACCESS_RESOLUTION
+        )
+        if eviction.is_access_due(stored.get('last_access'), resolution, now):
+            if query is None:
+                query = {'_id': stored['_id']}
+            queue.submit((query, now))
+            stored['last_access'] = now
+
+    def get_memory_cache(self):
+        '''Return the process-wide cache of results, bounded by
+        MONGO_RESULT_STORAGE_MEMORY_CACHE_SIZE bytes.
+        :returns: The cache, None when disabled
+        :rtype: tc_mongodb.lru_cache.LRUCache
+        '''
+
+        max_size = self.context.config.get(
+            'MONGO_RESULT_STORAGE_MEMORY_CACHE_SIZE', 0
+        )
+        if not max_size:
+            return None
+
+        if Storage.memory_cache is None:
+            Storage.memory_cache = LRUCache(
+                max_size, sizeof=lambda entry: len(entry[0])
+            )
+        return Storage.memory_cache
+
+    def get_bucket(self, database, bucket_name='fs'):
+        '''Return the process-wide GridFS bucket of database. New files are
+        split in chunks of MONGO_RESULT_STORAGE_CHUNK_SIZE bytes.
+        :rtype: gridfs.GridFSBucket
+        '''
+
+        return get_bucket(
+            self.bucket_class,
+            database,
+            self.context.config.get('MONGO_RESULT_STORAGE_CHUNK_SIZE', None),
+            bucket_name
+        )
+
+    def get_disk_cache(self):
+        '''Return the process-wide cache of GridFS results in
+        MONGO_RESULT_STORAGE_DISK_CACHE_PATH, bounded by
+        MONGO_RESULT_STORAGE_DISK_CACHE_SIZE bytes. GridFS files never
+        change, so entries are keyed by file id and need no invalidation.
+        :returns: The cache, None when disabled
+        :rtype: tc_mongodb.disk_cache.DiskCache
+        '''
+
+        directory = self.context.config.get(
+            'MONGO_RESULT_STORAGE_DISK_CACHE_PATH', None
+        )
+        if not directory:
+            return None
+
+        if Storage.disk_cache is None:
+            Storage.disk_cache = DiskCache(
+                directory,
+                self.context.config.get(
+                    'MONGO_RESULT_STORAGE_DISK_CACHE_SIZE',
+                    DEFAULT_DISK_CACHE_SIZE
+                )
+            )
+        return Storage.disk_cache
+
+    def get_breaker(self):
+        '''Return the process-wide circuit breaker, opened after
+        MONGO_RESULT_STORAGE_CIRCUIT_BREAKER_THRESHOLD consecutive connection
+        failures or timeouts for MONGO_RESULT_STORAGE_CIRCUIT_BREAKER_COOLDOWN
+        seconds.
+        :returns: The breaker, None when disabled
+        :rtype: tc_mongodb.utils.CircuitBreaker
+        '''
+
+        threshold = self.context.config.get(
+            'MONGO_RESULT_STORAGE_CIRCUIT_BREAKER_THRESHOLD', 0
+        )
+        if not threshold:
+            return None
+
+        if Storage.breaker is None:
+            Storage.breaker = CircuitBreaker(
+                threshold,
+                self.context.config.get(
+                    'MONGO_RESULT_STORAGE_CIRCUIT_BREAKER_COOLDOWN',
+                    DEFAULT_CIRCUIT_BREAKER_COOLDOWN
+                )
+            )
+        return Storage.breaker
+
+    def get_cached_result(self, key):
+        '''Return the result cached in memory for key.
+        :rtype: thumbor.result_storages.ResultStorageResult
+        '''
+
+        cache = self.get_memory_cache()
+        if cache is None:
+            return None
+
+        entry = cache.get(key)
+        if entry is None:
+            self.incr('memory_cache.miss')
+            return None
+
+        self.incr('memory_cache.hit')
+        contents, metadata, access = entry
+        # The hottest results are read from memory, keep them from eviction
+        self.record_access(access, self.lookup(key))
+        return ResultStorageResult(
+            buffer=contents,
+            metadata=dict(metadata),
+            successful=True
+        )
+
+    def cache_result(self, key, contents, metadata, expires_at,
+                     last_access=None):
+        '''Keep a result in memory until it expires.
+        :param datetime.datetime expires_at: None if it never expires
+        :param datetime.datetime last_access: Access stored in the document
+        '''
+
+        cache = self.get_memory_cache()
+        if cache is None:
+            return
+
+        ttl = None
+        if expires_at is not None:
+            ttl = (expires_at - datetime.utcnow()).total_seconds()
+            if ttl <= 0:
+                return
+
+        cache.set(
+            key, (contents, dict(metadata), {'last_access': last_access}), ttl
+        )
+
+    def get_miss_cache(self):
+        '''Return the process-wide cache of recent misses, bounded by
+        MONGO_RESULT_STORAGE_MISS_CACHE_SIZE keys.
+        :returns: The cache, None when disabled
+        :rtype: tc_mongodb.lru_cache.LRUCache
+        '''
+
+        max_size = self.context.config.get(
+            'MONGO_RESULT_STORAGE_MISS_CACHE_SIZE', 0
+        )
+        if not max_size:
+            return None
+
+        if Storage.miss_cache is None:
+            Storage.miss_cache = LRUCache(max_size, sizeof=lambda value: 1)
+        return Storage.miss_cache
+
+    def is_known_miss(self, key):
+        cache = self.get_miss_cache()
+        return cache is not None and cache.get(key, False)
+
+    def remember_miss(self, key):
+        '''Answer lookups of key as misses for
+        MONGO_RESULT_STORAGE_MISS_CACHE_TTL seconds, or until this process
+        stores it.
+        '''
+
+        cache = self.get_miss_cache()
+        if cache is not None:
+            cache.set(key, True, self.context.config.get(
+                'MONGO_RESULT_STORAGE_MISS_CACHE_TTL', DEFAULT_MISS_CACHE_TTL
+            ))
+
+    def forget_miss(self, key):
+        cache = self.get_miss_cache()
+        if cache is not None:
+            cache.delete(key)
+
     def is_expired(self, key):
         """
         Tells whether key has expired
@@ -106,33 +708,95 @@ class Storage(BaseStorage):
         :return: Whether it is expired or not
         :rtype: bool
         """
-        if key:
-            expire = self.get_max_age
-
-            if expire is None or expire == 0:
-                return False
-
-            image = next(self.storage.find({
-                'key': key,
-                'created_at': {
-                    '$gte': datetime.utcnow() - timedelta(
-                        seconds=self.get_max_age()
-                    )
-                },
-            }, {
-                'created_at': True, '_id': False
-            }).limit(1), None)
-
-            if image:
-                age = int(
-                    (datetime.utcnow() - image['created_at']).total_seconds()
-                )
-                timediff = datetime.utcnow() - timedelta(seconds=age)
-                return timediff.seconds > expire
-        else:
+        if not key:
             return True
 
+        image = self.get_document(key)
+
+        return image is None or self.is_document_expired(image)
+
+    def document_projection(self, with_data=False):
+        projection = {
+            'file_id': True,
+            'bucket': True,
+            'created_at': True,
+            'expires_at': True,
+            'metadata': True,
+            'content_type': True,
+            'content_length': True,
+            'etag': True,
+            'last_access': True,
+            'refresh_at': True,
+            'refreshing_until': True
+        }
+        if with_data:
+            projection['data'] = True
+        return projection
+
+    def get_result_metadata(self, stored, contents=None):
+        '''Return the thumbor metadata of a stored result. Documents written
+        by older versions lack the precomputed fields, they are derived from
+        contents when given.
+        :param dict stored: Result document
+        :param bytes contents: Result payload
+        :rtype: dict
+        '''
+
+        metadata = dict(stored.get('metadata') or {})
+        metadata['LastModified'] = stored['created_at'].replace(
+            tzinfo=pytz.utc
+        )
+
+        if stored.get('content_type') is not None:
+            metadata['ContentType'] = stored['content_type']
+            metadata['ContentLength'] = stored['content_length']
+            metadata['ETag'] = stored['etag']
+        elif contents is not None:
+            metadata['ContentType'] = BaseEngine.get_mimetype(contents)
+            metadata['ContentLength'] = len(contents)
+            metadata['ETag'] = compute_etag(contents)
+
+        return metadata
+
+    def memoized_document(self, key, with_data=False):
+        '''Return the document already fetched for key by this request.
+        :returns: Whether it was fetched, and the document
+        :rtype: tuple
+        '''
+
+        if key not in self.documents:
+            return False, None
+
+        doc, has_data = self.documents[key]
+        if with_data and not has_data and doc is not None:
+            return False, None
+        return True, doc
+
+    def remember_document(self, key, doc, with_data=False):
+        self.documents[key] = (doc, with_data)
+
+    def get_document(self, key, with_data=False):
+        '''Return the result document for key, querying MongoDB once per
+        request. Inline payloads are only fetched when with_data is set.
+        :param string key: Result key
+        :param bool with_data: Whether the inline payload is needed
+        :rtype: dict
+        '''
+
+        found, doc = self.memoized_document(key, with_data)
+        if not found:
+            for collection in self.read_collections():
+                doc = collection.find_one(
+                    self.lookup(key), self.document_projection(with_data)
+                )
+                if doc is not None:
+                    break
+            self.remember_document(key, doc, with_data)
+        return doc
+
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def put(self, bytes):
         '''Save to mongodb
         :param bytes: Bytes to write to the storage.
@@ -140,67 +804,219 @@ class Storage(BaseStorage):
         :rettype: string
         '''
 
-        doc = {
-            'key': self.get_key_from_request(),
-            'created_at': datetime.utcnow()
-        }
+        doc = self.lookup(self.get_key_from_request())
+        doc['created_at'] = datetime.utcnow()
+        self.forget_miss(doc['key'])
+        self.incr('bytes_written', len(bytes))
+
+        expires_at = self.get_expiration(doc['created_at'])
+        if expires_at is not None:
+            self.set_expiration(doc, expires_at)
 
         if self.context.config.get("MONGO_STORE_METADATA", False):
             doc['metadata'] = dict(self.context.headers)
         else:
             doc['metadata'] = {}
 
+        doc['content_type'] = BaseEngine.get_mimetype(bytes)
+        doc['content_length'] = len(bytes)
+        doc['etag'] = compute_etag(bytes)
+
         file_doc = dict(doc)
+        if self.get_max_size():
+            file_doc['last_access'] = doc['created_at']
+        collection = self.current_collection()
+
+        if len(bytes) <= self.get_inline_max_size():
+            file_doc['data'] = Binary(bytes)
+        else:
+            bucket_name = self.bucket_name(collection)
+            file_doc['file_id'] = self.put_file(bytes, doc, bucket_name)
+            if bucket_name != 'fs':
+                file_doc['bucket'] = bucket_name
+
+        previous = self.replace_document(
+            self.lookup(doc['key']), file_doc, collection
+        )
+        self.release_file(previous, file_doc.get('file_id'))
+        self.documents.pop(doc['key'], None)
+        self.record_stored(previous, len(bytes))
+
+        self.cache_result(
+            doc['key'], bytes, self.get_result_metadata(doc), expires_at,
+            file_doc.get('last_access')
+        )
+
+    def put_file(self, bytes, doc, bucket_name='fs'):
+        '''Store a result in GridFS.
+        :param bytes: Payload
+        :param dict doc: Fields of the file, unless shared by content
+        :param string bucket_name: Bucket of files that are not shared
+        :returns: The file id
+        '''
 
-        file_storage = gridfs.GridFS(self.database)
-        file_data = file_storage.put(bytes, **doc)
+        if self.deduplicates():
+            file_id = blobs.put_shared(
+                self.database, self.storage.name, bytes
+            )
+            if file_id is not None:
+                return file_id
+        file_storage = self.get_bucket(self.database, bucket_name)
+        return file_storage.upload_from_stream(
+            doc['key'], bytes, metadata=doc
+        )
+
+    def replace_document(self, query, doc, collection=None):
+        '''Atomically replace the document matching query, inserting it
+        when missing.
+        :param dict query: Unique lookup of the document
+        :param dict doc: New document
+        :param collection: Where the document lives, the storage
+            collection by default
+        :returns: The replaced document, if any
+        :rtype: dict
+        '''
 
-        file_doc['file_id'] = file_data
-        self.storage.insert_one(file_doc)
+        if collection is None:
+            collection = self.storage
+        projection = {'file_id': True, 'bucket': True, 'content_length': True}
+
+        try:
+            return collection.find_one_and_replace(
+                query, doc, projection=projection, upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent put inserted the document first, replace it
+            return collection.find_one_and_replace(
+                query, doc, projection=projection
+            )
+
+    def release_file(self, previous, file_id=None):
+        '''Release the GridFS file of a replaced document. A shared file
+        is released even when the new document uses it too, since the put
+        took its own reference.
+        :param dict previous: Replaced document
+        :param file_id: GridFS file of the new document
+        '''
+
+        if not previous or previous.get('file_id') is None:
+            return
+        if previous['file_id'] == file_id and not blobs.is_shared(file_id):
+            return
+
+        blobs.release(
+            self.database, previous['file_id'], previous.get('bucket', 'fs')
+        )
 
     @return_future
     def get(self, callback):
         '''Get the item from MongoDB.'''
 
         key = self.get_key_from_request()
-        callback(self._get(key))
+        result = self.get_cached_result(key)
+        if result is None:
+            found = self._get(key)
+            stale = found[1] if found else None
+            result = self.serve(
+                found, stale is not None and self.claim_refresh(stale)
+            )
+        callback(result)
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def _get(self, key):
-        stored = next(self.storage.find({
-            'key': key,
-            'created_at': {
-                '$gte': datetime.utcnow() - timedelta(
-                    seconds=self.get_max_age()
-                )
-            },
-        }, {
-            'file_id': True,
-            'created_at': True,
-            'metadata': True
-        }).limit(1), None)
-
-        if not stored:
+        if self.is_known_miss(key):
+            self.incr('get.miss_cached')
             return None
 
-        file_storage = gridfs.GridFS(self.database)
+        stored = self.get_document(key, with_data=True)
 
-        contents = file_storage.get(stored['file_id']).read()
+        stale = None
+        if stored and self.is_document_expired(stored) and \
+                self.is_document_stale(stored):
+            # Each caller claims the refresh, see serve
+            stale = stored
+        elif not stored or self.is_document_expired(stored):
+            self.incr('get.expired' if stored else 'get.miss')
+            self.remember_miss(key)
+            return None
 
-        metadata = stored['metadata']
-        metadata['LastModified'] = stored['created_at'].replace(
-            tzinfo=pytz.utc
+        if stored.get('data') is not None:
+            contents = bytes(stored['data'])
+        else:
+            contents = self.read_file(
+                stored['file_id'], stored.get('bucket', 'fs')
+            )
+            if contents is None:
+                # Replaced by a concurrent put between both reads
+                self.incr('get.miss')
+                self.remember_miss(key)
+                return None
+
+        self.incr('get.hit')
+        self.incr('bytes_read', len(contents))
+        self.record_access(stored)
+        metadata = self.get_result_metadata(stored, contents)
+        self.cache_result(
+            key, contents, metadata, self.get_refresh_time(stored),
+            stored.get('last_access')
         )
-        metadata['ContentLength'] = len(contents)
-        metadata['ContentType'] = BaseEngine.get_mimetype(contents)
         result = ResultStorageResult(
             buffer=contents,
             metadata=metadata,
             successful=True
         )
-        return result
+        return result, stale
+
+    @timed
+    def read_file(self, file_id, bucket_name='fs'):
+        '''Return the payload of a GridFS file, from the disk cache when
+        enabled.
+        :param string bucket_name: Bucket holding the file
+        :returns: The payload, None if the file is gone
+        :rtype: bytes
+        '''
+
+        disk_cache = self.get_disk_cache()
+        if disk_cache is not None:
+            contents = disk_cache.get(str(file_id))
+            self.incr('disk_cache.hit' if contents is not None
+                      else 'disk_cache.miss')
+            if contents is not None:
+                return contents
+
+        file_storage = self.get_bucket(self.read_database, bucket_name)
+        try:
+            contents = read_stream(file_storage.open_download_stream(file_id))
+        except gridfs.NoFile:
+            return None
+
+        if disk_cache is not None:
+            disk_cache.set(str(file_id), contents)
+        return contents
+
+    @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    def get_metadata(self):
+        '''Return the metadata of the current request item without reading
+        its payload.
+        :returns: LastModified, ContentType, ContentLength and ETag
+        :rtype: dict
+        '''
+
+        key = self.get_key_from_request()
+        stored = self.get_document(key)
+
+        if not stored or not self.is_document_servable(stored):
+            return None
+
+        return self.get_result_metadata(stored)
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def last_updated(self):
         '''Return the last_updated time of the current request item
         :return: A DateTime object
@@ -210,36 +1026,27 @@ class Storage(BaseStorage):
         key = self.get_key_from_request()
         max_age = self.get_max_age()
 
-        if max_age == 0:
+        if max_age <= 0:
             return datetime.fromtimestamp(Storage.start_time)
 
-        image = next(self.storage.find({
-            'key': key,
-            'created_at': {
-                '$gte': datetime.utcnow() - timedelta(
-                    seconds=self.get_max_age()
-                )
-            },
-        }, {
-            'created_at': True, '_id': False
-        }).limit(1), None)
-
-        if image:
-            age = int(
-                (datetime.utcnow() - image['created_at']).total_seconds()
-            )
-            ttl = max_age - age
+        cached = self.get_memory_cache()
+        entry = cached.get(key) if cached is not None else None
+        if entry is not None:
+            return entry[1]['LastModified'].replace(tzinfo=None)
 
-            if max_age <= 0:
-                return datetime.fromtimestamp(Storage.start_time)
+        image = self.get_document(key)
 
-            if ttl >= 0:
-                return datetime.utcnow() - timedelta(
-                    seconds=(
-                        max_age - ttl
-                    )
-                )
+        if image and self.is_document_servable(image):
+            return image['created_at']
 
         # Should never reach here. It means the storage put failed or the item
         # somehow does not exists anymore
         return datetime.utcnow()
+
+
+def forget_access_queue():
+    # The worker thread of the parent does not run in forked children
+    Storage.access_queue = None
+
+
+on_fork(forget_access_queue)
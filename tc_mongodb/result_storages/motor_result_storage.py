@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from datetime import datetime
+
+from bson.binary import Binary
+from motor.motor_tornado import MotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from tornado import gen
+from tornado.ioloop import IOLoop
+from thumbor.engines import BaseEngine
+from thumbor.result_storages import ResultStorageResult
+from tc_mongodb.utils import OnException, SingleFlight, guarded, timed
+from tc_mongodb.mongodb import blobs, periods
+from tc_mongodb.mongodb.buckets import read_motor_stream
+from tc_mongodb.mongodb.registry import client_options, worker_processes
+from tc_mongodb.mongodb.connector_motor_result_storage import MongoConnector
+from tc_mongodb.result_storages.mongo_result_storage import \
+    Storage as MongoResultStorage, compute_etag
+
+
+class Storage(MongoResultStorage):
+    '''Non-blocking MongoDB result storage backed by Motor.
+
+    ``get``, ``last_updated`` and ``is_expired`` return futures; thumbor
+    resolves them with ``gen.maybe_future``.
+    '''
+
+    '''inflight coalesces concurrent reads of the same key in the process.
+    '''
+    inflight = SingleFlight()
+
+    bucket_class = MotorGridFSBucket
+
+    def __conn__(self):
+        '''Return the Motor database and collection object.
+        :returns: Motor DB and Collection
+        :rtype: motor.motor_tornado.MotorDatabase,
+                motor.motor_tornado.MotorCollection
+        '''
+
+        mongo_conn = MongoConnector(
+            uri=self.context.config.MONGO_RESULT_STORAGE_URI,
+            host=self.context.config.MONGO_RESULT_STORAGE_SERVER_HOST,
+            port=self.context.config.MONGO_RESULT_STORAGE_SERVER_PORT,
+            db_name=self.context.config.MONGO_RESULT_STORAGE_SERVER_DB,
+            coll_name=
+            self.context.config.MONGO_RESULT_STORAGE_SERVER_COLLECTION,
+            hashed_keys=self.uses_hashed_keys(),
+            sharded=self.is_sharded(),
+            ensure_indexes=self.context.config.get(
+                'MONGO_RESULT_STORAGE_ENSURE_INDEXES', True
+            ),
+            tracks_access=self.get_max_size() > 0,
+            **client_options(
+                self.context.config, 'MONGO_RESULT_STORAGE',
+                worker_processes(self.context)
+            )
+        )
+
+        database = mongo_conn.db_conn
+        storage = mongo_conn.coll_conn
+        self.index_specs = mongo_conn.index_specs()
+
+        return database, storage
+
+    @gen.coroutine
+    def current_collection(self):
+        '''Return the collection new results are written to, the one of
+        the current period when partitioned. Partition indexes are created
+        with pymongo on the executor.
+        :rtype: motor.motor_tornado.MotorCollection
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            raise gen.Return(self.storage)
+
+        collection = self.database[periods.partition_name(
+            self.storage.name, periods.period_start(partitioning[0])
+        )]
+        if periods.claim_indexes(collection.delegate):
+            yield IOLoop.current().run_in_executor(
+                None, periods.create_indexes,
+                collection.delegate, self.index_specs
+            )
+        raise gen.Return(collection)
+
+    @gen.coroutine
+    def is_expired(self, key):
+        """
+        Tells whether key has expired
+        :param string key: Path to check
+        :return: Whether it is expired or not
+        :rtype: bool
+        """
+        if not key:
+            raise gen.Return(True)
+
+        image = yield self.get_document(key)
+
+        raise gen.Return(image is None or self.is_document_expired(image))
+
+    @gen.coroutine
+    def get_document(self, key, with_data=False):
+        '''Return the result document for key, querying MongoDB once per
+        request. Inline payloads are only fetched when with_data is set.
+        :param string key: Result key
+        :param bool with_data: Whether the inline payload is needed
+        :rtype: dict
+        '''
+
+        found, doc = self.memoized_document(key, with_data)
+        if not found:
+            for collection in self.read_collections():
+                doc = yield collection.find_one(
+                    self.lookup(key), self.document_projection(with_data)
+                )
+                if doc is not None:
+                    break
+            self.remember_document(key, doc, with_data)
+        raise gen.Return(doc)
+
+    @OnException(MongoResultStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def put(self, bytes):
+        '''Save to mongodb
+        :param bytes: Bytes to write to the storage.
+        '''
+
+        doc = self.lookup(self.get_key_from_request())
+        doc['created_at'] = datetime.utcnow()
+        self.forget_miss(doc['key'])
+        self.incr('bytes_written', len(bytes))
+
+        expires_at = self.get_expiration(doc['created_at'])
+        if expires_at is not None:
+            self.set_expiration(doc, expires_at)
+
+        if self.context.config.get("MONGO_STORE_METADATA", False):
+            doc['metadata'] = dict(self.context.headers)
+        else:
+            doc['metadata'] = {}
+
+        doc['content_type'] = BaseEngine.get_mimetype(bytes)
+        doc['content_length'] = len(bytes)
+        doc['etag'] = compute_etag(bytes)
+
+        file_doc = dict(doc)
+        if self.get_max_size():
+            file_doc['last_access'] = doc['created_at']
+        collection = yield self.current_collection()
+
+        if len(bytes) <= self.get_inline_max_size():
+            file_doc['data'] = Binary(bytes)
+        else:
+            bucket_name = self.bucket_name(collection)
+            file_doc['file_id'] = yield self.put_file(
+                bytes, doc, bucket_name
+            )
+            if bucket_name != 'fs':
+                file_doc['bucket'] = bucket_name
+
+        previous = yield self.replace_document(
+            self.lookup(doc['key']), file_doc, collection
+        )
+        yield self.release_file(previous, file_doc.get('file_id'))
+        self.documents.pop(doc['key'], None)
+        self.record_stored(previous, len(bytes))
+
+        self.cache_result(
+            doc['key'], bytes, self.get_result_metadata(doc), expires_at,
+            file_doc.get('last_access')
+        )
+
+    @gen.coroutine
+    def put_file(self, bytes, doc, bucket_name='fs'):
+        '''Store a result in GridFS. Shared blobs are reference counted
+        with pymongo on the executor.
+        :param bytes: Payload
+        :param dict doc: Metadata of the file, unless shared by content
+        :param string bucket_name: Bucket of files that are not shared
+        :returns: The file id
+        '''
+
+        file_id = None
+        if self.deduplicates():
+            file_id = yield IOLoop.current().run_in_executor(
+                None, blobs.put_shared,
+                self.database.delegate, self.storage.name, bytes
+            )
+        if file_id is None:
+            # Not deduplicated, or the blob could not be shared
+            file_storage = self.get_bucket(self.database, bucket_name)
+            file_id = yield file_storage.upload_from_stream(
+                doc['key'], bytes, metadata=doc
+            )
+        raise gen.Return(file_id)
+
+    @gen.coroutine
+    def replace_document(self, query, doc, collection=None):
+        '''Atomically replace the document matching query, inserting it
+        when missing.
+        :param dict query: Unique lookup of the document
+        :param dict doc: New document
+        :param collection: Where the document lives, the storage
+            collection by default
+        :returns: The replaced document, if any
+        :rtype: dict
+        '''
+
+        if collection is None:
+            collection = self.storage
+        projection = {'file_id': True, 'bucket': True, 'content_length': True}
+
+        try:
+            previous = yield collection.find_one_and_replace(
+                query, doc, projection=projection, upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent put inserted the document first, replace it
+            previous = yield collection.find_one_and_replace(
+                query, doc, projection=projection
+            )
+        raise gen.Return(previous)
+
+    @gen.coroutine
+    def release_file(self, previous, file_id=None):
+        '''Release the GridFS file of a replaced document. A shared file
+        is released even when the new document uses it too, since the put
+        took its own reference.
+        :param dict previous: Replaced document
+        :param file_id: GridFS file of the new document
+        '''
+
+        if not previous or previous.get('file_id') is None:
+            return
+        if previous['file_id'] == file_id and not blobs.is_shared(file_id):
+            return
+
+        if blobs.is_shared(previous['file_id']):
+            yield IOLoop.current().run_in_executor(
+                None, blobs.release,
+                self.database.delegate, previous['file_id']
+            )
+            return
+
+        file_storage = self.get_bucket(
+            self.database, previous.get('bucket', 'fs')
+        )
+        try:
+            yield file_storage.delete(previous['file_id'])
+        except NoFile:
+            pass
+
+    @OnException(MongoResultStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @gen.coroutine
+    def claim_refresh(self, stored):
+        claim = self.refresh_claim(stored)
+        if claim is None:
+            raise gen.Return(False)
+        result = yield self.storage.update_one(*claim)
+        raise gen.Return(result.modified_count == 1)
+
+    @gen.coroutine
+    def get(self):
+        '''Get the item from MongoDB. Concurrent lookups of the key share
+        one _get, each caller then claims the refresh of a stale result on
+        its own, so only one of them misses.
+        '''
+
+        key = self.get_key_from_request()
+        result = self.get_cached_result(key)
+        if result is None:
+            found = yield self.inflight.do(
+                ('get', self.storage.full_name, key), self._get, key
+            )
+            stale = found[1] if found else None
+            refreshes = False
+            if stale is not None:
+                refreshes = yield self.claim_refresh(stale)
+            result = self.serve(found, refreshes)
+        raise gen.Return(result)
+
+    @OnException(MongoResultStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _get(self, key):
+        if self.is_known_miss(key):
+            self.incr('get.miss_cached')
+            raise gen.Return(None)
+
+        stored = yield self.get_document(key, with_data=True)
+
+        stale = None
+        if stored and self.is_document_expired(stored) and \
+                self.is_document_stale(stored):
+            # Each caller claims the refresh, see get
+            stale = stored
+        elif not stored or self.is_document_expired(stored):
+            self.incr('get.expired' if stored else 'get.miss')
+            self.remember_miss(key)
+            raise gen.Return(None)
+
+        if stored.get('data') is not None:
+            contents = bytes(stored['data'])
+        else:
+            contents = yield self.read_file(
+                stored['file_id'], stored.get('bucket', 'fs')
+            )
+            if contents is None:
+                # Replaced by a concurrent put between both reads
+                self.incr('get.miss')
+                self.remember_miss(key)
+                raise gen.Return(None)
+
+        self.incr('get.hit')
+        self.incr('bytes_read', len(contents))
+        self.record_access(stored)
+        metadata = self.get_result_metadata(stored, contents)
+        self.cache_result(
+            key, contents, metadata, self.get_refresh_time(stored),
+            stored.get('last_access')
+        )
+        result = ResultStorageResult(
+            buffer=contents,
+            metadata=metadata,
+            successful=True
+        )
+        raise gen.Return((result, stale))
+
+    @timed
+    @gen.coroutine
+    def read_file(self, file_id, bucket_name='fs'):
+        '''Return the payload of a GridFS file, from the disk cache when
+        enabled.
+        :param string bucket_name: Bucket holding the file
+        :returns: The payload, None if the file is gone
+        :rtype: bytes
+        '''
+
+        disk_cache = self.get_disk_cache()
+        if disk_cache is not None:
+            contents = disk_cache.get(str(file_id))
+            self.incr('disk_cache.hit' if contents is not None
+                      else 'disk_cache.miss')
+            if contents is not None:
+                raise gen.Return(contents)
+
+        file_storage = self.get_bucket(self.read_database, bucket_name)
+        try:
+            grid_out = yield file_storage.open_download_stream(file_id)
+        except NoFile:
+            raise gen.Return(None)
+        contents = yield read_motor_stream(grid_out)
+
+        if disk_cache is not None:
+            disk_cache.set(str(file_id), contents)
+        raise gen.Return(contents)
+
+    @OnException(MongoResultStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def get_metadata(self):
+        '''Return the metadata of the current request item without reading
+        its payload.
+        :returns: LastModified, ContentType, ContentLength and ETag
+        :rtype: dict
+        '''
+
+        key = self.get_key_from_request()
+        stored = yield self.get_document(key)
+
+        if not stored or not self.is_document_servable(stored):
+            raise gen.Return(None)
+
+        raise gen.Return(self.get_result_metadata(stored))
+
+    @OnException(MongoResultStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def last_updated(self):
+        '''Return the last_updated time of the current request item
+        :return: A DateTime object
+        :rettype: datetetime.datetime
+        '''
+
+        key = self.get_key_from_request()
+        max_age = self.get_max_age()
+
+        if max_age <= 0:
+            raise gen.Return(datetime.fromtimestamp(Storage.start_time))
+
+        cached = self.get_memory_cache()
+        entry = cached.get(key) if cached is not None else None
+        if entry is not None:
+            raise gen.Return(entry[1]['LastModified'].replace(tzinfo=None))
+
+        image = yield self.get_document(key)
+
+        if image and self.is_document_servable(image):
+            raise gen.Return(image['created_at'])
+
+        # Should never reach here. It means the storage put failed or the item
+        # somehow does not exists anymore
+        raise gen.Return(datetime.utcnow())
@@ -4,25 +4,163 @@
 # Copyright (c) 2015 Thumbor-Community
 # Copyright (c) 2011 globo.com timehome@corp.globo.com
 
+import functools
 from datetime import datetime, timedelta
 import gridfs
-from pymongo.errors import PyMongoError
+from bson.binary import Binary
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from pymongo.write_concern import WriteConcern
 from tornado.concurrent import return_future
 from thumbor.storages import BaseStorage
 from thumbor.utils import logger
-from tc_mongodb.utils import OnException
+from tc_mongodb.disk_cache import DiskCache
+from tc_mongodb.lru_cache import LRUCache
+from tc_mongodb.utils import (
+    CircuitBreaker, CircuitOpenError, OnException, guarded, timed
+)
+from tc_mongodb.write_behind import DROP, WriteBehindQueue
+from tc_mongodb.mongodb.registry import (
+    client_options, on_fork, read_preference, worker_processes
+)
 from tc_mongodb.mongodb.connector_storage import MongoConnector
+from tc_mongodb.mongodb import blobs, keys, periods
+from tc_mongodb.mongodb.buckets import get_bucket, read_files, read_stream
+from tc_mongodb.mongodb.maintenance import owned_files, schedule_sweep
+from tc_mongodb.mongodb.monitoring import install as install_monitoring
+
+# Payloads that fit in a single GridFS chunk are kept in the image document
+DEFAULT_INLINE_MAX_SIZE = 255 * 1024
+DEFAULT_ORPHAN_SWEEP_INTERVAL = 0
+DEFAULT_MISS_CACHE_TTL = 5
+DEFAULT_DISK_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_WRITE_BEHIND_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 10
+
+
+def operation_size(operation):
+    '''Return the bytes a write-behind operation holds in memory.
+    :rtype: int
+    '''
+
+    if operation[0] != 'put':
+        return 0
+    # Inline payloads are also copied into the document
+    return len(operation[4]) + len(operation[3].get('data') or b'')
+
+
+def apply_writes(database,
+                 collection,
+                 operations,
+                 deduplicate=False,
+                 chunk_size=None):
+    '''Apply a batch of write-behind operations with a single ordered
+    bulk_write, then release the GridFS files the batch replaced.
+    :param list operations: ``('put', query, doc, doc_with_crypto, bytes)``
+        and ``('update', query, update)`` tuples in submission order
+    :param bool deduplicate: Store payloads as shared blobs
+    :param int chunk_size: GridFS chunk size, None for the default
+    '''
+
+    file_storage = get_bucket(gridfs.GridFSBucket, database, chunk_size)
+    requests = []
+    written = {}
+    queries = {}
+    stale = []
+
+    for operation in operations:
+        if operation[0] == 'put':
+            _, query, doc, doc_with_crypto, contents = operation
+            path = query['path']
+            if 'data' not in doc_with_crypto and deduplicate:
+                doc_with_crypto['file_id'] = blobs.put_shared(
+                    database, collection.name, contents
+                )
+            if 'data' not in doc_with_crypto and \
+                    doc_with_crypto.get('file_id') is None:
+                # Not deduplicated, or the blob could not be shared
+                doc_with_crypto['file_id'] = file_storage.upload_from_stream(
+                    path, contents, metadata=doc
+                )
+            if written.get(path) is not None:
+                stale.append(written[path])
+            written[path] = doc_with_crypto.get('file_id')
+            queries[path] = query
+            requests.append(ReplaceOne(query, doc_with_crypto, upsert=True))
+        else:
+            _, query, update = operation
+            requests.append(UpdateOne(query, update))
+
+    if written:
+        previous = collection.find({
+            '$or': list(queries.values()),
+            'file_id': {'$ne': None},
+        }, {'path': True, 'file_id': True})
+        stale.extend(
+            doc['file_id'] for doc in previous
+            if doc['file_id'] != written[doc['path']] or
+            blobs.is_shared(doc['file_id'])
+        )
+
+    collection.bulk_write(requests, ordered=True)
+
+    for file_id in stale:
+        blobs.release(database, file_id)
 
 
 class Storage(BaseStorage):
 
+    '''breaker stops calling MongoDB while it fails, see get_breaker.
+    '''
+    breaker = None
+
+    '''metrics_prefix names the metrics sent to context.metrics.
+    '''
+    metrics_prefix = 'mongodb_storage'
+
+    '''write_behind queues the writes of the process when enabled, see
+    get_write_behind.
+    '''
+    write_behind = None
+
+    '''bucket_class reads and writes GridFS files, see get_bucket.
+    '''
+    bucket_class = gridfs.GridFSBucket
+
+    '''miss_cache remembers the paths recently found missing in the
+    process, see get_miss_cache.
+    '''
+    miss_cache = None
+
+    '''disk_cache keeps GridFS payloads on the local disk, see
+    get_disk_cache.
+    '''
+    disk_cache = None
+
     def __init__(self, context):
         '''Initialize the MongoStorage
 
         :param thumbor.context.Context shared_client: Current context
         '''
         BaseStorage.__init__(self, context)
+        if self.context.config.get('MONGO_COMMAND_MONITORING', False):
+            install_monitoring(self.context.metrics)
         self.database, self.storage = self.__conn__()
+        self.read_database, self.reader = self.read_connection()
+        schedule_sweep(
+            self.database,
+            self.storage,
+            self.context.config.get(
+                'MONGO_STORAGE_ORPHAN_SWEEP_INTERVAL',
+                DEFAULT_ORPHAN_SWEEP_INTERVAL
+            ),
+            owned_files(['path'], self.storage)
+        )
+        partitioning = self.get_partitioning()
+        if partitioning is not None:
+            periods.schedule_drops(
+                self.database, self.storage.name, *partitioning
+            )
         super(Storage, self).__init__(context)
 
     def __conn__(self):
@@ -37,14 +175,181 @@ class Storage(BaseStorage):
             port=self.context.config.MONGO_STORAGE_SERVER_PORT,
             db_name=self.context.config.MONGO_STORAGE_SERVER_DB,
             coll_name=
-            self.context.config.MONGO_STORAGE_SERVER_COLLECTION
+            self.context.config.MONGO_STORAGE_SERVER_COLLECTION,
+            hashed_keys=self.uses_hashed_keys(),
+            sharded=self.is_sharded(),
+            ensure_indexes=self.context.config.get(
+                'MONGO_STORAGE_ENSURE_INDEXES', True
+            ),
+            breaker=self.get_breaker(),
+            **client_options(
+                self.context.config, 'MONGO_STORAGE',
+                worker_processes(self.context)
+            )
         )
 
         database = mongo_conn.db_conn
         storage = mongo_conn.coll_conn
+        self.index_specs = mongo_conn.index_specs()
 
         return database, storage
 
+    def read_connection(self):
+        '''Return the database and collection reads go to, routed by
+        MONGO_STORAGE_READ_PREFERENCE. Writes always go to the primary.
+        :returns: MongoDB DB and Collection
+        :rtype: pymongo.database.Database, pymongo.database.Collection
+        '''
+
+        preference = read_preference(self.context.config, 'MONGO_STORAGE')
+        if preference is None:
+            return self.database, self.storage
+
+        database = self.database.client.get_database(
+            self.database.name, read_preference=preference
+        )
+        return database, database[self.storage.name]
+
+    def is_sharded(self):
+        '''Tell whether the collection is sharded on the hashed path, see
+        MONGO_STORAGE_SHARDED.
+        :rtype: bool
+        '''
+
+        return self.context.config.get('MONGO_STORAGE_SHARDED', False)
+
+    def uses_hashed_keys(self):
+        '''Tell whether images are indexed by the digest of their path
+        rather than the path itself. Sharded collections always are.
+        :rtype: bool
+        '''
+
+        return self.is_sharded() or self.context.config.get(
+            'MONGO_STORAGE_HASHED_KEYS', False
+        )
+
+    def get_partitioning(self):
+        '''Return the period length and expiration of time-partitioned
+        collections, see MONGO_STORAGE_PARTITIONED and
+        tc_mongodb.mongodb.periods. Periods last
+        MONGO_STORAGE_PARTITION_SECONDS, the expiration by default.
+        :returns: (length, max_age) in seconds, None when disabled
+        :rtype: tuple
+        '''
+
+        config = self.context.config
+        max_age = self.get_max_age()
+        if not config.get('MONGO_STORAGE_PARTITIONED', False) or \
+                not max_age or max_age <= 0:
+            # Images that never expire can't be dropped with their period
+            return None
+
+        length = config.get('MONGO_STORAGE_PARTITION_SECONDS', None)
+        return periods.check_partitioning(
+            'MONGO_STORAGE', length or max_age, max_age
+        )
+
+    def read_collections(self):
+        '''Return the collections reads look an image up in, newest
+        period first when partitioned.
+        :rtype: list
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            return [self.reader]
+        return [
+            self.read_database[name] for name in
+            periods.live_partitions(self.storage.name, *partitioning)
+        ]
+
+    def write_collections(self):
+        '''Return the collections updates and removals look an image up
+        in, newest period first when partitioned.
+        :rtype: list
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            return [self.storage]
+        return [
+            self.database[name] for name in
+            periods.live_partitions(self.storage.name, *partitioning)
+        ]
+
+    def current_collection(self):
+        '''Return the collection new images are written to, the one of
+        the current period when partitioned.
+        :rtype: pymongo.collection.Collection
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            return self.storage
+
+        collection = self.database[periods.partition_name(
+            self.storage.name, periods.period_start(partitioning[0])
+        )]
+        periods.ensure_indexes(collection, self.index_specs)
+        return collection
+
+    def bucket_name(self, collection):
+        '''Return the GridFS bucket of the payloads of collection.'''
+
+        return 'fs' if self.get_partitioning() is None else collection.name
+
+    def find_live(self, query, projection=None):
+        '''Return the newest document matching query.
+        :rtype: dict
+        '''
+
+        for collection in self.read_collections():
+            doc = collection.find_one(query, projection)
+            if doc is not None:
+                return doc
+        return None
+
+    def find_many(self, paths, projection):
+        '''Return the newest documents of paths, with one query per
+        collection.
+        :param list paths: Distinct image paths
+        :param dict projection: Fields to return, along with the path
+        :returns: Documents by path
+        :rtype: dict
+        '''
+
+        projection = dict(projection, path=True)
+        hashed = self.uses_hashed_keys()
+        found = {}
+        for collection in self.read_collections():
+            missing = [path for path in paths if path not in found]
+            if not missing:
+                break
+            for doc in collection.find(
+                    keys.lookup_many('path', missing, hashed), projection):
+                found.setdefault(doc['path'], doc)
+        return found
+
+    def update_live(self, query, update):
+        for collection in self.write_collections():
+            if collection.update_one(query, update).matched_count:
+                return
+
+    def lookup(self, path):
+        '''Return the query of the image document of path.
+        :rtype: dict
+        '''
+
+        return keys.lookup('path', path, self.uses_hashed_keys())
+
+    def incr(self, name, value=1):
+        self.context.metrics.incr('%s.%s' % (self.metrics_prefix, name), value)
+
+    def timing(self, name, value):
+        self.context.metrics.timing(
+            '%s.%s' % (self.metrics_prefix, name), value
+        )
+
     def on_mongodb_error(self, fname, exc_type, exc_value):
         '''Callback executed when there is a redis error.
         :param string fname: Function name that was being called.
@@ -53,8 +358,16 @@ class Storage(BaseStorage):
         :returns: Default value or raise the current exception
         '''
 
+        circuit_open = isinstance(exc_value, CircuitOpenError)
+        if circuit_open:
+            self.incr('circuit_open.%s' % fname.lstrip('_'))
+        else:
+            self.incr('errors.%s' % fname.lstrip('_'))
+
         if self.context.config.MONGODB_STORAGE_IGNORE_ERRORS:
-            logger.error("[MONGODB_STORAGE] %s,%s" % exc_type, exc_value)
+            # The breaker logged why it opened
+            if not circuit_open:
+                logger.error("[MONGODB_STORAGE] %s,%s", exc_type, exc_value)
             if fname == '_exists':
                 return False
             return None
@@ -69,12 +382,54 @@ class Storage(BaseStorage):
 
         return self.context.config.STORAGE_EXPIRATION_SECONDS
 
-    @OnException(on_mongodb_error, PyMongoError)
-    def put(self, path, bytes):
-        doc = {
-            'path': path,
-            'created_at': datetime.utcnow()
-        }
+    def get_expiration(self, created_at):
+        '''Return when an image stored at created_at expires.
+        :param datetime.datetime created_at: Storage date
+        :returns: Expiration date, None if images never expire
+        :rtype: datetime.datetime
+        '''
+
+        max_age = self.get_max_age()
+        if not max_age:
+            return None
+        return created_at + timedelta(seconds=max_age)
+
+    def is_document_expired(self, doc):
+        '''Tell whether a stored document has expired. The TTL monitor
+        only runs once a minute, so expired documents can still be read.
+        :param dict doc: Document with its created_at and expires_at
+        :rtype: bool
+        '''
+
+        expires_at = doc.get('expires_at') or \
+            self.get_expiration(doc['created_at'])
+        return expires_at is not None and expires_at <= datetime.utcnow()
+
+    def get_inline_max_size(self):
+        '''Return the largest payload stored inline in the image document.
+        Bigger payloads go to GridFS.
+        :returns: Size in bytes, 0 stores everything in GridFS
+        :rtype: int
+        '''
+
+        return self.context.config.get(
+            'MONGO_STORAGE_INLINE_MAX_SIZE', DEFAULT_INLINE_MAX_SIZE
+        )
+
+    def build_documents(self, path, bytes):
+        '''Return the GridFS file fields and the image document of a put.
+        Payloads up to the inline size are embedded in the image document.
+        :param string path: Image path
+        :param bytes: Image payload
+        :rtype: tuple
+        '''
+
+        doc = self.lookup(path)
+        doc['created_at'] = datetime.utcnow()
+
+        expires_at = self.get_expiration(doc['created_at'])
+        if expires_at is not None:
+            doc['expires_at'] = expires_at
 
         doc_with_crypto = dict(doc)
         if self.context.config.STORES_CRYPTO_KEY_FOR_EACH_IMAGE:
@@ -84,13 +439,262 @@ class Storage(BaseStorage):
                         if no SECURITY_KEY specified")
             doc_with_crypto['crypto'] = self.context.server.security_key
 
-        file_storage = gridfs.GridFS(self.database)
-        file_data = file_storage.put(bytes, **doc)
+        if len(bytes) <= self.get_inline_max_size():
+            doc_with_crypto['data'] = Binary(bytes)
+
+        return doc, doc_with_crypto
+
+    def deduplicates(self):
+        '''Tell whether GridFS payloads are shared by content, see
+        tc_mongodb.mongodb.blobs.
+        :rtype: bool
+        '''
+
+        # Shared files outlive the partitions referencing them
+        return self.get_partitioning() is None and \
+            self.context.config.get('MONGO_STORAGE_DEDUPLICATE', False)
+
+    def get_miss_cache(self):
+        '''Return the process-wide cache of recent misses, bounded by
+        MONGO_STORAGE_MISS_CACHE_SIZE paths.
+        :returns: The cache, None when disabled
+        :rtype: tc_mongodb.lru_cache.LRUCache
+        '''
+
+        max_size = self.context.config.get('MONGO_STORAGE_MISS_CACHE_SIZE', 0)
+        if not max_size:
+            return None
+
+        if Storage.miss_cache is None:
+            Storage.miss_cache = LRUCache(max_size, sizeof=lambda value: 1)
+        return Storage.miss_cache
+
+    def is_known_miss(self, path):
+        cache = self.get_miss_cache()
+        return cache is not None and cache.get(path, False)
+
+    def remember_miss(self, path):
+        '''Answer lookups of path as misses for MONGO_STORAGE_MISS_CACHE_TTL
+        seconds, or until this process stores it.
+        '''
+
+        cache = self.get_miss_cache()
+        if cache is not None:
+            cache.set(path, True, self.context.config.get(
+                'MONGO_STORAGE_MISS_CACHE_TTL', DEFAULT_MISS_CACHE_TTL
+            ))
 
-        doc_with_crypto['file_id'] = file_data
-        self.storage.insert_one(doc_with_crypto)
+    def forget_miss(self, path):
+        cache = self.get_miss_cache()
+        if cache is not None:
+            cache.delete(path)
+
+    def get_bucket(self, database, bucket_name='fs'):
+        '''Return the process-wide GridFS bucket of database. New files are
+        split in chunks of MONGO_STORAGE_CHUNK_SIZE bytes.
+        :rtype: gridfs.GridFSBucket
+        '''
+
+        return get_bucket(
+            self.bucket_class,
+            database,
+            self.context.config.get('MONGO_STORAGE_CHUNK_SIZE', None),
+            bucket_name
+        )
+
+    def get_disk_cache(self):
+        '''Return the process-wide cache of GridFS payloads in
+        MONGO_STORAGE_DISK_CACHE_PATH, bounded by
+        MONGO_STORAGE_DISK_CACHE_SIZE bytes. GridFS files never change, so
+        entries are keyed by file id and need no invalidation.
+        :returns: The cache, None when disabled
+        :rtype: tc_mongodb.disk_cache.DiskCache
+        '''
+
+        directory = self.context.config.get(
+            'MONGO_STORAGE_DISK_CACHE_PATH', None
+        )
+        if not directory:
+            return None
+
+        if Storage.disk_cache is None:
+            Storage.disk_cache = DiskCache(
+                directory,
+                self.context.config.get(
+                    'MONGO_STORAGE_DISK_CACHE_SIZE', DEFAULT_DISK_CACHE_SIZE
+                )
+            )
+        return Storage.disk_cache
+
+    def get_breaker(self):
+        '''Return the process-wide circuit breaker, opened after
+        MONGO_STORAGE_CIRCUIT_BREAKER_THRESHOLD consecutive connection
+        failures or timeouts for MONGO_STORAGE_CIRCUIT_BREAKER_COOLDOWN
+        seconds.
+        :returns: The breaker, None when disabled
+        :rtype: tc_mongodb.utils.CircuitBreaker
+        '''
+
+        threshold = self.context.config.get(
+            'MONGO_STORAGE_CIRCUIT_BREAKER_THRESHOLD', 0
+        )
+        if not threshold:
+            return None
+
+        if Storage.breaker is None:
+            Storage.breaker = CircuitBreaker(
+                threshold,
+                self.context.config.get(
+                    'MONGO_STORAGE_CIRCUIT_BREAKER_COOLDOWN',
+                    DEFAULT_CIRCUIT_BREAKER_COOLDOWN
+                )
+            )
+        return Storage.breaker
+
+    def get_write_behind(self):
+        '''Return the process-wide write-behind queue.
+        :returns: The queue, None when MONGO_STORAGE_WRITE_BEHIND is off
+        :rtype: tc_mongodb.write_behind.WriteBehindQueue
+        '''
+
+        config = self.context.config
+        if not config.get('MONGO_STORAGE_WRITE_BEHIND', False) or \
+                self.get_partitioning() is not None:
+            # Queued writes would land in the period they are flushed in
+            return None
+
+        if Storage.write_behind is None:
+            # The worker thread uses pymongo even behind Motor
+            database = getattr(self.database, 'delegate', self.database)
+            collection = getattr(self.storage, 'delegate', self.storage)
+
+            write_concern = config.get('MONGO_STORAGE_WRITE_CONCERN', None)
+            if write_concern is not None:
+                write_concern = WriteConcern(**write_concern)
+                database = database.client.get_database(
+                    database.name, write_concern=write_concern
+                )
+                collection = collection.with_options(
+                    write_concern=write_concern
+                )
+
+            Storage.write_behind = WriteBehindQueue(
+                functools.partial(
+                    apply_writes, database, collection,
+                    deduplicate=self.deduplicates(),
+                    chunk_size=config.get('MONGO_STORAGE_CHUNK_SIZE', None)
+                ),
+                max_size=config.get(
+                    'MONGO_STORAGE_WRITE_BEHIND_QUEUE_SIZE', 10000
+                ),
+                batch_size=config.get(
+                    'MONGO_STORAGE_WRITE_BEHIND_BATCH_SIZE', 100
+                ),
+                interval=config.get(
+                    'MONGO_STORAGE_WRITE_BEHIND_INTERVAL', 1.0
+                ),
+                policy=config.get('MONGO_STORAGE_WRITE_BEHIND_POLICY', DROP),
+                max_bytes=config.get(
+                    'MONGO_STORAGE_WRITE_BEHIND_MAX_BYTES',
+                    DEFAULT_WRITE_BEHIND_MAX_BYTES
+                ),
+                sizeof=operation_size
+            )
+        return Storage.write_behind
+
+    @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    def put(self, path, bytes):
+        doc, doc_with_crypto = self.build_documents(path, bytes)
+        self.forget_miss(path)
+        self.incr('bytes_written', len(bytes))
+
+        write_behind = self.get_write_behind()
+        if write_behind is not None:
+            write_behind.submit(
+                ('put', self.lookup(path), doc, doc_with_crypto, bytes)
+            )
+            return
+
+        collection = self.current_collection()
+        if 'data' not in doc_with_crypto:
+            bucket_name = self.bucket_name(collection)
+            doc_with_crypto['file_id'] = self.put_file(
+                bytes, doc, bucket_name
+            )
+            if bucket_name != 'fs':
+                doc_with_crypto['bucket'] = bucket_name
+
+        previous = self.replace_document(
+            self.lookup(path), doc_with_crypto, collection
+        )
+        self.release_file(previous, doc_with_crypto.get('file_id'))
+
+    def put_file(self, bytes, doc, bucket_name='fs'):
+        '''Store a payload in GridFS.
+        :param bytes: Payload
+        :param dict doc: Fields of the file, unless shared by content
+        :param string bucket_name: Bucket of files that are not shared
+        :returns: The file id
+        '''
+
+        if self.deduplicates():
+            file_id = blobs.put_shared(
+                self.database, self.storage.name, bytes
+            )
+            if file_id is not None:
+                return file_id
+        file_storage = self.get_bucket(self.database, bucket_name)
+        return file_storage.upload_from_stream(
+            doc['path'], bytes, metadata=doc
+        )
+
+    def replace_document(self, query, doc, collection=None):
+        '''Atomically replace the document matching query, inserting it
+        when missing.
+        :param dict query: Unique lookup of the document
+        :param dict doc: New document
+        :param collection: Where the document lives, the storage
+            collection by default
+        :returns: The replaced document, if any
+        :rtype: dict
+        '''
+
+        if collection is None:
+            collection = self.storage
+        projection = {'file_id': True, 'bucket': True}
+
+        try:
+            return collection.find_one_and_replace(
+                query, doc, projection=projection, upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent put inserted the document first, replace it
+            return collection.find_one_and_replace(
+                query, doc, projection=projection
+            )
+
+    def release_file(self, previous, file_id=None):
+        '''Release the GridFS file of a replaced document. A shared file
+        is released even when the new document uses it too, since the put
+        took its own reference.
+        :param dict previous: Replaced document
+        :param file_id: GridFS file of the new document
+        '''
+
+        if not previous or previous.get('file_id') is None:
+            return
+        if previous['file_id'] == file_id and not blobs.is_shared(file_id):
+            return
+
+        blobs.release(
+            self.database, previous['file_id'], previous.get('bucket', 'fs')
+        )
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def put_crypto(self, path):
         if not self.context.config.STORES_CRYPTO_KEY_FOR_EACH_IMAGE:
             return None
@@ -99,22 +703,37 @@ class Storage(BaseStorage):
             raise RuntimeError("STORES_CRYPTO_KEY_FOR_EACH_IMAGE can't be \
                 True if no SECURITY_KEY specified")
 
-        self.storage.update_one(
-            {'path': path},
-            {'$set': {'crypto': self.context.server.security_key}}
-        )
+        update = {'$set': {'crypto': self.context.server.security_key}}
+
+        write_behind = self.get_write_behind()
+        if write_behind is not None:
+            write_behind.submit(('update', self.lookup(path), update))
+            return
+
+        self.update_live(self.lookup(path), update)
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def put_detector_data(self, path, data):
-        self.storage.update({'path': path}, {"$set": {"detector_data": data}})
+        update = {"$set": {"detector_data": data}}
+
+        write_behind = self.get_write_behind()
+        if write_behind is not None:
+            write_behind.submit(('update', self.lookup(path), update))
+            return
+
+        self.update_live(self.lookup(path), update)
 
     @return_future
     def get_crypto(self, path, callback):
         callback(self._get_crypto(path))
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def _get_crypto(self, path):
-        crypto = self.storage.find_one({'path': path})
+        crypto = self.find_live(self.lookup(path))
         return crypto.get('crypto') if crypto else None
 
     @return_future
@@ -122,13 +741,12 @@ class Storage(BaseStorage):
         callback(self._get_detector_data(path))
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def _get_detector_data(self, path):
-        doc = next(self.storage.find({
-            'path': path,
-            'detector_data': {'$ne': None},
-        }, {
-            'detector_data': True,
-        }).limit(1), None)
+        query = self.lookup(path)
+        query['detector_data'] = {'$ne': None}
+        doc = self.find_live(query, {'detector_data': True})
 
         return doc.get('detector_data') if doc else None
 
@@ -137,44 +755,271 @@ class Storage(BaseStorage):
         callback(self._get(path))
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def _get(self, path):
-        now = datetime.utcnow()
-        stored = next(
-            self.storage.find({
-                'path': path,
-                'created_at': {
-                    '$gte': now - timedelta(seconds=self.get_max_age())},
-            }, {'file_id': True}).limit(1), None
-        )
+        if self.is_known_miss(path):
+            self.incr('get.miss_cached')
+            return None
+
+        stored = self.find_live(self.lookup(path), {
+            'file_id': True,
+            'bucket': True,
+            'data': True,
+            'created_at': True,
+            'expires_at': True,
+        })
+
+        if not stored or self.is_document_expired(stored):
+            self.incr('get.expired' if stored else 'get.miss')
+            self.remember_miss(path)
+            return None
+
+        if stored.get('data') is not None:
+            contents = bytes(stored['data'])
+        else:
+            contents = self.read_file(
+                stored['file_id'], stored.get('bucket', 'fs')
+            )
+            if contents is None:
+                # Replaced by a concurrent put between both reads
+                self.incr('get.miss')
+                self.remember_miss(path)
+                return None
+
+        self.incr('get.hit')
+        self.incr('bytes_read', len(contents))
+        return contents
+
+    @timed
+    def read_file(self, file_id, bucket_name='fs'):
+        '''Return the payload of a GridFS file, from the disk cache when
+        enabled.
+        :param string bucket_name: Bucket holding the file
+        :returns: The payload, None if the file is gone
+        :rtype: bytes
+        '''
+
+        disk_cache = self.get_disk_cache()
+        if disk_cache is not None:
+            contents = disk_cache.get(str(file_id))
+            self.incr('disk_cache.hit' if contents is not None
+                      else 'disk_cache.miss')
+            if contents is not None:
+                return contents
 
-        if not stored:
+        file_storage = self.get_bucket(self.read_database, bucket_name)
+        try:
+            contents = read_stream(file_storage.open_download_stream(file_id))
+        except gridfs.NoFile:
             return None
 
-        file_storage = gridfs.GridFS(self.database)
+        if disk_cache is not None:
+            disk_cache.set(str(file_id), contents)
+        return contents
+
+    def split_cached(self, docs):
+        '''Return the payloads of GridFS documents found in the disk cache,
+        and the file ids left to read by bucket.
+        :rtype: tuple
+        '''
+
+        disk_cache = self.get_disk_cache()
+        contents = {}
+        missing = {}
+        for doc in docs:
+            file_id = doc['file_id']
+            if disk_cache is not None:
+                cached = disk_cache.get(str(file_id))
+                self.incr('disk_cache.hit' if cached is not None
+                          else 'disk_cache.miss')
+                if cached is not None:
+                    contents[file_id] = cached
+                    continue
+            missing.setdefault(doc.get('bucket', 'fs'), []).append(file_id)
+        return contents, missing
+
+    def cache_files(self, contents):
+        disk_cache = self.get_disk_cache()
+        if disk_cache is not None:
+            for file_id, data in contents.items():
+                disk_cache.set(str(file_id), data)
+
+    @timed
+    def read_payloads(self, docs):
+        '''Return the payloads of GridFS documents, from the disk cache
+        when enabled, in two queries per bucket.
+        :param list docs: Documents with their file_id and bucket
+        :returns: Payloads by file id, without the files gone
+        :rtype: dict
+        '''
+
+        contents, missing = self.split_cached(docs)
+        for bucket_name, file_ids in missing.items():
+            read = read_files(self.read_database, file_ids, bucket_name)
+            self.cache_files(read)
+            contents.update(read)
+        return contents
+
+    def unknown_paths(self, paths, operation):
+        '''Return the distinct paths not known to be missing, counting the
+        known misses of operation.
+        :rtype: list
+        '''
+
+        unknown = []
+        seen = set()
+        for path in paths:
+            if self.is_known_miss(path):
+                self.incr(operation + '.miss_cached')
+            elif path not in seen:
+                seen.add(path)
+                unknown.append(path)
+        return unknown
 
-        contents = file_storage.get(stored['file_id']).read()
+    def live_documents(self, paths, docs, operation):
+        '''Return the documents of paths that have not expired, counting
+        and remembering the misses of operation.
+        :param dict docs: Documents by path
+        :returns: Documents by path
+        :rtype: dict
+        '''
+
+        live = {}
+        for path in paths:
+            stored = docs.get(path)
+            if stored is None or self.is_document_expired(stored):
+                self.incr(operation + ('.expired' if stored else '.miss'))
+                self.remember_miss(path)
+            else:
+                live[path] = stored
+        return live
+
+    def payloads(self, live, files):
+        '''Return the payloads of live documents by path, counting hits
+        and the documents whose file is gone.
+        :param dict live: Documents by path
+        :param dict files: GridFS payloads by file id
+        :rtype: dict
+        '''
+
+        contents = {}
+        for path, stored in live.items():
+            if stored.get('data') is not None:
+                data = bytes(stored['data'])
+            else:
+                data = files.get(stored['file_id'])
+            if data is None:
+                # Replaced by a concurrent put between both reads
+                self.incr('get.miss')
+                self.remember_miss(path)
+                continue
+            self.incr('get.hit')
+            self.incr('bytes_read', len(data))
+            contents[path] = data
         return contents
 
+    @return_future
+    def get_many(self, paths, callback):
+        '''Return the payloads of paths in the same order, None for the
+        missing ones, with one query per collection and two per GridFS
+        bucket.
+        :param list paths: Image paths
+        :rtype: list
+        '''
+
+        paths = list(paths)
+        found = self._get_many(paths)
+        callback(found if found is not None else [None] * len(paths))
+
+    @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    def _get_many(self, paths):
+        unknown = self.unknown_paths(paths, 'get')
+        live = self.live_documents(unknown, self.find_many(unknown, {
+            'file_id': True,
+            'bucket': True,
+            'data': True,
+            'created_at': True,
+            'expires_at': True,
+        }), 'get')
+        files = self.read_payloads(
+            [doc for doc in live.values() if doc.get('data') is None]
+        )
+        contents = self.payloads(live, files)
+        return [contents.get(path) for path in paths]
+
+    @return_future
+    def exists_many(self, paths, callback):
+        '''Tell whether each of paths is stored, in the same order, with one
+        query per collection.
+        :param list paths: Image paths
+        :rtype: list
+        '''
+
+        paths = list(paths)
+        found = self._exists_many(paths)
+        callback(found if found is not None else [False] * len(paths))
+
+    @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    def _exists_many(self, paths):
+        unknown = self.unknown_paths(paths, 'exists')
+        live = self.live_documents(unknown, self.find_many(unknown, {
+            'created_at': True,
+            'expires_at': True,
+        }), 'exists')
+        if live:
+            self.incr('exists.hit', len(live))
+        return [path in live for path in paths]
+
     @return_future
     def exists(self, path, callback):
         callback(self._exists(path))
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def _exists(self, path):
-        return self.storage.find({
-            'path': path,
-            'created_at': {
-                '$gte':
-                    datetime.utcnow() - timedelta(seconds=self.get_max_age())
-            },
-        }).limit(1).count() >= 1
+        if self.is_known_miss(path):
+            self.incr('exists.miss_cached')
+            return False
+
+        stored = self.find_live(self.lookup(path), {
+            'created_at': True,
+            'expires_at': True,
+        })
+        if stored is None or self.is_document_expired(stored):
+            self.incr('exists.expired' if stored else 'exists.miss')
+            self.remember_miss(path)
+            return False
+        self.incr('exists.hit')
+        return True
 
     @OnException(on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
     def remove(self, path):
-        self.storage.delete_many({'path': path})
+        '''Delete the documents of path and release their GridFS files.
+        Images stored before documents were upserted can have several.
+        '''
+
+        for collection in self.write_collections():
+            while True:
+                stored = collection.find_one_and_delete(
+                    self.lookup(path),
+                    projection={'file_id': True, 'bucket': True}
+                )
+                if stored is None:
+                    break
+                self.release_file(stored)
+
+
+def forget_write_behind():
+    # The worker thread of the parent does not run in forked children
+    Storage.write_behind = None
+
 
-        file_storage = gridfs.GridFS(self.database)
-        file_datas = file_storage.find({'path': path})
-        if file_datas:
-            for file_data in file_datas:
-                file_storage.delete(file_data._id)
+on_fork(forget_write_behind)
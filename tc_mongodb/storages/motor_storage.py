@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+# Copyright (c) 2011 globo.com timehome@corp.globo.com
+
+from motor.motor_tornado import MotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tc_mongodb.utils import OnException, SingleFlight, guarded, timed
+from tc_mongodb.mongodb import blobs, keys, periods
+from tc_mongodb.mongodb.buckets import read_files, read_motor_stream
+from tc_mongodb.mongodb.registry import client_options, worker_processes
+from tc_mongodb.mongodb.connector_motor_storage import MongoConnector
+from tc_mongodb.storages.mongo_storage import Storage as MongoStorage
+
+
+class Storage(MongoStorage):
+    '''Non-blocking MongoDB storage backed by Motor.
+
+    Every round-trip yields to the IOLoop, so lookups issued by concurrent
+    requests share the connection pool instead of being serialized by
+    blocking pymongo calls.
+    '''
+
+    '''inflight coalesces concurrent reads of the same path in the process.
+    '''
+    inflight = SingleFlight()
+
+    bucket_class = MotorGridFSBucket
+
+    def __conn__(self):
+        '''Return the Motor database and collection object.
+        :returns: Motor DB and Collection
+        :rtype: motor.motor_tornado.MotorDatabase,
+                motor.motor_tornado.MotorCollection
+        '''
+
+        mongo_conn = MongoConnector(
+            uri=self.context.config.MONGO_STORAGE_URI,
+            host=self.context.config.MONGO_STORAGE_SERVER_HOST,
+            port=self.context.config.MONGO_STORAGE_SERVER_PORT,
+            db_name=self.context.config.MONGO_STORAGE_SERVER_DB,
+            coll_name=
+            self.context.config.MONGO_STORAGE_SERVER_COLLECTION,
+            hashed_keys=self.uses_hashed_keys(),
+            sharded=self.is_sharded(),
+            ensure_indexes=self.context.config.get(
+                'MONGO_STORAGE_ENSURE_INDEXES', True
+            ),
+            **client_options(
+                self.context.config, 'MONGO_STORAGE',
+                worker_processes(self.context)
+            )
+        )
+
+        database = mongo_conn.db_conn
+        storage = mongo_conn.coll_conn
+        self.index_specs = mongo_conn.index_specs()
+
+        return database, storage
+
+    @gen.coroutine
+    def current_collection(self):
+        '''Return the collection new images are written to, the one of
+        the current period when partitioned. Partition indexes are created
+        with pymongo on the executor.
+        :rtype: motor.motor_tornado.MotorCollection
+        '''
+
+        partitioning = self.get_partitioning()
+        if partitioning is None:
+            raise gen.Return(self.storage)
+
+        collection = self.database[periods.partition_name(
+            self.storage.name, periods.period_start(partitioning[0])
+        )]
+        if periods.claim_indexes(collection.delegate):
+            yield IOLoop.current().run_in_executor(
+                None, periods.create_indexes,
+                collection.delegate, self.index_specs
+            )
+        raise gen.Return(collection)
+
+    @gen.coroutine
+    def find_live(self, query, projection=None):
+        '''Return the newest document matching query.
+        :rtype: dict
+        '''
+
+        for collection in self.read_collections():
+            doc = yield collection.find_one(query, projection)
+            if doc is not None:
+                raise gen.Return(doc)
+        raise gen.Return(None)
+
+    @gen.coroutine
+    def find_many(self, paths, projection):
+        '''Return the newest documents of paths, with one query per
+        collection.
+        :param list paths: Distinct image paths
+        :param dict projection: Fields to return, along with the path
+        :returns: Documents by path
+        :rtype: dict
+        '''
+
+        projection = dict(projection, path=True)
+        hashed = self.uses_hashed_keys()
+        found = {}
+        for collection in self.read_collections():
+            missing = [path for path in paths if path not in found]
+            if not missing:
+                break
+            docs = yield collection.find(
+                keys.lookup_many('path', missing, hashed), projection
+            ).to_list(None)
+            for doc in docs:
+                found.setdefault(doc['path'], doc)
+        raise gen.Return(found)
+
+    @gen.coroutine
+    def update_live(self, query, update):
+        for collection in self.write_collections():
+            result = yield collection.update_one(query, update)
+            if result.matched_count:
+                return
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def put(self, path, bytes):
+        doc, doc_with_crypto = self.build_documents(path, bytes)
+        self.forget_miss(path)
+        self.incr('bytes_written', len(bytes))
+
+        write_behind = self.get_write_behind()
+        if write_behind is not None:
+            write_behind.submit(
+                ('put', self.lookup(path), doc, doc_with_crypto, bytes)
+            )
+            return
+
+        collection = yield self.current_collection()
+        if 'data' not in doc_with_crypto:
+            bucket_name = self.bucket_name(collection)
+            doc_with_crypto['file_id'] = yield self.put_file(
+                bytes, doc, bucket_name
+            )
+            if bucket_name != 'fs':
+                doc_with_crypto['bucket'] = bucket_name
+
+        previous = yield self.replace_document(
+            self.lookup(path), doc_with_crypto, collection
+        )
+        yield self.release_file(previous, doc_with_crypto.get('file_id'))
+
+    @gen.coroutine
+    def put_file(self, bytes, doc, bucket_name='fs'):
+        '''Store a payload in GridFS. Shared blobs are reference counted
+        with pymongo on the executor.
+        :param bytes: Payload
+        :param dict doc: Metadata of the file, unless shared by content
+        :param string bucket_name: Bucket of files that are not shared
+        :returns: The file id
+        '''
+
+        file_id = None
+        if self.deduplicates():
+            file_id = yield IOLoop.current().run_in_executor(
+                None, blobs.put_shared,
+                self.database.delegate, self.storage.name, bytes
+            )
+        if file_id is None:
+            # Not deduplicated, or the blob could not be shared
+            file_storage = self.get_bucket(self.database, bucket_name)
+            file_id = yield file_storage.upload_from_stream(
+                doc['path'], bytes, metadata=doc
+            )
+        raise gen.Return(file_id)
+
+    @gen.coroutine
+    def replace_document(self, query, doc, collection=None):
+        '''Atomically replace the document matching query, inserting it
+        when missing.
+        :param dict query: Unique lookup of the document
+        :param dict doc: New document
+        :param collection: Where the document lives, the storage
+            collection by default
+        :returns: The replaced document, if any
+        :rtype: dict
+        '''
+
+        if collection is None:
+            collection = self.storage
+        projection = {'file_id': True, 'bucket': True}
+
+        try:
+            previous = yield collection.find_one_and_replace(
+                query, doc, projection=projection, upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent put inserted the document first, replace it
+            previous = yield collection.find_one_and_replace(
+                query, doc, projection=projection
+            )
+        raise gen.Return(previous)
+
+    @gen.coroutine
+    def release_file(self, previous, file_id=None):
+        '''Release the GridFS file of a replaced document. A shared file
+        is released even when the new document uses it too, since the put
+        took its own reference.
+        :param dict previous: Replaced document
+        :param file_id: GridFS file of the new document
+        '''
+
+        if not previous or previous.get('file_id') is None:
+            return
+        if previous['file_id'] == file_id and not blobs.is_shared(file_id):
+            return
+
+        if blobs.is_shared(previous['file_id']):
+            yield IOLoop.current().run_in_executor(
+                None, blobs.release,
+                self.database.delegate, previous['file_id']
+            )
+            return
+
+        file_storage = self.get_bucket(
+            self.database, previous.get('bucket', 'fs')
+        )
+        try:
+            yield file_storage.delete(previous['file_id'])
+        except NoFile:
+            pass
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def put_crypto(self, path):
+        if not self.context.config.STORES_CRYPTO_KEY_FOR_EACH_IMAGE:
+            raise gen.Return(None)
+
+        if not self.context.server.security_key:
+            raise RuntimeError("STORES_CRYPTO_KEY_FOR_EACH_IMAGE can't be \
+                True if no SECURITY_KEY specified")
+
+        update = {'$set': {'crypto': self.context.server.security_key}}
+
+        write_behind = self.get_write_behind()
+        if write_behind is not None:
+            write_behind.submit(('update', self.lookup(path), update))
+            return
+
+        yield self.update_live(self.lookup(path), update)
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def put_detector_data(self, path, data):
+        update = {"$set": {"detector_data": data}}
+
+        write_behind = self.get_write_behind()
+        if write_behind is not None:
+            write_behind.submit(('update', self.lookup(path), update))
+            return
+
+        yield self.update_live(self.lookup(path), update)
+
+    def get_crypto(self, path):
+        return self._get_crypto(path)
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _get_crypto(self, path):
+        crypto = yield self.find_live(self.lookup(path))
+        raise gen.Return(crypto.get('crypto') if crypto else None)
+
+    def get_detector_data(self, path):
+        return self._get_detector_data(path)
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _get_detector_data(self, path):
+        query = self.lookup(path)
+        query['detector_data'] = {'$ne': None}
+        doc = yield self.find_live(query, {'detector_data': True})
+
+        raise gen.Return(doc.get('detector_data') if doc else None)
+
+    def get(self, path):
+        return self.inflight.do(
+            ('get', self.storage.full_name, path), self._get, path
+        )
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _get(self, path):
+        if self.is_known_miss(path):
+            self.incr('get.miss_cached')
+            raise gen.Return(None)
+
+        stored = yield self.find_live(self.lookup(path), {
+            'file_id': True,
+            'bucket': True,
+            'data': True,
+            'created_at': True,
+            'expires_at': True,
+        })
+
+        if not stored or self.is_document_expired(stored):
+            self.incr('get.expired' if stored else 'get.miss')
+            self.remember_miss(path)
+            raise gen.Return(None)
+
+        if stored.get('data') is not None:
+            contents = bytes(stored['data'])
+        else:
+            contents = yield self.read_file(
+                stored['file_id'], stored.get('bucket', 'fs')
+            )
+            if contents is None:
+                # Replaced by a concurrent put between both reads
+                self.incr('get.miss')
+                self.remember_miss(path)
+                raise gen.Return(None)
+
+        self.incr('get.hit')
+        self.incr('bytes_read', len(contents))
+        raise gen.Return(contents)
+
+    @timed
+    @gen.coroutine
+    def read_file(self, file_id, bucket_name='fs'):
+        '''Return the payload of a GridFS file, from the disk cache when
+        enabled.
+        :param string bucket_name: Bucket holding the file
+        :returns: The payload, None if the file is gone
+        :rtype: bytes
+        '''
+
+        disk_cache = self.get_disk_cache()
+        if disk_cache is not None:
+            contents = disk_cache.get(str(file_id))
+            self.incr('disk_cache.hit' if contents is not None
+                      else 'disk_cache.miss')
+            if contents is not None:
+                raise gen.Return(contents)
+
+        file_storage = self.get_bucket(self.read_database, bucket_name)
+        try:
+            grid_out = yield file_storage.open_download_stream(file_id)
+        except NoFile:
+            raise gen.Return(None)
+        contents = yield read_motor_stream(grid_out)
+
+        if disk_cache is not None:
+            disk_cache.set(str(file_id), contents)
+        raise gen.Return(contents)
+
+    @timed
+    @gen.coroutine
+    def read_payloads(self, docs):
+        '''Return the payloads of GridFS documents, from the disk cache
+        when enabled. Files are read with pymongo on the executor, in two
+        queries per bucket.
+        :param list docs: Documents with their file_id and bucket
+        :returns: Payloads by file id, without the files gone
+        :rtype: dict
+        '''
+
+        contents, missing = self.split_cached(docs)
+        for bucket_name, file_ids in missing.items():
+            read = yield IOLoop.current().run_in_executor(
+                None, read_files,
+                self.read_database.delegate, file_ids, bucket_name
+            )
+            self.cache_files(read)
+            contents.update(read)
+        raise gen.Return(contents)
+
+    @gen.coroutine
+    def get_many(self, paths):
+        paths = list(paths)
+        found = yield self._get_many(paths)
+        raise gen.Return(found if found is not None else [None] * len(paths))
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _get_many(self, paths):
+        unknown = self.unknown_paths(paths, 'get')
+        docs = yield self.find_many(unknown, {
+            'file_id': True,
+            'bucket': True,
+            'data': True,
+            'created_at': True,
+            'expires_at': True,
+        })
+        live = self.live_documents(unknown, docs, 'get')
+        files = yield self.read_payloads(
+            [doc for doc in live.values() if doc.get('data') is None]
+        )
+        contents = self.payloads(live, files)
+        raise gen.Return([contents.get(path) for path in paths])
+
+    @gen.coroutine
+    def exists_many(self, paths):
+        paths = list(paths)
+        found = yield self._exists_many(paths)
+        raise gen.Return(found if found is not None else [False] * len(paths))
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _exists_many(self, paths):
+        unknown = self.unknown_paths(paths, 'exists')
+        docs = yield self.find_many(unknown, {
+            'created_at': True,
+            'expires_at': True,
+        })
+        live = self.live_documents(unknown, docs, 'exists')
+        if live:
+            self.incr('exists.hit', len(live))
+        raise gen.Return([path in live for path in paths])
+
+    def exists(self, path):
+        return self.inflight.do(
+            ('exists', self.storage.full_name, path), self._exists, path
+        )
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def _exists(self, path):
+        if self.is_known_miss(path):
+            self.incr('exists.miss_cached')
+            raise gen.Return(False)
+
+        stored = yield self.find_live(self.lookup(path), {
+            'created_at': True,
+            'expires_at': True,
+        })
+        if stored is None or self.is_document_expired(stored):
+            self.incr('exists.expired' if stored else 'exists.miss')
+            self.remember_miss(path)
+            raise gen.Return(False)
+        self.incr('exists.hit')
+        raise gen.Return(True)
+
+    @OnException(MongoStorage.on_mongodb_error, PyMongoError)
+    @guarded
+    @timed
+    @gen.coroutine
+    def remove(self, path):
+        for collection in self.write_collections():
+            while True:
+                stored = yield collection.find_one_and_delete(
+                    self.lookup(path),
+                    projection={'file_id': True, 'bucket': True}
+                )
+                if stored is None:
+                    break
+                yield self.release_file(stored)
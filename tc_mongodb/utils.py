@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import threading
+from timeit import default_timer
+
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, PyMongoError
+from thumbor.utils import logger
+from tornado import gen
+
 
 class OnException(object):  # NOQA
 
@@ -8,27 +16,242 @@ class OnException(object):  # NOQA
         self.exception_class = exception_class
 
     def __call__(self, fn):
+        if gen.is_coroutine_function(fn):
+            return self.wrap_coroutine(fn)
+
         def wrapper(*args, **kwargs):
             self_instance = args[0] if args else None
             try:
                 return fn(*args, **kwargs)
             except self.exception_class as exc_value:
                 if self.callback:
-                    # Execute the callback and let it handle the exception
-                    if self_instance:
-                        return self.callback(
-                            self_instance,
-                            fn.__name__,
-                            self.exception_class,
-                            exc_value
-                        )
-                    else:
-                        return self.callback(
-                            fn.__name__,
-                            self.exception_class,
-                            exc_value
-                        )
+                    return self.handle(fn, self_instance, exc_value)
                 else:
                     raise
 
         return wrapper
+
+    def wrap_coroutine(self, fn):
+        '''Wrap a tornado coroutine so errors raised while its future
+        resolves are handled the same way as synchronous ones.
+        '''
+
+        @gen.coroutine
+        def wrapper(*args, **kwargs):
+            self_instance = args[0] if args else None
+            try:
+                result = yield fn(*args, **kwargs)
+            except self.exception_class as exc_value:
+                if not self.callback:
+                    raise
+                result = self.handle(fn, self_instance, exc_value)
+            raise gen.Return(result)
+
+        return wrapper
+
+    def handle(self, fn, self_instance, exc_value):
+        # Execute the callback and let it handle the exception
+        if self_instance:
+            return self.callback(
+                self_instance,
+                fn.__name__,
+                self.exception_class,
+                exc_value
+            )
+        else:
+            return self.callback(
+                fn.__name__,
+                self.exception_class,
+                exc_value
+            )
+
+
+class SingleFlight(object):
+    '''Share the future of an in-flight call among every caller asking
+    for the same key, so concurrent lookups of a key cost one round-trip.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    def do(self, key, fn, *args, **kwargs):
+        '''Return the future of the call in flight for key, or start one.
+        :param callable fn: Function returning a future
+        :returns: The shared future
+        '''
+
+        future = self.calls.get(key)
+        if future is not None:
+            return future
+
+        future = fn(*args, **kwargs)
+        self.calls[key] = future
+
+        def forget(done):
+            if self.calls.get(key) is done:
+                del self.calls[key]
+
+        future.add_done_callback(forget)
+        return future
+
+
+def timed(fn):
+    '''Report the duration of a storage method through the ``timing``
+    method of the storage, named after the method without its leading
+    underscore. Stack it under :class:`OnException`, which relies on the
+    name of the method it wraps.
+    '''
+
+    name = fn.__name__.lstrip('_')
+
+    if gen.is_coroutine_function(fn):
+        @gen.coroutine
+        @functools.wraps(fn)
+        def coroutine_wrapper(self, *args, **kwargs):
+            started = default_timer()
+            try:
+                result = yield fn(self, *args, **kwargs)
+            finally:
+                self.timing(name, (default_timer() - started) * 1000)
+            raise gen.Return(result)
+
+        return coroutine_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        started = default_timer()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            self.timing(name, (default_timer() - started) * 1000)
+
+    return wrapper
+
+
+class CircuitOpenError(PyMongoError):
+    '''Raised instead of calling MongoDB while the circuit is open.'''
+
+
+class CircuitBreaker(object):
+    '''Stop calling a failing database for a while.
+
+    After threshold consecutive failures the circuit opens and calls are
+    refused for cooldown seconds. A single call is then let through as a
+    probe: it closes the circuit when it succeeds and reopens it for
+    another cooldown when it fails.
+
+    :param int threshold: Consecutive failures opening the circuit
+    :param float cooldown: Seconds calls are refused for
+    :param tuple errors: Exceptions counted as failures, the others tell
+        the database answered
+    '''
+
+    def __init__(self, threshold, cooldown,
+                 errors=(ConnectionFailure, ExecutionTimeout)):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.errors = errors
+        self.failures = 0
+        self.opened_at = None
+        self.probing_since = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        '''Tell whether a call may go to the database, starting the probe
+        when the cooldown is over.
+        :rtype: bool
+        '''
+
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            now = default_timer()
+            if now - self.opened_at < self.cooldown:
+                return False
+            # A probe that never returned must not keep the circuit open
+            if self.probing_since is not None and \
+                    now - self.probing_since < self.cooldown:
+                return False
+            self.probing_since = now
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("[MONGODB] circuit closed, MongoDB recovered")
+            self.failures = 0
+            self.opened_at = None
+            self.probing_since = None
+
+    def failed(self, exc_value):
+        if not isinstance(exc_value, self.errors):
+            self.succeeded()
+            return
+
+        with self.lock:
+            self.failures += 1
+            self.probing_since = None
+            if self.opened_at is not None or \
+                    self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        "[MONGODB] circuit opened for %ss after %d "
+                        "failures: %s", self.cooldown, self.failures,
+                        exc_value
+                    )
+                self.opened_at = default_timer()
+
+
+def guarded(fn):
+    '''Run a storage method through the circuit breaker returned by the
+    ``get_breaker`` method of the storage, if any. While the circuit is
+    open the method raises :class:`CircuitOpenError` without reaching
+    MongoDB, so :class:`OnException` answers with its default value. Stack
+    it under :class:`OnException`.
+    '''
+
+    if gen.is_coroutine_function(fn):
+        @gen.coroutine
+        @functools.wraps(fn)
+        def coroutine_wrapper(self, *args, **kwargs):
+            breaker = self.get_breaker()
+            if breaker is None:
+                result = yield fn(self, *args, **kwargs)
+                raise gen.Return(result)
+
+            if not breaker.allow():
+                raise CircuitOpenError('MongoDB circuit is open')
+            try:
+                result = yield fn(self, *args, **kwargs)
+            except Exception as exc_value:
+                breaker.failed(exc_value)
+                raise
+            breaker.succeeded()
+            raise gen.Return(result)
+
+        return coroutine_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        breaker = self.get_breaker()
+        if breaker is None:
+            return fn(self, *args, **kwargs)
+
+        if not breaker.allow():
+            raise CircuitOpenError('MongoDB circuit is open')
+        try:
+            result = fn(self, *args, **kwargs)
+        except Exception as exc_value:
+            breaker.failed(exc_value)
+            raise
+        breaker.succeeded()
+        return result
+
+    return wrapper
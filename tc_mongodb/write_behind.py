@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import threading
+import time
+
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
+
+from thumbor.utils import logger
+
+DROP = 'drop'
+BLOCK = 'block'
+
+
+class WriteBehindQueue(object):
+    '''Acknowledge writes immediately and apply them in batches on a
+    background thread.
+
+    :param callable flush: Called with a list of queued operations
+    :param int max_size: Operations held before the policy applies
+    :param int batch_size: Most operations handed to a single flush
+    :param float interval: Seconds a partial batch waits for more writes
+    :param string policy: When the queue is full, ``drop`` new writes or
+        ``block`` the caller until the worker catches up
+    :param int max_bytes: Bytes held, queued or being flushed, before the
+        policy applies, None to only count operations
+    :param callable sizeof: Returns the bytes an operation holds
+    '''
+
+    def __init__(self,
+                 flush,
+                 max_size=10000,
+                 batch_size=100,
+                 interval=1.0,
+                 policy=DROP,
+                 max_bytes=None,
+                 sizeof=None):
+        if policy not in (DROP, BLOCK):
+            raise ValueError("Unknown write-behind policy %r" % policy)
+
+        self.flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda operation: 0)
+        self.held_bytes = 0
+        self.room = threading.Condition()
+        self.dropped = 0
+        self.queue = Queue(maxsize=max_size)
+
+        self.worker = threading.Thread(
+            target=self.run, name='tc_mongodb-write-behind'
+        )
+        self.worker.daemon = True
+        self.worker.start()
+
+    def has_room(self, size):
+        # A write bigger than the budget still goes through an empty queue
+        return not self.max_bytes or not self.held_bytes or \
+            self.held_bytes + size <= self.max_bytes
+
+    def drop(self):
+        self.dropped += 1
+        logger.warning(
+            "[MONGODB_STORAGE] write-behind queue full, dropped %d writes",
+            self.dropped
+        )
+        return False
+
+    def release(self, size):
+        with self.room:
+            self.held_bytes -= size
+            self.room.notify_all()
+
+    def submit(self, operation):
+        '''Queue an operation for the next batch.
+        :returns: Whether the operation was queued
+        :rtype: bool
+        '''
+
+        size = self.sizeof(operation)
+        with self.room:
+            if self.policy == BLOCK:
+                while not self.has_room(size):
+                    self.room.wait()
+            elif not self.has_room(size):
+                return self.drop()
+            self.held_bytes += size
+
+        if self.policy == BLOCK:
+            self.queue.put((size, operation))
+            return True
+
+        try:
+            self.queue.put_nowait((size, operation))
+        except Full:
+            self.release(size)
+            return self.drop()
+        return True
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            entries = self.next_batch()
+            batch = [operation for _, operation in entries]
+            try:
+                self.flush(batch)
+            except Exception as exc_value:
+                logger.error(
+                    "[MONGODB_STORAGE] write-behind flush of %d writes "
+                    "failed: %s", len(batch), exc_value
+                )
+            # Payloads are held until their batch is written
+            self.release(sum(size for size, _ in entries))
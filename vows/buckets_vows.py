@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from pyvows import Vows, expect
+from tc_mongodb.mongodb import buckets
+
+
+class FakeDatabase(object):
+    client = object()
+    name = 'thumbor'
+    read_preference = 'primary'
+
+
+class FakeBucket(object):
+    def __init__(self, database, **options):
+        self.database = database
+        self.options = options
+
+
+class FakeGridOut(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.length = sum(len(chunk) for chunk in self.chunks)
+
+    def readchunk(self):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+class FakeCursor(list):
+    def sort(self, keys):
+        return FakeCursor(sorted(
+            self, key=lambda doc: tuple(doc[key] for key, _ in keys)
+        ))
+
+
+class FakeCollection(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        field, condition = list(query.items())[0]
+        return FakeCursor(
+            doc for doc in self.docs if doc[field] in condition['$in']
+        )
+
+
+class FakeGridFSDatabase(dict):
+    def __init__(self, files, chunks):
+        dict.__init__(self, {
+            'fs.files': FakeCollection(files),
+            'fs.chunks': FakeCollection(chunks),
+        })
+
+
+@Vows.batch
+class BucketsVows(Vows.Context):
+    class ReusesBucketsOfADatabase(Vows.Context):
+        def topic(self):
+            database = FakeDatabase()
+            return (
+                buckets.get_bucket(FakeBucket, database),
+                buckets.get_bucket(FakeBucket, database),
+                buckets.get_bucket(FakeBucket, database, chunk_size=1024),
+            )
+
+        def should_share_a_bucket_per_chunk_size(self, topic):
+            first, second, third = topic
+            expect(first).to_equal(second)
+            expect(first).not_to_equal(third)
+            expect(third.options).to_equal({'chunk_size_bytes': 1024})
+
+    class ReadsStreamsChunkByChunk(Vows.Context):
+        def topic(self):
+            return buckets.read_stream(FakeGridOut([b'123', b'45', b'6']))
+
+        def should_join_the_chunks(self, topic):
+            expect(topic).to_equal(b'123456')
+
+    class ReadsManyFilesAtOnce(Vows.Context):
+        def topic(self):
+            database = FakeGridFSDatabase([
+                {'_id': 1, 'length': 6},
+                {'_id': 2, 'length': 2},
+                {'_id': 3, 'length': 4},
+            ], [
+                {'files_id': 1, 'n': 1, 'data': b'456'},
+                {'files_id': 2, 'n': 0, 'data': b'ab'},
+                {'files_id': 1, 'n': 0, 'data': b'123'},
+                {'files_id': 3, 'n': 0, 'data': b'xy'},
+            ])
+            return buckets.read_files(database, [1, 2, 3, 4])
+
+        def should_join_the_chunks_in_order(self, topic):
+            expect(topic[1]).to_equal(b'123456')
+            expect(topic[2]).to_equal(b'ab')
+
+        def should_skip_missing_and_incomplete_files(self, topic):
+            expect(sorted(topic)).to_equal([1, 2])
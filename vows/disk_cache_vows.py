@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import tempfile
+
+from pyvows import Vows, expect
+from tc_mongodb.disk_cache import DiskCache
+
+
+@Vows.batch
+class DiskCacheVows(Vows.Context):
+    class EvictsLeastRecentlyUsed(Vows.Context):
+        def topic(self):
+            cache = DiskCache(tempfile.mkdtemp(), 10)
+            cache.set('a', b'12345')
+            cache.set('b', b'12345')
+            cache.get('a')
+            cache.set('c', b'12345')
+            return cache
+
+        def should_keep_recently_used_entries(self, cache):
+            expect(cache.get('a')).to_equal(b'12345')
+            expect(cache.get('c')).to_equal(b'12345')
+
+        def should_evict_the_oldest_entry(self, cache):
+            expect(cache.get('b')).to_be_null()
+            expect(cache.stats()['evictions']).to_equal(1)
+
+        def should_stay_within_budget(self, cache):
+            expect(cache.size).to_equal(10)
+
+    class PicksUpFilesOfEarlierProcesses(Vows.Context):
+        def topic(self):
+            directory = tempfile.mkdtemp()
+            DiskCache(directory, 10).set('a', b'12345')
+            return DiskCache(directory, 10)
+
+        def should_read_them_back(self, cache):
+            expect(cache.size).to_equal(5)
+            expect(cache.get('a')).to_equal(b'12345')
+
+    class CanDeleteEntries(Vows.Context):
+        def topic(self):
+            cache = DiskCache(tempfile.mkdtemp(), 10)
+            cache.set('a', b'12345')
+            cache.delete('a')
+            return cache
+
+        def should_be_gone(self, cache):
+            expect(cache.get('a')).to_be_null()
+            expect(cache.size).to_equal(0)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from datetime import datetime, timedelta
+
+from pyvows import Vows, expect
+from tc_mongodb.mongodb import eviction
+
+NOW = datetime(2026, 10, 17, 13)
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(
+            self, key=lambda doc: doc.get(field) or datetime.min
+        ))
+
+    def hint(self, index):
+        expect(index).to_equal(eviction.LAST_ACCESS_INDEX)
+        return self
+
+
+class FakeResult(object):
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+
+class FakeFiles(object):
+    '''fs.files holding shared blobs and their reference counts.'''
+
+    def __init__(self, refs):
+        self.refs = refs
+        self.deleting = set()
+
+    def find_one_and_update(self, query, update, **kwargs):
+        self.refs[query['_id']] += update['$inc']['refs']
+        return {'_id': query['_id'], 'refs': self.refs[query['_id']]}
+
+    def update_one(self, query, update):
+        file_id = query['_id']
+        if self.refs[file_id] > 0 or file_id in self.deleting:
+            return FakeResult(0)
+        self.deleting.add(file_id)
+        return FakeResult(1)
+
+    def delete_many(self, query):
+        for file_id in query['_id']['$in']:
+            if file_id in self.deleting:
+                del self.refs[file_id]
+
+
+class FakeGridFSDatabase(object):
+    def __init__(self, refs):
+        self.fs = type('Bucket', (object,), {})()
+        self.fs.files = FakeFiles(refs)
+        self.fs.chunks = type('Chunks', (object,), {
+            'delete_many': lambda self, query: None
+        })()
+
+
+class FakeCollection(object):
+    full_name = 'thumbor.results'
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        sizes = {}
+        for doc in self.docs:
+            sizes.setdefault(
+                doc.get('file_id', doc['_id']), doc.get('content_length', 0)
+            )
+        return [{'_id': None, 'size': sum(sizes.values())}]
+
+    def find(self, query, projection, batch_size=None):
+        return FakeCursor(dict(doc) for doc in self.docs)
+
+    def find_one_and_delete(self, query, projection=None):
+        for doc in self.docs:
+            if doc['_id'] == query['_id'] and \
+                    doc.get('last_access') == query['last_access']:
+                self.docs.remove(doc)
+                return doc
+        return None
+
+
+class FakeSizes(object):
+    '''tc_mongodb_sizes, holding one tracked total.'''
+
+    def __init__(self, tracked=None):
+        self.tracked = tracked
+
+    def find_one(self, query):
+        return self.tracked
+
+    def replace_one(self, query, doc, upsert=False):
+        self.tracked = dict(doc, _id=query['_id'])
+
+    def update_one(self, query, update):
+        self.tracked['size'] += update['$inc']['size']
+
+
+def results(*accesses):
+    return [{
+        '_id': index,
+        'content_length': 100,
+        'last_access': NOW - timedelta(hours=hours),
+    } for index, hours in enumerate(accesses)]
+
+
+@Vows.batch
+class EvictionVows(Vows.Context):
+    class RecordsStaleAccesses(Vows.Context):
+        def topic(self):
+            return (
+                eviction.is_access_due(None, 600, NOW),
+                eviction.is_access_due(NOW - timedelta(hours=1), 600, NOW),
+                eviction.is_access_due(NOW - timedelta(minutes=1), 600, NOW),
+            )
+
+        def should_record_untracked_results(self, topic):
+            expect(topic[0]).to_be_true()
+
+        def should_record_after_the_resolution(self, topic):
+            expect(topic[1]).to_be_true()
+
+        def should_skip_recent_accesses(self, topic):
+            expect(topic[2]).to_be_false()
+
+    class KeepsResultsUnderTheBudget(Vows.Context):
+        def topic(self):
+            collection = FakeCollection(results(1, 2, 3))
+            return eviction.evict(None, collection, 300), collection
+
+        def should_not_evict(self, topic):
+            expect(topic[0]).to_equal((0, 0))
+            expect(topic[1].docs).to_length(3)
+
+    class EvictsTheLeastRecentlyUsed(Vows.Context):
+        def topic(self):
+            docs = results(1, 5, 2, 4, 3)
+            docs.append({'_id': 'untracked', 'content_length': 100})
+            collection = FakeCollection(docs)
+            return eviction.evict(None, collection, 400), collection
+
+        def should_go_under_the_low_water_mark(self, topic):
+            expect(topic[0]).to_equal((3, 300))
+
+        def should_keep_the_recent_results(self, topic):
+            expect(sorted(doc['_id'] for doc in topic[1].docs)).to_equal(
+                [0, 2, 4]
+            )
+
+    class CountsSharedBlobsOnce(Vows.Context):
+        def topic(self):
+            docs = results(5, 4, 1)
+            for doc in docs[:2]:
+                doc['file_id'] = 'sha256:shared'
+            collection = FakeCollection(docs)
+            return eviction.stored_bytes(collection)
+
+        def should_count_distinct_payloads(self, topic):
+            expect(topic).to_equal(200)
+
+    class OnlyCountsTheBytesActuallyFreed(Vows.Context):
+        def topic(self):
+            # Two old results share a blob, another result still holds it
+            docs = results(5, 4, 3, 1)
+            for doc in docs[:2]:
+                doc['file_id'] = 'sha256:shared'
+            database = FakeGridFSDatabase({'sha256:shared': 3})
+            collection = FakeCollection(docs)
+            return eviction.evict(database, collection, 250), collection
+
+        def should_keep_evicting_until_bytes_are_freed(self, topic):
+            expect(topic[0]).to_equal((3, 100))
+            expect([doc['_id'] for doc in topic[1].docs]).to_equal([3])
+
+    class TracksTheStoredBytes(Vows.Context):
+        def topic(self):
+            collection = FakeCollection(results(5, 4))
+            database = {eviction.SIZES_COLLECTION: FakeSizes({
+                'size': 1000, 'counted_at': datetime.utcnow(),
+            })}
+            eviction.record_stored(collection, 300)
+            eviction.record_stored(collection, -100)
+            eviction.add_stored(database, collection)
+            return eviction.tracked_bytes(database, collection, 3600)
+
+        def should_add_the_recorded_bytes(self, topic):
+            expect(topic).to_equal(1200)
+
+    class RecountsTheStoredBytes(Vows.Context):
+        def topic(self):
+            collection = FakeCollection(results(5, 4))
+            database = {eviction.SIZES_COLLECTION: FakeSizes({
+                'size': 1000,
+                'counted_at': datetime.utcnow() - timedelta(hours=2),
+            })}
+            size = eviction.tracked_bytes(database, collection, 3600)
+            return size, database[eviction.SIZES_COLLECTION].tracked
+
+        def should_sum_the_documents(self, topic):
+            expect(topic[0]).to_equal(200)
+
+        def should_store_the_new_total(self, topic):
+            expect(topic[1]['size']).to_equal(200)
+            expect(topic[1]['_id']).to_equal('thumbor.results')
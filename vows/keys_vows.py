@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from pyvows import Vows, expect
+from tc_mongodb.mongodb import keys
+
+
+@Vows.batch
+class KeysVows(Vows.Context):
+    class DigestsHaveAFixedSize(Vows.Context):
+        def topic(self):
+            return (
+                keys.digest('result:/short'),
+                keys.digest('result:/%s' % ('a' * 4096)),
+            )
+
+        def should_be_twenty_bytes(self, topic):
+            short, long_key = topic
+            expect(len(short)).to_equal(20)
+            expect(len(long_key)).to_equal(20)
+
+    class LooksUpByValueByDefault(Vows.Context):
+        def topic(self):
+            return keys.lookup('path', '/image.jpg', False)
+
+        def should_query_the_path(self, topic):
+            expect(topic).to_equal({'path': '/image.jpg'})
+
+    class LooksUpByDigestWhenHashed(Vows.Context):
+        def topic(self):
+            return keys.lookup('key', 'result:/image.jpg', True)
+
+        def should_query_the_digest_and_keep_the_key(self, topic):
+            expect(topic).to_equal({
+                'key_hash': keys.digest('result:/image.jpg'),
+                'key': 'result:/image.jpg',
+            })
+
+    class LooksUpManyByDigestWhenHashed(Vows.Context):
+        def topic(self):
+            return keys.lookup_many('path', ['/a.jpg', '/b.jpg'], True)
+
+        def should_query_the_digests(self, topic):
+            expect(topic).to_equal({'path_hash': {'$in': [
+                keys.digest('/a.jpg'), keys.digest('/b.jpg'),
+            ]}})
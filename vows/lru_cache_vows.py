@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from pyvows import Vows, expect
+from tc_mongodb.lru_cache import LRUCache
+
+
+@Vows.batch
+class LRUCacheVows(Vows.Context):
+    class EvictsLeastRecentlyUsed(Vows.Context):
+        def topic(self):
+            cache = LRUCache(10)
+            cache.set('a', b'12345')
+            cache.set('b', b'12345')
+            cache.get('a')
+            cache.set('c', b'12345')
+            return cache
+
+        def should_keep_recently_used_entries(self, cache):
+            expect(cache.get('a')).to_equal(b'12345')
+            expect(cache.get('c')).to_equal(b'12345')
+
+        def should_evict_the_oldest_entry(self, cache):
+            expect(cache.get('b')).to_be_null()
+            expect(cache.stats()['evictions']).to_equal(1)
+
+        def should_stay_within_budget(self, cache):
+            expect(cache.size).to_equal(10)
+
+    class SkipsValuesBiggerThanBudget(Vows.Context):
+        def topic(self):
+            cache = LRUCache(4)
+            cache.set('a', b'12345')
+            return cache
+
+        def should_not_cache(self, cache):
+            expect(cache.get('a')).to_be_null()
+            expect(len(cache)).to_equal(0)
+
+    class ExpiresEntries(Vows.Context):
+        def topic(self):
+            cache = LRUCache(10)
+            cache.set('a', b'1', ttl=-1)
+            return cache
+
+        def should_miss_expired_entries(self, cache):
+            expect(cache.get('a')).to_be_null()
+            expect(cache.size).to_equal(0)
+            expect(cache.stats()['misses']).to_equal(1)
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pyvows import Vows, expect
+from tc_mongodb.cli import parse_options
+from tc_mongodb.mongodb import blobs, maintenance
+
+
+class FakeCollection(object):
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def index_information(self):
+        return self.indexes
+
+
+def field_values(doc, field):
+    value = doc
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return []
+        value = value[part]
+    return value if isinstance(value, list) else [value]
+
+
+def satisfies(values, condition):
+    for operator, operand in condition.items():
+        if operator == '$exists' and bool(values) != operand:
+            return False
+        if operator == '$not' and satisfies(values, operand):
+            return False
+        if operator == '$in' and \
+                not any(value in operand for value in values):
+            return False
+        if operator == '$lt' and not any(value < operand for value in values):
+            return False
+        if operator == '$gt' and not any(value > operand for value in values):
+            return False
+        if operator == '$gte' and \
+                not any(value >= operand for value in values):
+            return False
+    return True
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        values = field_values(doc, field)
+        if not isinstance(condition, dict):
+            if condition not in values:
+                return False
+            continue
+        if not satisfies(values, condition):
+            return False
+    return True
+
+
+def apply_update(doc, update):
+    for field, value in update.get('$set', {}).items():
+        doc[field] = value
+    for field, value in update.get('$inc', {}).items():
+        doc[field] = doc.get(field, 0) + value
+    for field, value in update.get('$addToSet', {}).items():
+        if value not in doc.setdefault(field, []):
+            doc[field].append(value)
+
+
+class UpdateResult(object):
+    def __init__(self, count):
+        self.matched_count = self.modified_count = count
+
+
+class MemoryCursor(list):
+    def sort(self, field, direction):
+        return MemoryCursor(sorted(self, key=lambda doc: doc[field]))
+
+    def limit(self, count):
+        return MemoryCursor(self[:count])
+
+    def hint(self, index):
+        return self
+
+
+class MemoryCollection(object):
+    def __init__(self, name, docs=()):
+        self.name = name
+        self.docs = list(docs)
+        self.indexes = []
+
+    def create_index(self, keys):
+        self.indexes.append(keys)
+
+    def find(self, query, projection=None, batch_size=None):
+        return MemoryCursor(
+            dict(doc) for doc in self.docs if matches(doc, query)
+        )
+
+    def find_one(self, query, projection=None):
+        return next(iter(self.find(query)), None)
+
+    def update_one(self, query, update):
+        for doc in self.docs:
+            if matches(doc, query):
+                apply_update(doc, update)
+                return UpdateResult(1)
+        return UpdateResult(0)
+
+    def update_many(self, query, update):
+        docs = [doc for doc in self.docs if matches(doc, query)]
+        for doc in docs:
+            apply_update(doc, update)
+        return UpdateResult(len(docs))
+
+    def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not matches(doc, query)]
+
+
+class MemoryDatabase(dict):
+    name = 'thumbor'
+
+    def __init__(self, *collections):
+        dict.__init__(self, ((c.name, c) for c in collections))
+        self.fs = type('Bucket', (object,), {})()
+        self.fs.files = self['fs.files']
+        self.fs.chunks = self['fs.chunks']
+
+
+def shared_bucket():
+    '''Image and result storages of one database, each with a live and an
+    orphaned GridFS file in the shared bucket, a shared blob taken again
+    by a put that has not written its document yet, and the chunks of an
+    interrupted upload.'''
+
+    uploaded = datetime.utcnow() - timedelta(days=1)
+    files = [
+        {'_id': 'sha256:reused', 'collections': ['images'], 'refs': 2,
+         'uploadDate': uploaded, 'last_referenced': datetime.utcnow()},
+        {'_id': 'image', 'path': '/a.jpg',
+         'uploadDate': uploaded + timedelta(minutes=1)},
+        {'_id': 'old-image', 'path': '/b.jpg',
+         'uploadDate': uploaded + timedelta(minutes=2)},
+        {'_id': 'result', 'metadata': {'key': 'result:/a'},
+         'uploadDate': uploaded},
+        {'_id': 'old-result', 'metadata': {'key': 'result:/b'},
+         'uploadDate': uploaded},
+    ]
+    chunk_id = ObjectId.from_datetime(uploaded)
+    chunks = [{'_id': chunk_id, 'files_id': f['_id'], 'n': 0} for f in files]
+    chunks.append({'_id': chunk_id, 'files_id': 'interrupted', 'n': 0})
+    return MemoryDatabase(
+        MemoryCollection('images', [{'path': '/a.jpg', 'file_id': 'image'}]),
+        MemoryCollection('results', [
+            {'key': 'result:/a', 'file_id': 'result'}
+        ]),
+        MemoryCollection('fs.files', files),
+        MemoryCollection('fs.chunks', chunks),
+    )
+
+
+SPECS = [
+    ('path_1', [('path', ASCENDING)], {'unique': True}),
+    ('expires_at_1', [('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ('file_id_1', [('file_id', ASCENDING)], {'sparse': True}),
+]
+
+
+@Vows.batch
+class MaintenanceVows(Vows.Context):
+    class ReportsIndexProblems(Vows.Context):
+        def topic(self):
+            collection = FakeCollection({
+                '_id_': {'key': [('_id', 1)]},
+                'path_1': {'key': [('path', 1)]},
+                'expires_at_1': {'key': [('expires_at', 1)],
+                                 'expireAfterSeconds': 0},
+            })
+            return maintenance.index_problems(collection, SPECS)
+
+        def should_report_differing_options(self, topic):
+            expect(topic).to_include(('path_1', 'mismatch'))
+
+        def should_report_missing_indexes(self, topic):
+            expect(topic).to_include(('file_id_1', 'missing'))
+
+        def should_accept_matching_indexes(self, topic):
+            expect(topic).to_length(2)
+
+    class MatchesDocumentsWithoutExpiresAt(Vows.Context):
+        def topic(self):
+            return maintenance.expired_documents(3600)
+
+        def should_fall_back_to_created_at(self, topic):
+            expect(topic['$or']).to_length(2)
+            expect(topic['$or'][1]).to_include('created_at')
+
+    class KeepsDocumentsThatNeverExpire(Vows.Context):
+        def topic(self):
+            return maintenance.expired_documents(0)
+
+        def should_only_match_expires_at(self, topic):
+            expect(topic['$or']).to_length(1)
+
+
+    class SweepsOnlyTheFilesOfItsStorage(Vows.Context):
+        def topic(self):
+            database = shared_bucket()
+            images = database['images']
+            removed = maintenance.sweep_orphaned_files(
+                database, images, maintenance.owned_files(['path'], images)
+            )
+            return removed, database
+
+        def should_remove_its_orphans(self, topic):
+            removed, database = topic
+            expect(removed).to_equal((1, None))
+            expect([c['files_id'] for c in database.fs.chunks.docs]) \
+                .not_to_include('old-image')
+
+        def should_keep_the_files_of_the_other_storage(self, topic):
+            _, database = topic
+            expect(sorted(f['_id'] for f in database.fs.files.docs)).to_equal(
+                ['image', 'old-result', 'result', 'sha256:reused']
+            )
+
+        def should_keep_shared_blobs_referenced_again(self, topic):
+            _, database = topic
+            expect([c['files_id'] for c in database.fs.chunks.docs]) \
+                .to_include('sha256:reused')
+
+        def should_leave_chunks_without_files_alone(self, topic):
+            _, database = topic
+            expect([c['files_id'] for c in database.fs.chunks.docs]) \
+                .to_include('interrupted')
+
+        def should_index_the_upload_dates(self, topic):
+            _, database = topic
+            expect(database.fs.files.indexes).to_equal(
+                [maintenance.UPLOAD_DATE_INDEX]
+            )
+
+    class ResumesWhereTheSweepStopped(Vows.Context):
+        def topic(self):
+            database = shared_bucket()
+            images = database['images']
+            file_filter = maintenance.owned_files(['path'], images)
+            first = maintenance.sweep_orphaned_files(
+                database, images, file_filter, max_files=1
+            )
+            second = maintenance.sweep_orphaned_files(
+                database, images, file_filter, since=first[1], max_files=1
+            )
+            return first, second
+
+        def should_stop_after_max_files(self, topic):
+            expect(topic[0][0]).to_equal(0)
+            expect(topic[0][1]).not_to_be_null()
+
+        def should_check_the_next_files(self, topic):
+            expect(topic[1][0]).to_equal(1)
+            expect(topic[1][1] > topic[0][1]).to_be_true()
+
+    class SweepsChunksWithoutFiles(Vows.Context):
+        def topic(self):
+            database = shared_bucket()
+            removed = maintenance.sweep_orphaned_chunks(database)
+            return removed, database
+
+        def should_remove_the_chunks_of_interrupted_uploads(self, topic):
+            removed, database = topic
+            expect(removed).to_equal(1)
+            expect([c['files_id'] for c in database.fs.chunks.docs]) \
+                .not_to_include('interrupted')
+
+    class SkipsBlobsBeingDeleted(Vows.Context):
+        def topic(self):
+            database = shared_bucket()
+            database.fs.files.update_one(
+                {'_id': 'sha256:reused'},
+                {'$set': {'deleting': datetime.utcnow()}}
+            )
+            database.fs.files.docs[0]['_id'] = blobs.blob_id(b'payload')
+            file_id = blobs.put_shared(database, 'images', b'payload')
+            return file_id, database.fs.files.docs[0]
+
+        def should_leave_the_payload_to_a_file_of_its_own(self, topic):
+            expect(topic[0]).to_be_null()
+
+        def should_not_reference_the_blob(self, topic):
+            expect(topic[1]['refs']).to_equal(2)
+
+
+@Vows.batch
+class CliVows(Vows.Context):
+    class ParsesPurges(Vows.Context):
+        def topic(self):
+            return parse_options([
+                '-s', 'storage', 'purge', '--orphans', '--rate', '100'
+            ])
+
+        def should_select_the_storage(self, topic):
+            expect(topic.storage).to_equal('storage')
+
+        def should_read_the_rate(self, topic):
+            expect(topic.rate).to_equal(100)
+            expect(topic.expired).to_be_false()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import time
+from datetime import datetime, timedelta
+
+from tc_mongodb.result_storages.mongo_result_storage import \
+    Storage as MongoResultStorage
+from tc_mongodb.result_storages.motor_result_storage import \
+    Storage as MotorResultStorage
+from thumbor.context import Context, RequestParameters
+from thumbor.config import Config
+from tornado import gen
+from tornado.ioloop import IOLoop
+from pyvows import Vows, expect
+from fixtures.storage_fixtures import IMAGE_URL, IMAGE_BYTES, get_server
+
+
+def result_storage(url, storage_class=MongoResultStorage, **settings):
+    config = Config(
+        MONGO_RESULT_STORAGE_URI="",
+        MONGO_RESULT_STORAGE_SERVER_HOST='localhost',
+        MONGO_RESULT_STORAGE_SERVER_PORT=27017,
+        MONGO_RESULT_STORAGE_SERVER_DB='thumbor',
+        MONGO_RESULT_STORAGE_SERVER_COLLECTION='results',
+        RESULT_STORAGE_EXPIRATION_SECONDS=3600,
+        MONGO_RESULT_STORAGE_STALE_SECONDS=600,
+        **settings
+    )
+    context = Context(config=config, server=get_server('ACME-SEC'))
+    context.request = RequestParameters(url=url)
+    return storage_class(context)
+
+
+def store_stale(url, **settings):
+    '''Store a result for url and move it into its grace window.
+    :returns: The pymongo storage that stored it
+    '''
+
+    storage = result_storage(url, **settings)
+    storage.put(IMAGE_BYTES)
+    now = datetime.utcnow()
+    storage.storage.update_one(
+        storage.lookup(storage.get_key_from_request()),
+        {'$set': {
+            'refresh_at': now - timedelta(minutes=1),
+            'expires_at': now + timedelta(minutes=9),
+        }}
+    )
+    return storage
+
+
+def stored_document(storage):
+    return storage.storage.find_one(
+        storage.lookup(storage.get_key_from_request())
+    )
+
+
+def buffer_of(result):
+    return result.buffer if result is not None else None
+
+
+@Vows.batch
+class MongoResultStorageVows(Vows.Context):
+    class ServesStaleResults(Vows.Context):
+        def topic(self):
+            url = IMAGE_URL % 9001
+            store_stale(url)
+            first = result_storage(url).get().result()
+            second = result_storage(url).get().result()
+            return buffer_of(first), buffer_of(second)
+
+        def should_leave_the_refresh_to_one_caller(self, topic):
+            expect(topic[0]).to_be_null()
+
+        def should_serve_the_stale_bytes_to_the_others(self, topic):
+            expect(topic[1]).to_equal(IMAGE_BYTES)
+
+    class ReleasesTheClaimOnPut(Vows.Context):
+        def topic(self):
+            url = IMAGE_URL % 9002
+            storage = store_stale(url)
+            result_storage(url).get().result()
+            claimed = stored_document(storage).get('refreshing_until')
+            result_storage(url).put(IMAGE_BYTES)
+            return claimed, stored_document(storage)
+
+        def should_claim_the_refresh(self, topic):
+            expect(topic[0]).not_to_be_null()
+
+        def should_clear_the_claim(self, topic):
+            expect(topic[1]).not_to_include('refreshing_until')
+
+        def should_store_a_fresh_result(self, topic):
+            expect(topic[1]['refresh_at'] > datetime.utcnow()).to_be_true()
+
+    class LapsesTheClaimAfterTheTimeout(Vows.Context):
+        def topic(self):
+            url = IMAGE_URL % 9003
+            settings = {'MONGO_RESULT_STORAGE_REFRESH_TIMEOUT': 1}
+            store_stale(url, **settings)
+            first = result_storage(url, **settings).get().result()
+            time.sleep(1.5)
+            # The first caller never stored the new result
+            second = result_storage(url, **settings).get().result()
+            return buffer_of(first), buffer_of(second)
+
+        def should_give_the_refresh_to_the_first_caller(self, topic):
+            expect(topic[0]).to_be_null()
+
+        def should_give_it_again_once_lapsed(self, topic):
+            expect(topic[1]).to_be_null()
+
+    class ClaimsPerCoalescedCaller(Vows.Context):
+        def topic(self):
+            url = IMAGE_URL % 9004
+            store_stale(url)
+
+            @gen.coroutine
+            def read_concurrently():
+                results = yield [
+                    result_storage(url, MotorResultStorage).get()
+                    for _ in range(3)
+                ]
+                raise gen.Return(results)
+
+            results = IOLoop.current().run_sync(read_concurrently)
+            return sorted(map(buffer_of, results), key=lambda b: b is None)
+
+        def should_leave_the_refresh_to_one_caller(self, topic):
+            expect(topic[2]).to_be_null()
+
+        def should_serve_the_stale_bytes_to_the_others(self, topic):
+            expect(topic[:2]).to_equal([IMAGE_BYTES, IMAGE_BYTES])
+
+    class RecordsAccessesOfMemoryHits(Vows.Context):
+        def topic(self):
+            url = IMAGE_URL % 9005
+            settings = {
+                'MONGO_RESULT_STORAGE_MAX_SIZE': 1024 * 1024 * 1024,
+                'MONGO_RESULT_STORAGE_MEMORY_CACHE_SIZE': 1024 * 1024,
+                'MONGO_RESULT_STORAGE_ACCESS_RESOLUTION': 0,
+            }
+            storage = result_storage(url, **settings)
+            storage.put(IMAGE_BYTES)
+            accessed_at = datetime.utcnow() - timedelta(days=1)
+            storage.storage.update_one(
+                storage.lookup(storage.get_key_from_request()),
+                {'$set': {'last_access': accessed_at}}
+            )
+            result = result_storage(url, **settings).get().result()
+            # The access queue flushes every second
+            time.sleep(1.5)
+            return buffer_of(result), accessed_at, stored_document(storage)
+
+        def should_serve_the_result_from_memory(self, topic):
+            expect(topic[0]).to_equal(IMAGE_BYTES)
+
+        def should_move_the_access_forward(self, topic):
+            expect(topic[2]['last_access'] > topic[1]).to_be_true()
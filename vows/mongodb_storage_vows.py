@@ -315,3 +315,185 @@ class MongoStorageVows(MongoDBContext):
             def should_not_be_null(self, topic):
                 expect(topic.result()).to_be_null()
 
+
+    class InlineVows(Vows.Context):
+        class StoresSmallImagesInline(Vows.Context):
+            def topic(self):
+                config = Config(
+                    MONGO_STORAGE_URI="",
+                    MONGO_STORAGE_SERVER_HOST='localhost',
+                    MONGO_STORAGE_SERVER_PORT=27017,
+                    MONGO_STORAGE_SERVER_DB='thumbor',
+                    MONGO_STORAGE_SERVER_COLLECTION='images',
+                    STORAGE_EXPIRATION_SECONDS=3600
+                )
+                storage = MongoStorage(Context(
+                    config=config, server=get_server('ACME-SEC')
+                ))
+                storage.put(IMAGE_URL % 11, IMAGE_BYTES)
+                return storage.storage.find_one({'path': IMAGE_URL % 11})
+
+            def should_embed_the_bytes(self, topic):
+                expect(topic['data']).to_equal(IMAGE_BYTES)
+                expect(topic.get('file_id')).to_be_null()
+
+        class StoresBigImagesInGridFS(Vows.Context):
+            def topic(self):
+                config = Config(
+                    MONGO_STORAGE_URI="",
+                    MONGO_STORAGE_SERVER_HOST='localhost',
+                    MONGO_STORAGE_SERVER_PORT=27017,
+                    MONGO_STORAGE_SERVER_DB='thumbor',
+                    MONGO_STORAGE_SERVER_COLLECTION='images',
+                    STORAGE_EXPIRATION_SECONDS=3600,
+                    MONGO_STORAGE_INLINE_MAX_SIZE=0
+                )
+                storage = MongoStorage(Context(
+                    config=config, server=get_server('ACME-SEC')
+                ))
+                storage.put(IMAGE_URL % 12, IMAGE_BYTES)
+                return storage
+
+            def should_reference_a_gridfs_file(self, storage):
+                doc = storage.storage.find_one({'path': IMAGE_URL % 12})
+                expect(doc.get('data')).to_be_null()
+                expect(doc['file_id']).not_to_be_null()
+
+            def should_read_the_bytes_back(self, storage):
+                expect(storage._get(IMAGE_URL % 12)).to_equal(IMAGE_BYTES)
+
+    class CanReplaceImage(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_URI="",
+                MONGO_STORAGE_SERVER_HOST='localhost',
+                MONGO_STORAGE_SERVER_PORT=27017,
+                MONGO_STORAGE_SERVER_DB='thumbor',
+                MONGO_STORAGE_SERVER_COLLECTION='images',
+                STORAGE_EXPIRATION_SECONDS=3600,
+                MONGO_STORAGE_INLINE_MAX_SIZE=0
+            )
+            storage = MongoStorage(Context(
+                config=config, server=get_server('ACME-SEC')
+            ))
+            storage.put(IMAGE_URL % 13, IMAGE_BYTES)
+            storage.put(IMAGE_URL % 13, IMAGE_BYTES)
+            return storage
+
+        def should_keep_a_single_document(self, storage):
+            expect(
+                storage.storage.count_documents({'path': IMAGE_URL % 13})
+            ).to_equal(1)
+
+        def should_delete_the_replaced_file(self, storage):
+            doc = storage.storage.find_one({'path': IMAGE_URL % 13})
+            files = list(storage.database.fs.files.find({
+                'metadata.path': IMAGE_URL % 13
+            }))
+            expect(files).to_length(1)
+            expect(files[0]['_id']).to_equal(doc['file_id'])
+
+        class RemovesTheFileWithTheImage(Vows.Context):
+            def topic(self, storage):
+                storage.remove(IMAGE_URL % 13)
+                return storage.database.fs.files.count_documents({
+                    'metadata.path': IMAGE_URL % 13
+                })
+
+            def should_be_gone(self, topic):
+                expect(topic).to_equal(0)
+
+    class StoresExpirationDate(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_URI="",
+                MONGO_STORAGE_SERVER_HOST='localhost',
+                MONGO_STORAGE_SERVER_PORT=27017,
+                MONGO_STORAGE_SERVER_DB='thumbor',
+                MONGO_STORAGE_SERVER_COLLECTION='images',
+                STORAGE_EXPIRATION_SECONDS=3600
+            )
+            storage = MongoStorage(Context(
+                config=config, server=get_server('ACME-SEC')
+            ))
+            storage.put(IMAGE_URL % 14, IMAGE_BYTES)
+            return storage.storage.find_one({'path': IMAGE_URL % 14})
+
+        def should_expire_after_storage_expiration(self, topic):
+            expect(
+                (topic['expires_at'] - topic['created_at']).total_seconds()
+            ).to_equal(3600)
+
+    class DeduplicatesImages(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_URI="",
+                MONGO_STORAGE_SERVER_HOST='localhost',
+                MONGO_STORAGE_SERVER_PORT=27017,
+                MONGO_STORAGE_SERVER_DB='thumbor',
+                MONGO_STORAGE_SERVER_COLLECTION='images',
+                STORAGE_EXPIRATION_SECONDS=3600,
+                MONGO_STORAGE_INLINE_MAX_SIZE=0,
+                MONGO_STORAGE_DEDUPLICATE=True
+            )
+            storage = MongoStorage(Context(
+                config=config, server=get_server('ACME-SEC')
+            ))
+            storage.put(IMAGE_URL % 15, IMAGE_BYTES)
+            storage.put(IMAGE_URL % 16, IMAGE_BYTES)
+            storage.put(IMAGE_URL % 16, IMAGE_BYTES)
+            return storage
+
+        def should_share_a_single_file(self, storage):
+            first = storage.storage.find_one({'path': IMAGE_URL % 15})
+            second = storage.storage.find_one({'path': IMAGE_URL % 16})
+            expect(first['file_id']).to_equal(second['file_id'])
+
+        def should_count_references(self, storage):
+            doc = storage.storage.find_one({'path': IMAGE_URL % 15})
+            blob = storage.database.fs.files.find_one({'_id': doc['file_id']})
+            expect(blob['refs']).to_equal(2)
+
+        def should_read_the_bytes_back(self, storage):
+            expect(storage._get(IMAGE_URL % 16)).to_equal(IMAGE_BYTES)
+
+        class DeletesTheFileWithItsLastReference(Vows.Context):
+            def topic(self, storage):
+                doc = storage.storage.find_one({'path': IMAGE_URL % 15})
+                storage.remove(IMAGE_URL % 15)
+                storage.remove(IMAGE_URL % 16)
+                return storage.database.fs.files.find_one(
+                    {'_id': doc['file_id']}
+                )
+
+            def should_be_gone(self, topic):
+                expect(topic).to_be_null()
+
+    class RemembersMisses(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_URI="",
+                MONGO_STORAGE_SERVER_HOST='localhost',
+                MONGO_STORAGE_SERVER_PORT=27017,
+                MONGO_STORAGE_SERVER_DB='thumbor',
+                MONGO_STORAGE_SERVER_COLLECTION='images',
+                STORAGE_EXPIRATION_SECONDS=3600,
+                MONGO_STORAGE_MISS_CACHE_SIZE=100
+            )
+            storage = MongoStorage(Context(
+                config=config, server=get_server('ACME-SEC')
+            ))
+            storage._exists(IMAGE_URL % 17)
+            return storage
+
+        def should_know_the_miss(self, storage):
+            expect(storage.is_known_miss(IMAGE_URL % 17)).to_be_true()
+
+        class ForgetsItOnPut(Vows.Context):
+            def topic(self, storage):
+                storage.put(IMAGE_URL % 17, IMAGE_BYTES)
+                return storage
+
+            def should_find_the_image(self, storage):
+                expect(storage.is_known_miss(IMAGE_URL % 17)).to_be_false()
+                expect(storage._exists(IMAGE_URL % 17)).to_be_true()
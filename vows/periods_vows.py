@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import calendar
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+from pyvows import Vows, expect
+from tc_mongodb.mongodb import periods
+
+DAY = 24 * 3600
+SPECS = [('path_1', [('path', 1)], {'unique': True})]
+# 2026-10-17 13:00 UTC
+NOW = calendar.timegm(datetime(2026, 10, 17, 13).utctimetuple())
+
+
+class FakePartition(object):
+    full_name = 'thumbor.images_20261017000000'
+    database = type('Database', (object,), {'client': object()})()
+
+    def __init__(self, fail):
+        self.fail = fail
+
+    def create_index(self, keys, **options):
+        if self.fail:
+            raise OperationFailure('index build failed')
+
+
+@Vows.batch
+class PeriodsVows(Vows.Context):
+    class NamesPartitionsAfterTheirStart(Vows.Context):
+        def topic(self):
+            return periods.partition_name(
+                'images', periods.period_start(DAY, NOW)
+            )
+
+        def should_use_the_utc_start(self, topic):
+            expect(topic).to_equal('images_20261017000000')
+
+        def should_parse_back(self, topic):
+            expect(periods.partition_start('images', topic)).to_equal(
+                NOW - 13 * 3600
+            )
+
+    class IgnoresOtherCollections(Vows.Context):
+        def topic(self):
+            return [
+                periods.partition_start('images', name) for name in (
+                    'images', 'images_20261017000000.files',
+                    'results_20261017000000',
+                )
+            ]
+
+        def should_not_parse(self, topic):
+            expect(topic).to_equal([None, None, None])
+
+    class ListsLivePartitionsNewestFirst(Vows.Context):
+        def topic(self):
+            return periods.live_partitions('images', DAY, DAY, NOW)
+
+        def should_cover_the_expiration_window(self, topic):
+            expect(topic).to_equal([
+                'images_20261017000000', 'images_20261016000000'
+            ])
+
+    class ExpiresPeriodsOnceTheirNewestDocumentHas(Vows.Context):
+        def topic(self):
+            start = NOW - 13 * 3600 - DAY
+            return (
+                periods.is_expired(start, DAY, DAY, NOW),
+                periods.is_expired(start - DAY, DAY, DAY, NOW),
+            )
+
+        def should_keep_the_previous_period(self, topic):
+            expect(topic[0]).to_be_false()
+
+        def should_expire_older_periods(self, topic):
+            expect(topic[1]).to_be_true()
+
+    class BoundsTheLivePartitions(Vows.Context):
+        def topic(self):
+            return periods.check_partitioning(
+                'MONGO_STORAGE', 5 * DAY, 30 * DAY
+            )
+
+        def should_accept_periods_spanning_few_partitions(self, topic):
+            expect(topic).to_equal((5 * DAY, 30 * DAY))
+            expect(periods.partition_count(*topic)).to_equal(7)
+
+        class RejectsHourlyPeriodsOfAMonth(Vows.Context):
+            @Vows.capture_error
+            def topic(self):
+                return periods.check_partitioning(
+                    'MONGO_STORAGE', 3600, 30 * DAY
+                )
+
+            def should_be_an_error(self, topic):
+                expect(topic).to_be_an_error_like(ValueError)
+                expect(str(topic)).to_include(
+                    'MONGO_STORAGE_PARTITION_SECONDS'
+                )
+
+    class ClaimsThePartitionIndexesOnce(Vows.Context):
+        def topic(self):
+            partition = FakePartition(fail=True)
+            claims = [periods.claim_indexes(partition)]
+            periods.create_indexes(partition, SPECS)
+            claims.append(periods.claim_indexes(partition))
+            claims.append(periods.claim_indexes(partition))
+            return claims
+
+        def should_let_one_caller_retry_after_a_failure(self, topic):
+            expect(topic).to_equal([True, True, False])
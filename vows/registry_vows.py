@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from pymongo.errors import ServerSelectionTimeoutError
+from pyvows import Vows, expect
+from thumbor.config import Config
+from tc_mongodb.mongodb import registry
+from tc_mongodb.mongodb.connector_storage import MongoConnector
+from tc_mongodb.utils import CircuitBreaker
+
+
+class FakeClient(object):
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+
+class DownConnector(MongoConnector):
+    '''Connector of a MongoDB that can't be reached.'''
+
+    attempts = []
+
+    def create_connection(self):
+        collection = type('Collection', (object,), {})()
+        collection.full_name = '%s.%s' % (self.db_name, self.coll_name)
+        return None, collection
+
+    def ensure_index(self):
+        self.attempts.append(self.coll_name)
+        raise ServerSelectionTimeoutError('localhost:27017: timed out')
+
+
+@Vows.batch
+class RegistryVows(Vows.Context):
+    class ReusesClientsForTheSameServer(Vows.Context):
+        def topic(self):
+            return (
+                registry.get_client(FakeClient, host='localhost', port=1),
+                registry.get_client(FakeClient, host='localhost', port=1),
+            )
+
+        def should_be_the_same_client(self, topic):
+            first, second = topic
+            expect(first).to_equal(second)
+
+    class CreatesClientsPerPoolSettings(Vows.Context):
+        def topic(self):
+            return (
+                registry.get_client(FakeClient, host='localhost', port=2),
+                registry.get_client(
+                    FakeClient, host='localhost', port=2, maxPoolSize=5
+                ),
+            )
+
+        def should_be_different_clients(self, topic):
+            first, second = topic
+            expect(first).not_to_equal(second)
+            expect(second.kwargs).to_equal({'maxPoolSize': 5})
+
+    class ReadsPoolSettingsFromConfig(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_MAX_POOL_SIZE=50,
+                MONGO_STORAGE_WAIT_QUEUE_TIMEOUT_MS=200
+            )
+            return registry.client_options(config, 'MONGO_STORAGE')
+
+        def should_map_to_client_options(self, topic):
+            expect(topic).to_equal({
+                'maxPoolSize': 50,
+                'waitQueueTimeoutMS': 200,
+            })
+
+    class SplitsTheConnectionBudgetBetweenProcesses(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_MAX_CONNECTIONS=100,
+                MONGO_STORAGE_MIN_POOL_SIZE=40
+            )
+            return registry.client_options(config, 'MONGO_STORAGE', 4)
+
+        def should_size_pools_to_their_share(self, topic):
+            expect(topic).to_equal({'maxPoolSize': 25, 'minPoolSize': 25})
+
+    class KeepsSmallerPoolSizes(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_MAX_CONNECTIONS=100,
+                MONGO_STORAGE_MAX_POOL_SIZE=10
+            )
+            return registry.client_options(config, 'MONGO_STORAGE', 4)
+
+        def should_keep_the_pool_size(self, topic):
+            expect(topic).to_equal({'maxPoolSize': 10})
+
+    class RebuildsClientsAfterFork(Vows.Context):
+        def topic(self):
+            forks = []
+            registry.on_fork(lambda: forks.append(True))
+            before = registry.get_client(FakeClient, host='localhost', port=3)
+            # Pretend the registry was filled by a parent process
+            registry._pid = -1
+            after = registry.get_client(FakeClient, host='localhost', port=3)
+            return before, after, forks
+
+        def should_create_a_new_client(self, topic):
+            before, after, _ = topic
+            expect(after).not_to_equal(before)
+
+        def should_notify_fork_callbacks(self, topic):
+            expect(topic[2]).to_length(1)
+
+    class ReadsFromPrimaryByDefault(Vows.Context):
+        def topic(self):
+            return registry.read_preference(Config(), 'MONGO_STORAGE')
+
+        def should_be_null(self, topic):
+            expect(topic).to_be_null()
+
+    class ReadsReadPreferenceFromConfig(Vows.Context):
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_READ_PREFERENCE='secondaryPreferred',
+                MONGO_STORAGE_READ_PREFERENCE_TAGS=[{'dc': 'east'}, {}],
+                MONGO_STORAGE_MAX_STALENESS_SECONDS=120
+            )
+            return registry.read_preference(config, 'MONGO_STORAGE')
+
+        def should_route_to_secondaries(self, topic):
+            expect(topic.mongos_mode).to_equal('secondaryPreferred')
+            expect(topic.tag_sets).to_equal([{'dc': 'east'}, {}])
+            expect(topic.max_staleness).to_equal(120)
+
+    class ClaimsBootstrapsOnce(Vows.Context):
+        def topic(self):
+            key = ('vows', 'claim')
+            first = registry.claim_bootstrap(key)
+            second = registry.claim_bootstrap(key)
+            registry.forget_bootstrap(key)
+            return first, second, registry.claim_bootstrap(key)
+
+        def should_hand_the_claim_to_one_caller(self, topic):
+            expect(topic[0]).to_be_true()
+            expect(topic[1]).to_be_false()
+
+        def should_claim_again_once_forgotten(self, topic):
+            expect(topic[2]).to_be_true()
+
+    class BootstrapsThroughTheBreaker(Vows.Context):
+        def topic(self):
+            breaker = CircuitBreaker(2, 60)
+            connectors = [
+                DownConnector(db_name='thumbor', coll_name='down',
+                              breaker=breaker)
+                for _ in range(3)
+            ]
+            key = connectors[0].bootstrap_key
+            claimed = registry.claim_bootstrap(key)
+            registry.forget_bootstrap(key)
+            return claimed, breaker, DownConnector.attempts
+
+        def should_leave_the_bootstrap_to_a_later_connector(self, topic):
+            expect(topic[0]).to_be_true()
+
+        def should_stop_trying_once_the_circuit_opens(self, topic):
+            expect(topic[1].is_open()).to_be_true()
+            expect(topic[2]).to_equal(['down', 'down'])
+
+    class RejectsInvalidTagSets(Vows.Context):
+        @Vows.capture_error
+        def topic(self):
+            config = Config(
+                MONGO_STORAGE_READ_PREFERENCE='secondary',
+                MONGO_STORAGE_READ_PREFERENCE_TAGS={'dc': 'east'}
+            )
+            return registry.read_preference(config, 'MONGO_STORAGE')
+
+        def should_raise_the_type_error(self, topic):
+            expect(topic).to_be_an_error_like(TypeError)
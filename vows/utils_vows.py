@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+from pymongo.errors import AutoReconnect, DuplicateKeyError, PyMongoError
+from pyvows import Vows, expect
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tc_mongodb.utils import (
+    CircuitBreaker, OnException, SingleFlight, guarded, timed
+)
+
+
+class FakeStorage(object):
+    def on_error(self, fname, exc_type, exc_value):
+        return fname
+
+    @OnException(on_error, PyMongoError)
+    @gen.coroutine
+    def _get(self, fail):
+        yield gen.moment
+        if fail:
+            raise PyMongoError('unavailable')
+        raise gen.Return('contents')
+
+
+class TimedStorage(object):
+    def __init__(self):
+        self.timings = []
+
+    def timing(self, name, value):
+        self.timings.append(name)
+
+    def on_error(self, fname, exc_type, exc_value):
+        return fname
+
+    @OnException(on_error, PyMongoError)
+    @timed
+    @gen.coroutine
+    def _exists(self, fail):
+        yield gen.moment
+        if fail:
+            raise PyMongoError('unavailable')
+        raise gen.Return(True)
+
+
+class GuardedStorage(object):
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.calls = 0
+
+    def get_breaker(self):
+        return self.breaker
+
+    def on_error(self, fname, exc_type, exc_value):
+        return type(exc_value).__name__
+
+    @OnException(on_error, PyMongoError)
+    @guarded
+    @gen.coroutine
+    def _get(self, error=None):
+        self.calls += 1
+        yield gen.moment
+        if error is not None:
+            raise error
+        raise gen.Return('contents')
+
+
+def run_calls(storage, errors):
+    @gen.coroutine
+    def run():
+        results = []
+        for error in errors:
+            result = yield storage._get(error)
+            results.append(result)
+        raise gen.Return(results)
+
+    return IOLoop.current().run_sync(run)
+
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+
+    @gen.coroutine
+    def fetch(self, value):
+        self.calls += 1
+        yield gen.sleep(0.01)
+        raise gen.Return(value)
+
+
+@Vows.batch
+class OnExceptionVows(Vows.Context):
+    class WrapsCoroutines(Vows.Context):
+        def topic(self):
+            storage = FakeStorage()
+            return IOLoop.current().run_sync(lambda: storage._get(False))
+
+        def should_return_result(self, topic):
+            expect(topic).to_equal('contents')
+
+    class HandlesErrorsRaisedByCoroutines(Vows.Context):
+        def topic(self):
+            storage = FakeStorage()
+            return IOLoop.current().run_sync(lambda: storage._get(True))
+
+        def should_return_callback_value(self, topic):
+            expect(topic).to_equal('_get')
+
+
+@Vows.batch
+class SingleFlightVows(Vows.Context):
+    class CoalescesConcurrentCalls(Vows.Context):
+        def topic(self):
+            counter = Counter()
+            flight = SingleFlight()
+
+            @gen.coroutine
+            def run():
+                results = yield [
+                    flight.do('key', counter.fetch, 'value')
+                    for _ in range(5)
+                ]
+                yield gen.moment
+                raise gen.Return((results, counter.calls, len(flight)))
+
+            return IOLoop.current().run_sync(run)
+
+        def should_share_the_result(self, topic):
+            expect(topic[0]).to_equal(['value'] * 5)
+
+        def should_call_once(self, topic):
+            expect(topic[1]).to_equal(1)
+
+        def should_forget_finished_calls(self, topic):
+            expect(topic[2]).to_equal(0)
+
+
+@Vows.batch
+class TimedVows(Vows.Context):
+    class ReportsDurations(Vows.Context):
+        def topic(self):
+            storage = TimedStorage()
+            IOLoop.current().run_sync(lambda: storage._exists(False))
+            return storage.timings
+
+        def should_name_the_timing_after_the_method(self, topic):
+            expect(topic).to_equal(['exists'])
+
+    class KeepsTheMethodNameForErrorHandlers(Vows.Context):
+        def topic(self):
+            storage = TimedStorage()
+            result = IOLoop.current().run_sync(lambda: storage._exists(True))
+            return result, storage.timings
+
+        def should_report_the_failed_call(self, topic):
+            result, timings = topic
+            expect(result).to_equal('_exists')
+            expect(timings).to_equal(['exists'])
+
+
+@Vows.batch
+class CircuitBreakerVows(Vows.Context):
+    class OpensAfterConsecutiveFailures(Vows.Context):
+        def topic(self):
+            storage = GuardedStorage(CircuitBreaker(2, 60))
+            failure = AutoReconnect('down')
+            results = run_calls(storage, [failure, failure, None, None])
+            return results, storage.calls
+
+        def should_refuse_calls_once_open(self, topic):
+            expect(topic[0]).to_equal([
+                'AutoReconnect', 'AutoReconnect',
+                'CircuitOpenError', 'CircuitOpenError'
+            ])
+
+        def should_not_reach_the_database(self, topic):
+            expect(topic[1]).to_equal(2)
+
+    class IgnoresErrorsFromAnAnsweringDatabase(Vows.Context):
+        def topic(self):
+            storage = GuardedStorage(CircuitBreaker(2, 60))
+            failure = AutoReconnect('down')
+            duplicate = DuplicateKeyError('duplicate')
+            return run_calls(storage, [failure, duplicate, failure, None])
+
+        def should_stay_closed(self, topic):
+            expect(topic[-1]).to_equal('contents')
+
+    class ClosesWhenTheProbeSucceeds(Vows.Context):
+        def topic(self):
+            breaker = CircuitBreaker(1, 0)
+            storage = GuardedStorage(breaker)
+            results = run_calls(storage, [AutoReconnect('down'), None])
+            return results, breaker.is_open()
+
+        def should_let_the_probe_through(self, topic):
+            expect(topic[0]).to_equal(['AutoReconnect', 'contents'])
+
+        def should_close(self, topic):
+            expect(topic[1]).to_be_false()
+
+    class ReopensWhenTheProbeFails(Vows.Context):
+        def topic(self):
+            breaker = CircuitBreaker(1, 0)
+            storage = GuardedStorage(breaker)
+            failure = AutoReconnect('down')
+            run_calls(storage, [failure, failure])
+            return breaker.is_open()
+
+        def should_stay_open(self, topic):
+            expect(topic).to_be_true()
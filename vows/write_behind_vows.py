@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2015 Thumbor-Community
+
+import threading
+
+from pyvows import Vows, expect
+from tc_mongodb.write_behind import WriteBehindQueue
+
+
+class Recorder(object):
+    def __init__(self, expected):
+        self.batches = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append(batch)
+        if sum(len(b) for b in self.batches) >= self.expected:
+            self.done.set()
+
+
+@Vows.batch
+class WriteBehindVows(Vows.Context):
+    class FlushesInBatches(Vows.Context):
+        def topic(self):
+            recorder = Recorder(3)
+            queue = WriteBehindQueue(recorder, batch_size=2, interval=0.05)
+            for operation in ('a', 'b', 'c'):
+                queue.submit(operation)
+            recorder.done.wait(5)
+            return recorder.batches
+
+        def should_keep_submission_order(self, topic):
+            expect([op for batch in topic for op in batch]).to_equal(
+                ['a', 'b', 'c']
+            )
+
+        def should_respect_batch_size(self, topic):
+            expect(max(len(batch) for batch in topic)).to_be_lesser_than(3)
+
+    class RejectsUnknownPolicies(Vows.Context):
+        @Vows.capture_error
+        def topic(self):
+            return WriteBehindQueue(lambda batch: None, policy='wait')
+
+        def should_be_an_error(self, topic):
+            expect(topic).to_be_an_error_like(ValueError)
+
+    class DropsWritesOverTheByteBudget(Vows.Context):
+        def topic(self):
+            flushing = threading.Event()
+            release = threading.Event()
+
+            def flush(batch):
+                flushing.set()
+                release.wait(5)
+
+            queue = WriteBehindQueue(
+                flush, interval=0.01, max_bytes=10, sizeof=len
+            )
+            queue.submit(b'12345678')
+            # The first write is held until its batch is flushed
+            flushing.wait(5)
+            accepted = (queue.submit(b'123'), queue.submit(b'12'))
+            release.set()
+            return accepted, queue.dropped
+
+        def should_drop_writes_that_do_not_fit(self, topic):
+            expect(topic[0]).to_equal((False, True))
+            expect(topic[1]).to_equal(1)